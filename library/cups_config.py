@@ -0,0 +1,392 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+(c) 2016, Hitesh Prabhakar <HP41@GitHub>
+
+This file is part of Ansible
+
+This module is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This software is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this software.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import grp
+import pwd
+import tempfile
+
+
+# ===========================================
+
+
+DOCUMENTATION = '''
+---
+module: cups_config
+author:
+    - "Hitesh Prabhakar <H41P@GitHub>"
+short_description: Installs the CUPS configuration files, reloading only what they affect.
+description:
+    - Compares rendered (eg. by the template module to a temporary location) cupsd.conf, cups-browsed.conf and
+      snmp.conf with the installed ones and only installs those that differ.
+    - A new cupsd.conf is checked with 'cupsd -t' before anything is installed. Every file is written to a temporary
+      file next to the installed one and then moved in place, so CUPS never reads a partly written file.
+    - Only the services a changed file belongs to are told about it, through the service manager. cupsd is
+      reloaded, which makes it re-read its configuration once the jobs it's printing are done, without dropping them.
+      With systemd that's a HUP sent to the main process of its unit, as the cups unit has no reload action,
+      otherwise 'service <cups_service> reload'. cups-browsed, which can't reload, is restarted. snmp.conf is read by
+      the SNMP backend every time it runs, so nothing is reloaded for it.
+    - A service that isn't running reads the new configuration when it's started, so it's left alone.
+    - Nothing is stopped, started or reloaded if no file changed.
+version_added: "2.1"
+notes: []
+requirements:
+    - CUPS 1.7+
+options:
+    cupsd_conf:
+        description:
+            - Path of the rendered cupsd.conf to install on the host.
+        required: false
+        default: null
+    cups_browsed_conf:
+        description:
+            - Path of the rendered cups-browsed.conf to install on the host.
+        required: false
+        default: null
+    snmp_conf:
+        description:
+            - Path of the rendered snmp.conf to install on the host.
+        required: false
+        default: null
+    etc_dir:
+        description:
+            - The CUPS configuration directory the files are installed in.
+        required: false
+        default: /etc/cups
+    owner:
+        description:
+            - Owner of the installed files.
+        required: false
+        default: root
+    group:
+        description:
+            - Group of the installed files.
+        required: false
+        default: lp
+    mode:
+        description:
+            - Mode of the installed files, eg. '0644'.
+        required: false
+        default: "0644"
+    validate:
+        description:
+            - Whether a changed cupsd.conf is checked with 'cupsd -t' before it's installed. The module fails without
+              installing anything if the check fails.
+        required: false
+        default: true
+        choices: ["true", "false"]
+    reload:
+        description:
+            - Whether cupsd is reloaded even if cupsd.conf didn't change, eg. as its SSL certificates changed.
+        required: false
+        default: false
+        choices: ["true", "false"]
+    cups_service:
+        description:
+            - Name of the cupsd service, reloaded if cupsd.conf changed.
+        required: false
+        default: cups
+    cups_browsed_service:
+        description:
+            - Name of the cups-browsed service, restarted if cups-browsed.conf changed.
+        required: false
+        default: cups-browsed
+'''
+
+EXAMPLES = '''
+- template:
+    src: cupsd.conf.j2
+    dest: /tmp/cups-ansible/cupsd.conf
+
+- cups_config:
+    cupsd_conf: /tmp/cups-ansible/cupsd.conf
+'''
+
+RETURN = '''
+installed:
+    description: The configuration files that were installed (or would have been in check mode).
+    returned: always
+    type: list
+    sample: ["/etc/cups/cupsd.conf"]
+reloaded:
+    description: The running services that were reloaded or restarted (or would have been in check mode).
+    returned: always
+    type: list
+    sample: ["cups"]
+'''
+
+
+# ===========================================
+
+
+class CUPSConfig(object):
+    """
+        Installs the CUPS configuration files that differ from the rendered ones.
+
+        Every file is compared by content, owner, group and mode. Files that only differ in owner, group or mode are
+        fixed in place, which doesn't affect any service. Files whose content differs are installed in two steps:
+        first all of them are written to temporary files next to the installed ones (and a new cupsd.conf is
+        validated), then they're all moved in place. So a failing validation or write leaves the installed
+        configuration untouched.
+
+        FILES maps every parameter to the name of its file in etc_dir and the service affected by it. services maps
+        those to the name of the service and how the service manager makes it pick up a change.
+
+        With systemd the services are managed with systemctl, otherwise with the service command. The cups unit
+        shipped with CUPS has no ExecReload, so 'systemctl reload' fails for it. cupsd is reloaded by sending a HUP to
+        the main process of its unit instead, which is what its init script does as well.
+    """
+
+    FILES = [
+        ('cupsd_conf', 'cupsd.conf', 'cupsd'),
+        ('cups_browsed_conf', 'cups-browsed.conf', 'cups-browsed'),
+        ('snmp_conf', 'snmp.conf', None),
+    ]
+
+    # Exists if the host was booted with systemd, see sd_booted(3)
+    SYSTEMD_DIR = '/run/systemd/system'
+
+    def __init__(self, module):
+        """
+        Assigns module vars to object.
+        """
+        self.module = module
+
+        self.etc_dir = module.params['etc_dir']
+        self.validate = module.params['validate']
+        self.reload = module.params['reload']
+        self.services = {
+            'cupsd': (module.params['cups_service'], 'reload'),
+            'cups-browsed': (module.params['cups_browsed_service'], 'restart'),
+        }
+        self.check_mode = module.check_mode
+
+        self.systemctl = None
+        if os.path.isdir(self.SYSTEMD_DIR):
+            self.systemctl = module.get_bin_path('systemctl')
+
+        try:
+            self.uid = pwd.getpwnam(module.params['owner']).pw_uid
+            self.gid = grp.getgrnam(module.params['group']).gr_gid
+        except KeyError as e:
+            self.module.fail_json(msg="Unknown owner or group: {0}.".format(e))
+
+        mode = module.params['mode']
+        try:
+            self.mode = mode if isinstance(mode, int) else int(str(mode), 8)
+        except ValueError:
+            self.module.fail_json(msg="Invalid mode '{0}', it must be octal, eg. '0644'.".format(mode))
+
+    @staticmethod
+    def _read(path):
+        """
+        A static method to read a file.
+
+        :returns: The content of the file or None if it doesn't exist.
+        """
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def _attributes_differ(self, path):
+        """
+        :returns: True if the owner, group or mode of the file differ from the defined ones.
+        """
+        st = os.stat(path)
+
+        return st.st_uid != self.uid or st.st_gid != self.gid or (st.st_mode & 0o7777) != self.mode
+
+    def _stage(self, dest, content):
+        """
+        Writes the content to a temporary file next to dest, with the defined owner, group and mode.
+
+        :returns: The path of the temporary file.
+        """
+        (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(dest), prefix='.{0}.'.format(os.path.basename(dest)))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.chown(tmp_path, self.uid, self.gid)
+            os.chmod(tmp_path, self.mode)
+        except (IOError, OSError):
+            os.unlink(tmp_path)
+            raise
+
+        return tmp_path
+
+    def _validate_cupsd_conf(self, path):
+        """
+        Checks a cupsd.conf with 'cupsd -t', along with the installed cups-files.conf if there's one.
+
+        Module fails and exits if cupsd finds an error.
+        """
+        cmd = ['cupsd', '-t', '-c', path]
+
+        cups_files_conf = os.path.join(self.etc_dir, 'cups-files.conf')
+        if os.path.exists(cups_files_conf):
+            cmd.extend(['-s', cups_files_conf])
+
+        (rc, out, err) = self.module.run_command(cmd)
+
+        if rc != 0:
+            self.module.fail_json(msg="New cupsd.conf is invalid, nothing was installed. 'cupsd -t' output - {0}"
+                                  .format((err or out).strip()))
+
+    def _running(self, service):
+        """
+        :returns: True if the service manager reports the service as running.
+        """
+        if self.systemctl:
+            cmd = [self.systemctl, 'is-active', '--quiet', service]
+        else:
+            cmd = ['service', service, 'status']
+
+        (rc, out, err) = self.module.run_command(cmd)
+
+        return rc == 0
+
+    def _reload_service(self, service, action):
+        """
+        Makes a service pick up its changed configuration, see CUPSConfig.
+
+        Module fails and exits if the service manager fails to do it.
+        """
+        if self.systemctl and action == 'reload':
+            cmd = [self.systemctl, 'kill', '--signal=HUP', '--kill-who=main', service]
+        elif self.systemctl:
+            cmd = [self.systemctl, action, service]
+        else:
+            cmd = ['service', service, action]
+
+        (rc, out, err) = self.module.run_command(cmd)
+        if rc != 0:
+            self.module.fail_json(msg="Failed to {0} {1}: {2}".format(action, service, (err or out).strip()))
+
+    def install(self):
+        """
+        Installs all files that differ and reloads the services affected, see CUPSConfig.
+
+        :returns: A hash of changed, installed, reloaded and diff.
+        """
+        changes = []
+        fixes = []
+
+        for (param, filename, service) in self.FILES:
+            if not self.module.params[param]:
+                continue
+
+            content = CUPSConfig._read(self.module.params[param])
+            if content is None:
+                self.module.fail_json(msg="Rendered {0} '{1}' doesn't exist.".format(filename,
+                                                                                       self.module.params[param]))
+
+            dest = os.path.join(self.etc_dir, filename)
+            installed = CUPSConfig._read(dest)
+
+            if installed != content:
+                changes.append((dest, content, installed, service, self.module.params[param]))
+            elif self._attributes_differ(dest):
+                fixes.append(dest)
+
+        if self.validate:
+            for (dest, content, installed, service, rendered) in changes:
+                if service == 'cupsd':
+                    self._validate_cupsd_conf(rendered)
+
+        staged = []
+        if not self.check_mode:
+            try:
+                for (dest, content, installed, service, rendered) in changes:
+                    staged.append((self._stage(dest, content), dest))
+            except (IOError, OSError) as e:
+                for (tmp_path, dest) in staged:
+                    os.unlink(tmp_path)
+                self.module.fail_json(msg="Failed to write the new configuration, nothing was installed: {0}."
+                                      .format(e))
+
+            for (tmp_path, dest) in staged:
+                os.rename(tmp_path, dest)
+
+            for dest in fixes:
+                os.chown(dest, self.uid, self.gid)
+                os.chmod(dest, self.mode)
+
+        services = set(service for (dest, content, installed, service, rendered) in changes if service)
+        if self.reload:
+            services.add('cupsd')
+
+        # A service that isn't running reads the new configuration when it's started
+        reloaded = []
+        for (name, action) in sorted(self.services[service] for service in services):
+            if not self._running(name):
+                continue
+
+            if not self.check_mode:
+                self._reload_service(name, action)
+            reloaded.append(name)
+
+        diff = [{'before_header': dest, 'after_header': rendered,
+                 'before': (installed or b'').decode('utf-8', 'replace'), 'after': content.decode('utf-8', 'replace')}
+                for (dest, content, installed, service, rendered) in changes]
+
+        return {
+            'changed': bool(changes or fixes or reloaded),
+            'installed': sorted(dest for (dest, content, installed, service, rendered) in changes),
+            'reloaded': reloaded,
+            'diff': diff,
+        }
+
+
+# ===========================================
+
+
+def main():
+    """
+    main function that populates this Ansible module with variables and installs the configuration files.
+    """
+    module = AnsibleModule(
+        argument_spec=dict(
+            cupsd_conf=dict(required=False, default=None, type='path'),
+            cups_browsed_conf=dict(required=False, default=None, type='path'),
+            snmp_conf=dict(required=False, default=None, type='path'),
+            etc_dir=dict(required=False, default='/etc/cups', type='path'),
+            owner=dict(required=False, default='root', type='str'),
+            group=dict(required=False, default='lp', type='str'),
+            mode=dict(required=False, default='0644'),
+            validate=dict(required=False, default=True, type='bool'),
+            reload=dict(required=False, default=False, type='bool'),
+            cups_service=dict(required=False, default='cups', type='str'),
+            cups_browsed_service=dict(required=False, default='cups-browsed', type='str'),
+        ),
+        supports_check_mode=True,
+    )
+
+    result = CUPSConfig(module).install()
+
+    module.exit_json(**result)
+
+# Import statements at the bottom as per Ansible best practices.
+from ansible.module_utils.basic import *
+
+if __name__ == '__main__':
+    main()
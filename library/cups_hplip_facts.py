@@ -0,0 +1,172 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+(c) 2016, Hitesh Prabhakar <HP41@GitHub>
+
+This file is part of Ansible
+
+This module is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This software is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this software.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+try:
+    from configparser import RawConfigParser, Error as ConfigParserError
+except ImportError:
+    from ConfigParser import RawConfigParser, Error as ConfigParserError
+
+
+# ===========================================
+
+
+DOCUMENTATION = '''
+---
+module: cups_hplip_facts
+author:
+    - "Hitesh Prabhakar <H41P@GitHub>"
+short_description: Gathers the versions of the installed HPLIP and HP proprietary plugin.
+description:
+    - Reads the version of HPLIP from its configuration (hplip.conf) and whether the HP plugin is installed, and its
+      version, from the HPLIP state file (hplip.state), which 'hp-plugin' updates when it installs the plugin.
+    - The plugin has to match the version of HPLIP, so it only needs installing (again) if plugin_current is false,
+      eg. on a new host or after HPLIP was upgraded.
+    - Never changes anything.
+version_added: "2.1"
+notes: []
+requirements: []
+options:
+    hplip_conf:
+        description:
+            - Path of the HPLIP configuration file.
+        required: false
+        default: /etc/hp/hplip.conf
+    state_file:
+        description:
+            - Path of the HPLIP state file.
+        required: false
+        default: /var/lib/hp/hplip.state
+'''
+
+EXAMPLES = '''
+- cups_hplip_facts:
+
+- command: hp-plugin -i
+  when: not hplip.plugin_current
+'''
+
+RETURN = '''
+ansible_facts:
+    description: The gathered facts.
+    returned: always
+    type: complex
+    contains:
+        hplip:
+            description:
+                - version is the version of HPLIP, null if it isn't installed.
+                - plugin_installed tells if the HP plugin is installed and plugin_version is its version, null if
+                  it isn't installed.
+                - plugin_current is true if the plugin is installed and has the same version as HPLIP.
+            type: dict
+            sample: {"version": "3.16.11", "plugin_installed": true, "plugin_version": "3.16.11",
+                     "plugin_current": true}
+'''
+
+
+# ===========================================
+
+
+class CUPSHPLIPFacts(object):
+    """
+        Gathers the versions of HPLIP and its plugin.
+
+        Both files are INI files, eg. hplip.conf:
+            [hplip]
+            version=3.16.11
+
+        and hplip.state:
+            [plugin]
+            installed=1
+            eula=1
+            version=3.16.11
+    """
+
+    def __init__(self, module):
+        """
+        Assigns module vars to object.
+        """
+        self.module = module
+
+        self.hplip_conf = module.params['hplip_conf']
+        self.state_file = module.params['state_file']
+
+    @staticmethod
+    def read_value(path, section, option):
+        """
+        A static method to read a single value of an INI file.
+
+        :returns: The value or None if the file, section or option doesn't exist or the file can't be parsed.
+        """
+        parser = RawConfigParser()
+
+        try:
+            if not parser.read(path):
+                return None
+            if not parser.has_option(section, option):
+                return None
+            return parser.get(section, option).strip() or None
+        except ConfigParserError:
+            return None
+
+    def gather(self):
+        """
+        :returns: The facts as a hash of version, plugin_installed, plugin_version and plugin_current.
+        """
+        version = CUPSHPLIPFacts.read_value(self.hplip_conf, 'hplip', 'version')
+
+        plugin_installed = CUPSHPLIPFacts.read_value(self.state_file, 'plugin', 'installed') == '1'
+        plugin_version = None
+        if plugin_installed:
+            plugin_version = CUPSHPLIPFacts.read_value(self.state_file, 'plugin', 'version')
+
+        return {
+            'version': version,
+            'plugin_installed': plugin_installed,
+            'plugin_version': plugin_version,
+            'plugin_current': version is not None and plugin_installed and plugin_version == version,
+        }
+
+
+# ===========================================
+
+
+def main():
+    """
+    main function that populates this Ansible module with variables and gathers the facts.
+    """
+    module = AnsibleModule(
+        argument_spec=dict(
+            hplip_conf=dict(required=False, default='/etc/hp/hplip.conf', type='path'),
+            state_file=dict(required=False, default='/var/lib/hp/hplip.state', type='path'),
+        ),
+        supports_check_mode=True,
+    )
+
+    facts = CUPSHPLIPFacts(module).gather()
+
+    module.exit_json(changed=False, ansible_facts={'hplip': facts})
+
+# Import statements at the bottom as per Ansible best practices.
+from ansible.module_utils.basic import *
+
+if __name__ == '__main__':
+    main()
@@ -22,6 +22,35 @@ You should have received a copy of the GNU General Public License
 along with this software.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import base64
+import collections
+import contextlib
+import copy
+import cProfile
+import fnmatch
+import getpass
+import hashlib
+import json
+import mmap
+import socket
+import ssl
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+except ImportError:
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
 
 # ===========================================
 
@@ -51,9 +80,77 @@ options:
     purge:
         description:
             - Task to purge all printers in CUPS. Convenient before deploy.
+            - Printers and classes matching exclude are kept.
+        required: false
+        default: false
+        choices: ["true", "false"]
+    remove:
+        description:
+            - A list of printers and classes to remove in a single module run.
+            - Every item is either a name, a glob pattern (eg. 'Lab-*') or a regular expression prefixed with 're:'
+              (eg. 're:^OLD-[0-9]+$') that is matched against all printers and classes in CUPS.
+            - Classes are removed before printers. Printers and classes that don't exist are ignored.
+            - Mutually exclusive with name, purge, printers and classes.
+        required: false
+        default: null
+        type: list
+    exclude:
+        description:
+            - A list of names, glob patterns or 're:' prefixed regular expressions of printers and classes that must
+              not be removed by remove or purge, even if they match.
+        required: false
+        default: []
+        type: list
+    journal_limit:
+        description:
+            - The maximum number of commands kept in the journal of the result, per printer or class. Only the most
+              recent ones are kept once there are more. 0 keeps all of them.
+        required: false
+        default: 200
+    journal_output_limit:
+        description:
+            - The maximum number of characters of stdout and stderr kept per command in the journal. 0 keeps all of
+              it.
+        required: false
+        default: 1024
+    legacy_output:
+        description:
+            - Whether to also return the commands run and their output as the cmd_history and stdout strings like
+              older versions of this module did.
         required: false
         default: false
         choices: ["true", "false"]
+    profile:
+        description:
+            - Path of a file on the host to dump cProfile statistics of the module run to, eg. for use with pstats.
+            - Profiling processes all items of printers and classes one after the other, so all of them show up.
+        required: false
+        default: null
+    workers:
+        description:
+            - The maximum number of lpadmin commands run at the same time when removing with remove or purge.
+            - The maximum number of items of printers and classes processed at the same time. A class is only
+              processed once the printers that are or will be its members are done.
+            - No more commands or requests than server_concurrency are sent to the server at the same time though.
+        required: false
+        default: 4
+    query_concurrency:
+        description:
+            - The maximum number of read-only CUPS queries (lpoptions) run at the same time when checking the items of
+              printers and classes.
+            - The settings of all printers and classes that exist already (and aren't known to be converged, see
+              state_file) are read up front this way, before any item is processed.
+            - 0 reads them one after the other while each item is processed instead. Ignored with backend=ipp or
+              config_dir defined, as those don't run any queries per printer.
+        required: false
+        default: 8
+    query_timeout:
+        description:
+            - Seconds a single read-only query run up front (see query_concurrency) may take. The query is killed and
+              its printer or class fails once they are up.
+            - 0 waits for the queries to finish however long they take.
+        required: false
+        default: 60
     state:
         description:
             - Whether the printer should or not be in CUPS.
@@ -94,6 +191,21 @@ options:
             - The System V interface or PPD file to be used for the printer.
         required: false
         default: null
+    make_and_model:
+        description:
+            - Instead of model, the make-and-model of the driver as listed by 'lpinfo -l -m', eg.
+              'HP LaserJet 4250 Postscript (recommended)'. Case and whitespace don't matter.
+            - If several drivers match the first one by name is used. Only used with driver=model and model undefined.
+        required: false
+        default: null
+    device_id:
+        description:
+            - Instead of model, the IEEE-1284 device ID of the printer, eg. 'MFG:HP;MDL:LaserJet 4250;CMD:PCL,PJL;'.
+              The driver whose device-id has the same manufacturer (MFG) and model (MDL) is used.
+            - If several drivers match the first one by name is used. Only used with driver=model and model and
+              make_and_model undefined.
+        required: false
+        default: null
     default:
         description:
           - Set default server printer. Only one printer can be default.
@@ -152,8 +264,143 @@ options:
     options:
         description:
             - A dictionary of key-value pairs describing printer options and their required value.
+            - Values of options the driver (PPD) defines are checked against the values it allows before anything is
+              changed. Options the driver doesn't define are passed to CUPS as they are.
         default: {}
         required: false
+    printers:
+        description:
+            - A list of printers to reconcile in a single module run.
+            - Every item is a hash accepting the same keys as this module does for a single printer (name, state, uri,
+              model, options, ...). Keys that are not given take the same defaults as above.
+            - Mutually exclusive with name, purge and remove.
+        required: false
+        default: null
+        type: list
+    classes:
+        description:
+            - A list of classes to reconcile in a single module run. They are processed after any printers defined.
+            - Every item is a hash accepting the same keys as this module does for a single class (name, state,
+              class_members, info, location, ...).
+            - Mutually exclusive with name, purge and remove.
+        required: false
+        default: null
+        type: list
+    driver_cache:
+        description:
+            - Path of a host-local file to cache the driver catalog reported by 'lpinfo -l -m' in.
+            - The catalog is stored as an index that's memory-mapped by later runs, so looking up a driver doesn't
+              require reading the whole catalog. See CUPSDriverIndex for details.
+            - The cache is invalidated automatically when the driver/PPD directories or the installed packages change.
+            - If not defined the catalog is only cached in memory for the duration of the module run.
+            - Not used when server is a remote host.
+        required: false
+        default: null
+    state_file:
+        description:
+            - Path of a host-local file to remember the printers and classes in that were found to be in the desired
+              state in. As long as neither their parameters nor their section of printers.conf or classes.conf,
+              their PPD or the installed drivers changed since, they aren't checked again. See CUPSStateStore for
+              details.
+            - printers.conf and classes.conf are looked for in config_dir, or /etc/cups if it isn't defined.
+            - Not used when server is a remote host.
+            - If not defined every printer and class is checked every time.
+        required: false
+        default: null
+    backend:
+        description:
+            - How to talk to CUPS.
+            - 'lpadmin' runs the CUPS command-line tools (lpadmin, lpstat, lpoptions, lpinfo).
+            - 'ipp' sends IPP requests directly to cupsd over a pool of kept-alive connections instead.
+        required: false
+        default: lpadmin
+        choices: ["lpadmin", "ipp"]
+    server:
+        description:
+            - Host name or absolute path of the domain socket of the cupsd to manage. Any cupsd reachable from the
+              host the module runs on can be managed, so a single control node can reconcile many print servers by
+              delegating the task to localhost for each of them.
+            - With backend=lpadmin it's handed to every CUPS command-line tool as '-h server:port'.
+            - Defaults to the local cupsd, eg. the local domain socket (/run/cups/cups.sock) with backend=ipp.
+            - Of a remote server no local files are used, so state_file, driver_cache and config_dir aren't either.
+              The settings of the printers are always asked for, and the driver catalog is cached for the duration
+              of the module run only.
+        required: false
+        default: null
+    port:
+        description:
+            - The port cupsd listens on when server is a host name.
+        required: false
+        default: 631
+    encryption:
+        description:
+            - Whether the connection to cupsd is encrypted, like the Encryption directive of client.conf.
+            - 'required' and 'always' encrypt right away (with backend=lpadmin the tools are run with '-E'),
+              'ifrequested' only once the server asks for it and 'never' not at all.
+        required: false
+        default: ifrequested
+        choices: ["never", "ifrequested", "required", "always"]
+    username:
+        description:
+            - User to authenticate as on a remote server with backend=ipp, using Basic authentication. It's also the
+              requesting user of every IPP request.
+            - Set encryption=required as well, so the password isn't sent in clear text.
+            - Requests to the local cupsd are authenticated the way the CUPS tools do it, without a password.
+        required: false
+        default: null
+    password:
+        description:
+            - Password of username.
+        required: false
+        default: null
+    validate_certs:
+        description:
+            - Whether the certificate of the server is validated when the connection is encrypted with
+              backend=ipp. cupsd creates self-signed certificates by default, which can't be validated.
+        required: false
+        default: true
+        choices: ["true", "false"]
+    server_concurrency:
+        description:
+            - The maximum number of CUPS commands or IPP requests sent to the server at the same time, whether they
+              come from the workers processing items, removing printers and classes or reading their settings up
+              front (see workers and query_concurrency).
+            - With backend=ipp it's also the maximum number of kept-alive connections to the server, which are reused
+              for all requests.
+        required: false
+        default: 8
+    config_dir:
+        description:
+            - The CUPS configuration directory, eg. /etc/cups.
+            - If defined the current state of printers and classes is read directly from printers.conf, classes.conf
+              and ppd/<name>.ppd in it instead of asking cupsd. Changes are still made using the selected backend.
+            - cupsd writes these files lazily, so changes made by other means in the last few seconds might be missed.
+            - Can't be used when server is a remote host.
+        required: false
+        default: null
+    gather_facts:
+        description:
+            - Gathers the printers and classes in CUPS as facts instead of changing anything, see ansible_facts
+              below. Every printer and class is read the same way it's read to be compared with its definition.
+            - The list of printers and classes (with their device URI and whether they are enabled and accepting
+              jobs) and the default destination are always gathered. The items of this list add the sections to
+              gather on top of that. attributes are the options 'lpoptions -p' lists (eg. printer-location,
+              printer-make-and-model), members are the members of every class and driver_options the current values
+              of the driver (PPD) options of every printer.
+            - Every section left out saves a command per printer or class, and keeps the facts small.
+            - Mutually exclusive with name, purge, printers, classes and remove.
+        required: false
+        default: null
+        choices: ["all", "attributes", "members", "driver_options"]
+        type: list
+    gather_names:
+        description:
+            - Only gather the printers and classes matching any item of this list, see gather_facts. Every item is a
+              name, a glob pattern or a 're:' prefixed regular expression, like the items of remove.
+            - The default destination is returned even if it doesn't match.
+        required: false
+        default: ["*"]
+        type: list
 '''
 
 # ===========================================
@@ -209,9 +456,67 @@ EXAMPLES = '''
     state: 'absent'
     printer_or_class: 'class'
 
+# Installs several printers and a class in a single module run.
+- cups_lpadmin:
+    printers:
+      - name: 'CampusPrinter1'
+        uri: 'ipp://192.168.2.10:631/ipp/print'
+        model: 'drv:///hp/hpcups.drv/hp-laserjet_m1539dnf_mfp-pcl3.ppd'
+        location: 'Room 404'
+      - name: 'CampusPrinter2'
+        uri: 'ipp://192.168.2.11:631/ipp/print'
+        model: 'raw'
+      - name: 'HP_P2055'
+        state: 'absent'
+    classes:
+      - name: 'StudentClass'
+        class_members:
+          - CampusPrinter1
+          - CampusPrinter2
+
 # Purge all printers/classes. Useful when does not matter what we have now,
   client always receive new configuration.
 - cups_lpadmin: purge='true'
+
+# Removes all printers and classes of the old site except the ones still in use, 8 at a time.
+- cups_lpadmin:
+    remove:
+      - 'OLDSITE-*'
+      - 're:^LAB[0-9]+-(BW|COLOR)$'
+      - 'HP_P2055'
+    exclude:
+      - 'OLDSITE-RECEPTION'
+    workers: 8
+
+# Reconciles the printers of every branch print server from the control node over encrypted IPP, at most 4
+  requests to each server at a time.
+- cups_lpadmin:
+    backend: ipp
+    server: '{{ inventory_hostname }}'
+    encryption: required
+    username: '{{ cups_admin_user }}'
+    password: '{{ cups_admin_password }}'
+    validate_certs: false
+    server_concurrency: 4
+    printers: '{{ branch_printers }}'
+  delegate_to: localhost
+
+# Gathers the printers of one site with their settings and only reconciles the ones that are missing or whose
+  location differs.
+- cups_lpadmin:
+    gather_facts:
+      - attributes
+    gather_names:
+      - 'SITE1-*'
+
+- cups_lpadmin:
+    printers: "{{ printers_to_fix }}"
+  vars:
+    printers_to_fix: >-
+      [{% for p in cups_printer_list if p.name not in cups.printers
+          or cups.printers[p.name].attributes['printer-location'] | default('') != p.location | default('') %}
+      {{ p | to_json }}{{ '' if loop.last else ',' }}{% endfor %}]
+  when: printers_to_fix | length > 0
 '''
 
 # ===========================================
@@ -223,6 +528,11 @@ purge:
     returned: when purge=True
     type: string
     sample: "True"
+removed:
+    description: The printers and classes that were removed (or would be removed in check mode).
+    returned: when purge=True or remove is defined
+    type: list
+    sample: ["OLDSITE-Class", "OLDSITE-Printer1", "OLDSITE-Printer2"]
 state:
     description: The state as defined in the invocation of this script.
     returned: when purge=False
@@ -253,259 +563,3269 @@ assign_cups_policy:
     returned: when purge=False and (printer_or_class=class or printer_or_class=printer)
     type: string
     sample: "[TestPrinter1,TestPrinter2]"
+timings:
+    description:
+        - Seconds of wall time spent in each phase of the run; inventory (reading printers and classes), queries
+          (reading the settings of all printers and classes ahead of time, for printers and classes or gather_facts),
+          driver_lookup (reading the driver catalog), comparison (reading and comparing the current settings) and
+          apply (making changes).
+        - total is the wall time of the run. For printers and classes a phase counts the time in which at least one
+          item was in it. As items are processed at the same time (see workers) they may be in different phases at
+          once, so no phase exceeds total but the phases may add up to more.
+    returned: always
+    type: dict
+    sample: {"inventory": 0.012, "queries": 0.05, "driver_lookup": 0.0, "comparison": 0.094, "apply": 0.231,
+             "total": 0.392}
+fingerprint_matched:
+    description: The printer or class wasn't checked as it was found in the desired state before and neither its
+                 parameters nor the CUPS state changed since, see state_file.
+    returned: when state_file is defined and it matched
+    type: boolean
+    sample: true
+plan:
+    description:
+        - The lpadmin commands that would be run, in order. Nothing is run in check mode.
+        - changes is false for commands that only re-send settings that can't be compared (eg. cupsIPPSupplies),
+          those don't count as a change.
+    returned: in check mode
+    type: list
+    sample: [{"name": "TEST", "argv": ["lpadmin", "-p", "TEST", "-L", "Room 404"], "changes": true}]
+diff:
+    description:
+        - The settings of the printer or class that are (or in check mode would be) changed, with their current
+          value in before and their new one in after. Driver options are under options.
+    returned: when anything is changed
+    type: dict
+    sample: {"before": {"printer-location": "Room 101", "options": {"PageSize": "Letter"}},
+             "after": {"printer-location": "Room 404", "options": {"PageSize": "A4"}}}
+checks:
+    description:
+        - The settings of the printer or class that were compared with their current value, cheapest first, and
+          the outcome of every check. cost tells what a check had to look at (query for lpoptions or IPP, file for
+          a PPD or driver for the driver catalog).
+        - outcome is match, mismatch, undetermined (the expected value couldn't be determined) or skipped (a
+          cheaper check of the same setting decided it, so this one wasn't run, eg. the driver wasn't looked up
+          with lpinfo as the queue PPD showed the printer has it).
+    returned: when an existing printer or class was compared
+    type: list
+    sample: [{"name": "printer-location", "cost": "query", "outcome": "mismatch"},
+             {"name": "printer-make-and-model", "cost": "file", "outcome": "match"},
+             {"name": "printer-make-and-model", "cost": "driver", "outcome": "skipped"}]
 changed:
     description: If any changes were made to the system when this script was run.
     returned: always
     type: boolean
     sample: "False"
+journal:
+    description:
+        - The commands run (and IPP requests sent or files read), oldest first. Each one is a hash of its argv, rc,
+          duration in seconds and its stdout and stderr cut to journal_output_limit characters.
+        - rc and duration are null for files read.
+        - At most journal_limit of the most recent commands are returned.
+    returned: always
+    type: list
+    sample: [{"argv": ["lpadmin", "-p", "TEST", "-L", "Room 404"], "rc": 0, "duration": 0.012, "stdout": "",
+              "stderr": ""}]
+journal_dropped:
+    description: The number of older commands left out of journal because of journal_limit.
+    returned: when commands were left out
+    type: int
+    sample: 42
 stdout:
     description: Output from all the commands run concatenated. Only returned if any changes to the system were run.
-    returned: always
+    returned: when legacy_output=true
     type: string
     sample: "sample output"
 cmd_history:
-    description: A concatenated string of all the commands run.
-    returned: always
+    description: A concatenated string of all the commands run, each followed by its return code and wall time.
+    returned: when legacy_output=true
     type: string
-    sample: "\nlpstat -p TEST \nlpinfo -l -m \nlpoptions -p TEST \nlpstat -p TEST \nlpstat -p TEST \nlpadmin -p TEST -o cupsIPPSupplies=true -o cupsSNMPSupplies=true \nlpoptions -p TEST -l "
+    sample: "\nlpstat -v -a -c -p -d (rc=0, 0.011s) \nlpinfo -l -m (rc=0, 1.804s) \nlpoptions -p TEST (rc=0, 0.009s) "
+printers:
+    description: The result of every printer item, in the order they were defined. Each one holds the same keys as
+                 the result of a single printer invocation.
+    returned: when printers or classes is defined
+    type: list
+    sample: [{"name": "TestPrinter1", "state": "present", "changed": false, "uri": "file:///dev/null"}]
+classes:
+    description: The result of every class item, in the order they were defined. Each one holds the same keys as
+                 the result of a single class invocation.
+    returned: when printers or classes is defined
+    type: list
+    sample: [{"name": "TestClass", "state": "present", "changed": true, "class_members": ["TestPrinter1"]}]
+ansible_facts:
+    description: The printers and classes gathered.
+    returned: when gather_facts is defined
+    type: complex
+    contains:
+        cups:
+            description:
+                - default is the name of the default destination, null if there's none.
+                - printers and classes are hashes by name. Every printer holds device-uri, enabled and accepting,
+                  every class enabled and accepting. The sections gathered are added as attributes (a hash of
+                  option and value), members (a list of printer names) and driver_options (a hash of option and
+                  current value).
+            type: dict
+            sample: {
+                "default": "TestPrinter1",
+                "printers": {
+                    "TestPrinter1": {"device-uri": "file:///dev/null", "enabled": true, "accepting": true,
+                                     "attributes": {"printer-location": "Room 404", "printer-is-shared": "false"},
+                                     "driver_options": {"PageSize": "A4"}}
+                },
+                "classes": {
+                    "TestClass": {"enabled": true, "accepting": true, "members": ["TestPrinter1"],
+                                  "attributes": {"printer-info": "TestClass"}}
+                }
+            }
 '''
 
 
 # ===========================================
 
 
-class CUPSCommand(object):
+# Parameters describing a single printer or class. They are accepted at the top level of the module as well as by
+# every item of the 'printers' and 'classes' lists.
+CUPS_ITEM_ARGUMENT_SPEC = dict(
+    state=dict(required=False, default='present', choices=['present', 'absent'], type='str'),
+    driver=dict(required=False, default='model', choices=['model', 'ppd'], type='str'),
+    name=dict(required=False, type='str'),
+    printer_or_class=dict(default='printer', required=False, type='str', choices=['printer', 'class']),
+    uri=dict(required=False, default=None, type='str'),
+    enabled=dict(required=False, default=True, type='bool'),
+    shared=dict(required=False, default=False, type='bool'),
+    default=dict(required=False, default=False, type='bool'),
+    model=dict(required=False, default=None, type='str'),
+    make_and_model=dict(required=False, default=None, type='str'),
+    device_id=dict(required=False, default=None, type='str'),
+    info=dict(required=False, default=None, type='str'),
+    location=dict(required=False, default=None, type='str'),
+    assign_cups_policy=dict(required=False, default=None, type='str'),
+    class_members=dict(required=False, default=[], type='list'),
+    report_ipp_supply_levels=dict(required=False, default=True, type='bool'),
+    report_snmp_supply_levels=dict(required=False, default=True, type='bool'),
+    job_kb_limit=dict(required=False, default=None, type='int'),
+    job_quota_limit=dict(required=False, default=None, type='int'),
+    job_page_limit=dict(required=False, default=None, type='int'),
+    options=dict(required=False, default={}, type='dict'),
+)
+
+
+class CUPSDriverIndex(object):
+    """
+        A compact index of the driver catalog that can be used straight from a memory-mapped file.
+
+        Drivers can be looked up by name, by make-and-model and by the manufacturer and model (MFG/MDL) of their
+        IEEE-1284 device-id, each in constant time and without decoding any other driver. Opening the index only maps
+        the file, so it costs next to nothing however many drivers there are.
+
+        Layout (all integers big-endian):
+            - Header: magic, version, fingerprint of the drivers (see CUPSDriverCache), number of drivers and number
+              of slots per hash table.
+            - Three hash tables, for name, make-and-model and device-id, in that order. Every slot holds the offset of
+              a driver record or 0 if it's empty. Collisions are resolved by linear probing, the tables are at most
+              half full.
+            - The driver records, each made up of its FIELDS as length-prefixed UTF-8 strings.
+
+        The keys are normalised (see make_and_model_key and device_id_key) when the index is written and when it's
+        looked up. Drivers sharing a key are all found, in the order of their names.
     """
-        This is the main class that directly deals with the lpadmin command.
 
-        Method naming methodology:
-            - Methods prefixed with 'cups_item' or '_cups_item' can be used with both printer and classes.
-            - Methods prefixed with 'class' or '_class' are meant to work with classes only.
-            - Methods prefixed with 'printer' or '_printer' are meant to work with printers only.
+    MAGIC = b'CUPSDIDX'
+    VERSION = 1
 
-        CUPSCommand handles printers like so:
-            - If state=absent:
-                - Printer exists: Deletes printer
-                - Printer doesn't exist: Does nothing and exits
-            - If state=present:
-                - Printer exists: Checks printer options and compares them to the ones stated:
-                    - Options are different: Deletes the printer and installs it again with stated options.
-                    - Options are same: Does nothing and exits.
-                - Printer doesn't exist: Installs printer with stated options.
-            - Mandatory options are set every time if the right variables are defined. They are:
-                - cupsIPPSupplies
-                - cupsSNMPSupplies
-                - printer-op-policy
-                - job-k-limit
-                - job-page-limit
-                - job-quota-period
+    HEADER = struct.Struct('>8sI40sII')
+    SLOT = struct.Struct('>I')
+    LENGTH = struct.Struct('>H')
 
-        CUPSCommand handles classes like so:
-            - If state=absent:
-                - Class exists: Deletes class
-                - Class doesn't exist: Does nothing and exits
-            - If state=present:
-                - Class exists: Checks class options and members and compares them to the ones stated:
-                    - Options and members are different: Deletes the class and installs it again with
-                      stated options and stated members.
-                    - Options and members are same: Does nothing and exits.
-                - Class doesn't exist: Installs class with stated options and members.
-            - Mandatory options are set every time if the right variables are defined. They are:
-                - cupsIPPSupplies
-                - cupsSNMPSupplies
-                - printer-op-policy
-            - Notes about how classes are handled:
-                - Members stated will be the final list of printers in that class.
-                - It cannot add or remove printers from an existing list that might have more/other members defined.
-                - It'll uninstall the class and create it from scratch as defined in this script if the defined member
-                  list and the actual member list don't match.
-    """
+    FIELDS = ['name', 'natural_language', 'make-and-model', 'device-id']
 
-    def __init__(self, module):
+    def __init__(self, data):
         """
-        Assigns module vars to object.
+        :param data: The index, i.e. a memory-mapped index file or the bytes returned by build().
         """
-        self.module = module
-
-        self.driver = CUPSCommand.strip_whitespace(module.params['driver'])
-        self.name = CUPSCommand.strip_whitespace(module.params['name'])
-        self.printer_or_class = module.params['printer_or_class']
+        self.data = data
 
-        self.state = module.params['state']
-        self.purge = module.params['purge']
+        (magic, version, fingerprint, self.count, self.slots) = self.HEADER.unpack_from(data, 0)
+        self.fingerprint = fingerprint.decode('ascii').rstrip('\0')
 
-        self.uri = CUPSCommand.strip_whitespace(module.params['uri'])
-
-        self.enabled = module.params['enabled']
-        self.shared = module.params['shared']
-        self.default = module.params['default']
+    @staticmethod
+    def make_and_model_key(make_and_model):
+        """
+        A static method to normalise a make-and-model for lookups, i.e. case and whitespace are ignored.
 
-        self.model = CUPSCommand.strip_whitespace(module.params['model'])
+        :returns: The key or None if there's no make-and-model.
+        """
+        key = " ".join((make_and_model or '').lower().split())
 
-        self.info = CUPSCommand.strip_whitespace(module.params['info'])
-        self.location = CUPSCommand.strip_whitespace(module.params['location'])
+        return key or None
 
-        self.options = module.params['options']
+    @staticmethod
+    def device_id_key(device_id):
+        """
+        A static method to normalise an IEEE-1284 device ID for lookups, eg:
+            MFG:HP;MDL:LaserJet 4250;CMD:PCL,PJL;
+        into:
+            hp;laserjet 4250
 
-        self.assign_cups_policy = CUPSCommand.strip_whitespace(module.params['assign_cups_policy'])
+        The long forms MANUFACTURER and MODEL are accepted as well. Case and whitespace are ignored.
 
-        self.class_members = module.params['class_members']
+        :returns: The key or None if the device ID lacks MFG or MDL.
+        """
+        aliases = {'MFG': 'MFG', 'MANUFACTURER': 'MFG', 'MDL': 'MDL', 'MODEL': 'MDL'}
 
-        self.report_ipp_supply_levels = module.params['report_ipp_supply_levels']
-        self.report_snmp_supply_levels = module.params['report_snmp_supply_levels']
-        self.job_kb_limit = module.params['job_kb_limit']
-        self.job_quota_limit = module.params['job_quota_limit']
-        self.job_page_limit = module.params['job_page_limit']
+        fields = {}
+        for part in (device_id or '').split(';'):
+            (key, sep, value) = part.partition(':')
+            key = key.strip().upper()
+            if sep and key in aliases:
+                fields.setdefault(aliases[key], " ".join(value.lower().split()))
 
-        self.out = ""
-        self.cmd_history = ""
-        self.changed = False
+        if not fields.get('MFG') or not fields.get('MDL'):
+            return None
 
-        self.cups_current_options = {}
-        self.cups_expected_options = {}
-        self.class_current_members = []
-        self.printer_current_options = {}
+        return "{0};{1}".format(fields['MFG'], fields['MDL'])
 
-        self.check_mode = module.check_mode
+    @staticmethod
+    def _keys(driver):
+        """
+        :returns: The name, make-and-model and device-id key of a driver, see make_and_model_key and device_id_key.
+        """
+        return [driver.get('name'), CUPSDriverIndex.make_and_model_key(driver.get('make-and-model')),
+                CUPSDriverIndex.device_id_key(driver.get('device-id'))]
 
-        self.check_settings()
+    @staticmethod
+    def _hash(key):
+        """
+        A static method to hash a key, the same way across runs and Python versions.
+        """
+        return zlib.crc32(key.encode('utf-8')) & 0xffffffff
 
-    def check_settings(self):
+    @staticmethod
+    def _to_text(value):
         """
-        Checks the values provided to the module and see if there are any missing/illegal settings.
+        A static method to convert a field read from the index to text, as json does for the catalog.
+        """
+        return value.decode('utf-8')
 
-        Module fails and exits if it encounters an illegal combination of variables sent to the module.
-        :returns: None
+    @staticmethod
+    def build(drivers, fingerprint):
         """
-        msgs = []
+        A static method to build the index of a driver catalog.
 
-        if self.state == 'printer':
-            if not self.printer_or_class:
-                msgs.append("When state=present printer or class must be defined.")
+        :param drivers: Hash of drivers in the format returned by CUPSCommand._printer_get_installed_drivers.
+        :param fingerprint: The fingerprint of the drivers to store in the index.
+        :returns: The index as bytes.
+        """
+        names = sorted(drivers)
+
+        slots = 8
+        while slots < 2 * len(names):
+            slots *= 2
+
+        tables_size = 3 * slots * CUPSDriverIndex.SLOT.size
+        records = []
+        offsets = []
+        offset = CUPSDriverIndex.HEADER.size + tables_size
+        for name in names:
+            record = b''
+            for field in CUPSDriverIndex.FIELDS:
+                value = (drivers[name].get(field) or '').encode('utf-8')[:0xffff]
+                record += CUPSDriverIndex.LENGTH.pack(len(value)) + value
+            records.append(record)
+            offsets.append(offset)
+            offset += len(record)
+
+        tables = [[0] * slots for i in range(3)]
+        for (name, record_offset) in zip(names, offsets):
+            for (table, key) in zip(tables, CUPSDriverIndex._keys(drivers[name])):
+                if key is None:
+                    continue
 
-            if self.printer_or_class == 'printer':
-                if not self.uri and not self.exists_self():
-                    msgs.append("URI is required to install printer.")
+                slot = CUPSDriverIndex._hash(key) % slots
+                while table[slot]:
+                    slot = (slot + 1) % slots
+                table[slot] = record_offset
 
-            if self.printer_or_class == 'class':
-                if not self.class_members and not self.exists_self():
-                    self.module.fail_json(msg="Empty class cannot be created.")
+        header = CUPSDriverIndex.HEADER.pack(CUPSDriverIndex.MAGIC, CUPSDriverIndex.VERSION,
+                                             fingerprint.encode('ascii'), len(names), slots)
 
-        if msgs:
-            "\n".join(msgs)
-            self.module.fail_json(msg=msgs)
+        return header + b''.join(struct.pack('>{0}I'.format(slots), *table) for table in tables) + b''.join(records)
 
     @staticmethod
-    def strip_whitespace(text):
+    def open(path, fingerprint):
         """
-        A static method to help with stripping white space around object variables.
+        A static method to memory-map an index file.
 
-        :returns: Trailing whitespace removed text or 'None' if input is 'None'.
+        :param path: Path of the index file.
+        :param fingerprint: The current fingerprint of the drivers.
+        :returns: A CUPSDriverIndex or None if the file is missing, unreadable, corrupt or its fingerprint differs.
         """
         try:
-            return text.strip()
-        except:
+            with open(path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
             return None
 
-    def append_cmd_out(self, cmd_out):
-        """
-        Appends the out text from the command that was just run to the string with the out text of all the commands run.
+        try:
+            (magic, version, stored, count, slots) = CUPSDriverIndex.HEADER.unpack_from(data, 0)
+        except struct.error:
+            data.close()
+            return None
 
-        :param cmd_out: The text that was outputted during last command that was run.
-        :returns: None
-        """
-        if cmd_out:
-            self.out = "{0}{1}{2}".format(self.out, "\n", cmd_out)
+        if magic != CUPSDriverIndex.MAGIC or version != CUPSDriverIndex.VERSION or \
+                stored.decode('ascii', 'replace').rstrip('\0') != fingerprint or \
+                len(data) < CUPSDriverIndex.HEADER.size + 3 * slots * CUPSDriverIndex.SLOT.size:
+            data.close()
+            return None
 
-    def append_cmd_history(self, cmd):
+        return CUPSDriverIndex(data)
+
+    def _record(self, offset):
         """
-        Appends the commands run into a single string.
+        Decodes a single driver record.
 
-        :param cmd: The command to be appended into the command history string.
-        :returns: None
+        :returns: The hash describing the driver like CUPSCommand._printer_get_installed_drivers does and the offset
+        of the next record.
         """
-        safe_cmd = ""
-        for x in cmd:
-            x = str(x)
-            if " " in x:
-                if not ((x.startswith('"') and x.endswith('"')) or (x.startswith("'") and x.endswith("'"))):
-                    x = '{0}{1}{0}'.format('"', x)
-            safe_cmd = "{0}{1}{2}".format(safe_cmd, x, " ")
-        self.cmd_history = "{0}{1}{2}".format(self.cmd_history, "\n", safe_cmd)
+        driver = {}
+        for field in self.FIELDS:
+            (length,) = self.LENGTH.unpack_from(self.data, offset)
+            offset += self.LENGTH.size
+            value = CUPSDriverIndex._to_text(self.data[offset:offset + length])
+            offset += length
+            if value:
+                driver[field] = value
+
+        return driver, offset
+
+    def _find(self, table, key):
+        """
+        Looks up a key in one of the hash tables.
 
-    def _log_results(self, out):
+        :param table: 0 for name, 1 for make-and-model, 2 for device-id.
+        :param key: The normalised key.
+        :returns: A list of the drivers with that key.
         """
-        Method to log the details outputted from the command that was just run.
+        if key is None or not self.count:
+            return []
 
-        :param out: Output text from the command that was just run.
-        :returns: None
+        start = self.HEADER.size + table * self.slots * self.SLOT.size
+        slot = CUPSDriverIndex._hash(key) % self.slots
+        found = []
+
+        while True:
+            (offset,) = self.SLOT.unpack_from(self.data, start + slot * self.SLOT.size)
+            if not offset:
+                return found
+
+            (driver, end) = self._record(offset)
+            if CUPSDriverIndex._keys(driver)[table] == key:
+                found.append(driver)
+
+            slot = (slot + 1) % self.slots
+
+    def get(self, name):
         """
-        self.append_cmd_out(out)
+        :returns: The driver with the given name or None if there's none.
+        """
+        found = self._find(0, name)
 
-    def process_info_command(self, cmd):
+        return found[0] if found else None
+
+    def find_make_and_model(self, make_and_model):
         """
-        Runs a command that's meant to poll information only.
+        :returns: A list of the drivers with the given make-and-model, see make_and_model_key.
+        """
+        return self._find(1, CUPSDriverIndex.make_and_model_key(make_and_model))
 
-        Wraps around _process_command and ensures command output isn't logged as we're just fetching for information.
+    def find_device_id(self, device_id):
+        """
+        :returns: A list of the drivers with the manufacturer and model of the given device ID, see device_id_key.
+        """
+        return self._find(2, CUPSDriverIndex.device_id_key(device_id))
 
-        :param cmd: The command to run.
-        :returns: The output of _process_command which is return code, command output and error output.
+    def drivers(self):
         """
-        return self._process_command(cmd, log=False)
+        Decodes the whole catalog.
 
-    def process_change_command(self, cmd, err_msg, only_log_on_error=False):
+        :returns: Hash of drivers in the format returned by CUPSCommand._printer_get_installed_drivers.
         """
-        Runs a command that's meant to change CUPS state/settings.
+        drivers = {}
+        offset = self.HEADER.size + 3 * self.slots * self.SLOT.size
+        for i in range(self.count):
+            (driver, offset) = self._record(offset)
+            drivers[driver['name']] = driver
 
-        Wraps around _process_command and ensures command output is logged as we're making changes to the system.
-        An optional only_log_on_error is provided for the install_mandatory_options methods that are always run
-        almost always and need not pollute the changed/output text with its information. This'll ensure the output
-        and error text is only recorded when there's an error (err != None) and (rc != 0).
+        return drivers
 
-        It also is an easy way to centralize change command therefore making support_check_mode easier to implement.
 
-        :param cmd: The command to run.
-        :param err_msg: The error message with which to exit the module if an error occurred.
-        :param only_log_on_error: The optional flag to record output if there's an error. Default=False
-        :returns: The output of _process_command which is return code, command output and error output.
+class CUPSDriverCache(object):
+    """
+        Caches the driver catalog reported by 'lpinfo -l -m'.
+
+        The catalog is always kept in memory for the lifetime of the module run. If a path is given it's also stored
+        in that host-local file together with a fingerprint of the driver directories and the package database.
+        The stored catalog is only used while that fingerprint still matches, therefore installing, removing or
+        upgrading drivers/PPDs (or cups-driverd itself) invalidates it automatically.
+
+        The fingerprint is built from the mtime and size of every directory below DRIVER_DIRS and of the files in
+        PACKAGE_STATE_FILES. Directory mtimes change whenever a driver or PPD file is added, removed or replaced.
+
+        The catalog is kept as a CUPSDriverIndex, both in memory and in the file. A stored catalog is only
+        memory-mapped, so a run looking up a few drivers doesn't pay for reading all of them.
+    """
+
+    DRIVER_DIRS = [
+        '/usr/lib/cups/driver',
+        '/usr/share/cups/drv',
+        '/usr/share/cups/model',
+        '/usr/share/ppd',
+        '/usr/local/share/ppd',
+        '/opt/share/ppd',
+    ]
+
+    PACKAGE_STATE_FILES = [
+        '/usr/lib/cups/daemon/cups-driverd',
+        '/var/lib/dpkg/status',
+        '/var/lib/rpm/Packages',
+    ]
+
+    def __init__(self, module, path=None):
         """
-        (rc, out, err) = self._process_command(cmd, log=False)
+        Assigns module vars to object.
 
-        if rc != 0 and err:
-            self.module.fail_json(msg="Error Message - {0}. Command Error Output - {1}.".format(err_msg, err))
+        :param module: The AnsibleModule this cache works for.
+        :param path: Optional path of the file to persist the catalog in. Caches in memory only if not defined.
+        """
+        self.module = module
+        self.path = path
 
-        if self.check_mode:
-            self.module.exit_json(changed=True)
+        self.index = None
+        self._fingerprint = None
 
-        if not only_log_on_error:
-            self._log_results(out)
-            self.changed = True
+        # Single drivers looked up without reading the whole catalog, by name. None if a driver wasn't found.
+        self.lookups = {}
 
-        return rc, out, err
+        # Option schemas (see CUPSPPD.parse_schema) of the drivers, by driver and model. All printers using the same
+        # driver share the options and their allowed values, only the defaults differ.
+        self.option_schemas = {}
 
-    def _process_command(self, cmd, log=True):
+        self.lock = threading.Lock()
+
+    def fingerprint(self):
         """
-        Runs a command given to it. Also logs the details if specified.
+        Computes a fingerprint of the installed drivers without running lpinfo.
 
-        :param cmd: The command to run.
-        :param log: Boolean to specify if the command output should be logged. Default=True
-        :returns: Return code, command output and error output of the command that was run.
+        It's computed only once per module run.
+
+        :returns: A sha1 hex digest of the mtime and size of all driver directories and package state files.
         """
-        self.append_cmd_history(cmd)
+        if self._fingerprint is None:
+            entries = []
 
-        (rc, out, err) = self.module.run_command(cmd)
+            for path in self.PACKAGE_STATE_FILES:
+                entries.append(CUPSDriverCache._stat_entry(path))
 
-        if log:
-            self._log_results(out)
+            for top in self.DRIVER_DIRS:
+                entries.append(CUPSDriverCache._stat_entry(top))
+                for (dirpath, dirnames, filenames) in os.walk(top):
+                    dirnames.sort()
+                    for d in dirnames:
+                        entries.append(CUPSDriverCache._stat_entry(os.path.join(dirpath, d)))
 
-        return rc, out, err
+            self._fingerprint = hashlib.sha1("\n".join(entries).encode('utf-8')).hexdigest()
 
-    def _printer_get_installed_drivers(self):
+        return self._fingerprint
+
+    @staticmethod
+    def _stat_entry(path):
         """
-        Parses the output of lpinfo -l -m to provide a list of available drivers on machine.
+        A static method to describe a path by its mtime and size.
 
-        Example output from lpinfo -l -m:
-        Model:  name = gutenprint.5.2://xerox-wc_m118/expert
+        :returns: A string holding path, mtime and size or just the path if it doesn't exist.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return path
+
+        return "{0}:{1}:{2}".format(path, st.st_mtime, st.st_size)
+
+    def load(self):
+        """
+        Returns the cached driver catalog if there's one that's still valid.
+
+        A missing, unreadable, corrupt or stale cache file is treated as a cache miss.
+
+        :returns: The CUPSDriverIndex of the catalog or None.
+        """
+        if self.index is not None or not self.path:
+            return self.index
+
+        self.index = CUPSDriverIndex.open(self.path, self.fingerprint())
+
+        return self.index
+
+    def save(self, drivers):
+        """
+        Stores the driver catalog in memory and, if a path is defined, in the cache file.
+
+        The file is written to a temporary file first and then moved in place. Failing to write it isn't fatal,
+        the catalog will just be fetched from lpinfo again on the next run.
+
+        :param drivers: Hash of drivers in the format returned by CUPSCommand._printer_get_installed_drivers.
+        :returns: None
+        """
+        data = CUPSDriverIndex.build(drivers, self.fingerprint())
+        self.index = CUPSDriverIndex(data)
+
+        if not self.path:
+            return
+
+        try:
+            cache_dir = os.path.dirname(os.path.abspath(self.path))
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+
+            (fd, tmp_path) = tempfile.mkstemp(dir=cache_dir, prefix='.lpinfo-cache-')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            pass
+
+
+class CUPSStateStore(object):
+    """
+        Remembers the printers and classes that were found to be in the desired state, so later runs can skip
+        checking them.
+
+        For every printer or class that was checked and needed no change, a hash of its parameters is stored in a
+        host-local file together with a fingerprint of the CUPS state it was checked against. As long as both still
+        match, the printer or class is known to be converged and none of its settings need to be read again.
+
+        The fingerprint is built from the section of the printer or class in printers.conf or classes.conf, the
+        content of the PPD cupsd keeps for the printer, the mtime and size of the PPD file given in model if
+        driver=ppd and the fingerprint of the installed drivers (see CUPSDriverCache). Lines cupsd updates on its own,
+        eg. StateTime, ConfigTime or the supply levels in marker-* attributes, are left out of the section. So
+        any change made with lpadmin (or the web interface) outside of this module forces a real check of the printer
+        or class changed, and only of that one. Note that cupsd writes these files up to DirtyCleanInterval (see
+        cupsd.conf) after the change.
+
+        Even an unchanged printer or class has its mandatory options that can't be compared re-sent. So after any
+        command was run for a printer or class it's only marked as pending, with its parameters and the fingerprint
+        of the state it was left in. The next run checks it once more without re-sending those options (they were
+        just sent with the same parameters), but only if its state is still the same. If it isn't (eg. it was changed
+        in between, or cupsd hadn't written the change yet when the fingerprint was taken) it's checked in full. If
+        nothing needs changing the fingerprint of the state it found is stored. A printer or class that failed is
+        removed from the file. Check mode leaves the file as it is.
+    """
+
+    STATE_VERSION = 2
+
+    # Keywords of printers.conf and classes.conf that cupsd updates without the printer or class being changed
+    VOLATILE_KEYWORDS = ['StateMessage', 'StateTime', 'ConfigTime', 'Reason']
+
+    def __init__(self, module, path, cups_dir, driver_cache):
+        """
+        Assigns module vars to object. The file is only read when needed.
+
+        :param module: The AnsibleModule this store works for.
+        :param path: Path of the file to keep the state in.
+        :param cups_dir: The CUPS configuration directory holding printers.conf, classes.conf and ppd/.
+        :param driver_cache: The CUPSDriverCache whose fingerprint is part of the fingerprint of every printer.
+        """
+        self.module = module
+        self.path = path
+        self.cups_dir = cups_dir
+        self.driver_cache = driver_cache
+
+        self.entries = None
+        self._sections = None
+
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def params_hash(params):
+        """
+        A static method to hash the parameters of a printer or class.
+
+        :param params: A hash of parameters as handed to CUPSCommand.
+        :returns: A sha1 hex digest of the parameters listed in CUPS_ITEM_ARGUMENT_SPEC.
+        """
+        item = dict((k, params.get(k)) for k in CUPS_ITEM_ARGUMENT_SPEC)
+
+        return hashlib.sha1(json.dumps(item, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _read_sections(path, sections):
+        """
+        A static method to read the sections of printers.conf or classes.conf, without their volatile lines.
+
+        :param path: Path of the file.
+        :param sections: The hash to add the lines of every section to, by printer or class name.
+        """
+        lines = None
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                keyword = line.split(' ', 1)[0]
+
+                if line.startswith('</'):
+                    lines = None
+                elif line.startswith('<') and line.endswith('>'):
+                    (kind, sep, name) = line[1:-1].partition(' ')
+                    lines = sections.setdefault(name, [])
+                    lines.append(kind)
+                elif lines is None or keyword in CUPSStateStore.VOLATILE_KEYWORDS or \
+                        line.startswith('Attribute marker-'):
+                    continue
+                else:
+                    lines.append(line)
+
+    def _load_sections(self):
+        """
+        Reads the sections of printers.conf and classes.conf.
+
+        :returns: The lines of every section by printer or class name or None if there's no readable printers.conf.
+        """
+        sections = {}
+
+        for filename in ('printers.conf', 'classes.conf'):
+            try:
+                self._read_sections(os.path.join(self.cups_dir, filename), sections)
+            except (IOError, OSError):
+                if filename == 'printers.conf':
+                    return None
+
+        return sections
+
+    @staticmethod
+    def _content_entry(path):
+        """
+        A static method to describe a file by its content.
+
+        :returns: A string holding path and the sha1 of its content or just the path if it can't be read.
+        """
+        try:
+            with open(path, 'rb') as f:
+                return '{0} {1}'.format(path, hashlib.sha1(f.read()).hexdigest())
+        except (IOError, OSError):
+            return path
+
+    def refresh(self):
+        """
+        Makes the next fingerprint() read printers.conf and classes.conf again, eg. after this run changed them.
+        """
+        with self.lock:
+            self._sections = None
+
+    def fingerprint(self, params):
+        """
+        Computes the fingerprint of the CUPS state of a printer or class.
+
+        printers.conf and classes.conf are only read once per module run (or after refresh()), so all printers and
+        classes are fingerprinted against the state from before this run changed anything.
+
+        :param params: A hash of parameters as handed to CUPSCommand.
+        :returns: A sha1 hex digest or None if the state can't be fingerprinted, i.e. there's no printers.conf.
+        """
+        with self.lock:
+            if self._sections is None:
+                self._sections = self._load_sections() or False
+            sections = self._sections
+
+        if sections is False:
+            return None
+
+        entries = [self.driver_cache.fingerprint()]
+        entries.extend(sections.get(params['name']) or ['-'])
+        if params['name']:
+            entries.append(CUPSStateStore._content_entry(os.path.join(self.cups_dir, 'ppd',
+                                                                      '{0}.ppd'.format(params['name']))))
+        if params['driver'] == 'ppd' and params['model']:
+            entries.append(CUPSDriverCache._stat_entry(params['model']))
+
+        return hashlib.sha1("\n".join(entries).encode('utf-8')).hexdigest()
+
+    def load(self):
+        """
+        Reads the state file, unless it has already been done.
+
+        A missing, unreadable or corrupt file is treated as if nothing was known to be converged.
+
+        :returns: The hash of entries by printer or class name.
+        """
+        with self.lock:
+            if self.entries is None:
+                self.entries = {}
+
+                try:
+                    with open(self.path) as f:
+                        state = json.load(f)
+                except (IOError, OSError, ValueError):
+                    state = None
+
+                if isinstance(state, dict) and state.get('version') == self.STATE_VERSION:
+                    self.entries = state.get('entries') or {}
+
+        return self.entries
+
+    def matches(self, name, params_hash, fingerprint):
+        """
+        :returns: True if the printer or class was found converged with the same parameters and CUPS state before.
+        """
+        if fingerprint is None:
+            return False
+
+        return self.load().get(name) == {'params': params_hash, 'fingerprint': fingerprint}
+
+    def pending(self, name, params_hash, fingerprint):
+        """
+        :returns: True if commands were run for the printer or class with the same parameters in the last run and
+        its CUPS state hasn't changed since.
+        """
+        if fingerprint is None:
+            return False
+
+        return self.load().get(name) == {'params': params_hash, 'fingerprint': fingerprint, 'pending': True}
+
+    def update(self, name, params_hash, fingerprint, failed=False, commands_run=False):
+        """
+        Records the outcome of checking a printer or class.
+
+        :param name: Name of the printer or class.
+        :param params_hash: The hash of its parameters, see params_hash().
+        :param fingerprint: The fingerprint of the CUPS state it was checked against, see fingerprint(). If commands
+        were run, the fingerprint of the state they left it in, taken after refresh().
+        :param failed: True if it failed, it's removed then.
+        :param commands_run: True if any command was run for it, it's marked as pending then.
+        """
+        entries = self.load()
+        with self.lock:
+            if failed or fingerprint is None:
+                entries.pop(name, None)
+            elif commands_run:
+                entries[name] = {'params': params_hash, 'fingerprint': fingerprint, 'pending': True}
+            else:
+                entries[name] = {'params': params_hash, 'fingerprint': fingerprint}
+
+    def save(self):
+        """
+        Writes the state file, to a temporary file first that is then moved in place.
+
+        Failing to write it isn't fatal, everything will just be checked again on the next run.
+
+        :returns: None
+        """
+        if self.entries is None:
+            return
+
+        state = {
+            'version': self.STATE_VERSION,
+            'entries': self.entries,
+        }
+
+        try:
+            state_dir = os.path.dirname(os.path.abspath(self.path))
+            if not os.path.isdir(state_dir):
+                os.makedirs(state_dir)
+
+            (fd, tmp_path) = tempfile.mkstemp(dir=state_dir, prefix='.lpadmin-state-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            pass
+
+    @staticmethod
+    def from_module(module, driver_cache):
+        """
+        A static method to create the store defined by the module parameters.
+
+        :returns: A CUPSStateStore or None if state_file isn't defined or a remote server is managed, whose state
+        can't be fingerprinted from here.
+        """
+        if not module.params['state_file']:
+            return None
+
+        if CUPSServer.from_module(module).is_remote():
+            return None
+
+        return CUPSStateStore(module, module.params['state_file'], module.params['config_dir'] or '/etc/cups',
+                              driver_cache)
+
+
+class CUPSInventory(object):
+    """
+        An in-memory index of all destinations (printers and classes) in CUPS.
+
+        It's populated from a single snapshot, i.e. the output of 'lpstat -v -a -c -p -d', instead of forking lpstat
+        for every existence or membership check. CUPSCommand keeps it up to date as it applies changes so it can
+        be shared by several CUPSCommand objects within the same module run.
+
+        Every destination is stored as a hash, eg:
+            'TestPrinter1': 'printer_or_class': 'printer'
+                            'device-uri': 'file:///dev/null'
+                            'accepting': True
+                            'enabled': True
+                            'members': []
+    """
+
+    def __init__(self):
+        """
+        Initialises an empty, not yet loaded inventory.
+        """
+        self.destinations = None
+        self.default = None
+
+        # Guards the changes recorded by CUPSCommand objects running concurrently, see CUPSBulkCommand
+        self.lock = threading.RLock()
+
+    def loaded(self):
+        """
+        :returns: True if a snapshot has been parsed into this inventory.
+        """
+        return self.destinations is not None
+
+    def _destination(self, name):
+        """
+        Returns the hash of a destination, creating an empty printer entry for it if it doesn't exist yet.
+
+        :param name: Name of the printer or class.
+        :returns: The hash describing the destination.
+        """
+        if name not in self.destinations:
+            self.destinations[name] = {
+                'printer_or_class': 'printer',
+                'device-uri': None,
+                'accepting': False,
+                'enabled': False,
+                'members': [],
+            }
+
+        return self.destinations[name]
+
+    def parse_lpstat(self, out):
+        """
+        Parses the combined output of 'lpstat -v -a -c -p -d' into this inventory, eg:
+            device for TestPrinter1: file:///dev/null
+            TestPrinter1 accepting requests since Mon 23 May 2016 11:08:40 AM AEST
+            TestClass not accepting requests since Mon 23 May 2016 11:08:40 AM AEST -
+                Rejecting Jobs
+            members of class TestClass:
+                TestPrinter1
+            printer TestPrinter1 is idle.  enabled since Mon 23 May 2016 11:08:40 AM AEST
+            printer TestClass disabled since Mon 23 May 2016 11:08:40 AM AEST -
+                reason unknown
+            system default destination: TestPrinter1
+
+        Lines starting with whitespace continue the line before them. They list class members after a
+        'members of class' line and are informational (state reasons) otherwise.
+
+        :param out: Output of the lpstat command.
+        :returns: None
+        """
+        self.destinations = {}
+        self.default = None
+
+        current_class = None
+        for line in out.splitlines():
+            if not line.strip():
+                continue
+
+            if line[0].isspace():
+                if current_class is not None:
+                    self.destinations[current_class]['members'].append(line.strip())
+                continue
+
+            current_class = None
+            words = line.split()
+
+            if words[1:3] == ['accepting', 'requests']:
+                self._destination(words[0])['accepting'] = True
+            elif words[1:4] == ['not', 'accepting', 'requests']:
+                self._destination(words[0])['accepting'] = False
+            elif line.startswith('device for '):
+                (name, uri) = line[len('device for '):].split(':', 1)
+                self._destination(name)['device-uri'] = uri.strip()
+            elif line.startswith('members of class '):
+                current_class = line[len('members of class '):].strip().rstrip(':')
+                self._destination(current_class)['printer_or_class'] = 'class'
+                self.destinations[current_class]['device-uri'] = None
+            elif words[0] == 'printer' and len(words) > 2:
+                self._destination(words[1])['enabled'] = words[2] != 'disabled'
+            elif line.startswith('system default destination:'):
+                self.default = line.split(':', 1)[1].strip()
+
+    def parse_ipp_printers(self, printers, default=None):
+        """
+        Loads this inventory from the printer attributes returned by a CUPS-Get-Printers IPP request.
+
+        :param printers: A list of attribute hashes, one per printer or class, see CUPSIPPBackend.get_printers.
+        :param default: Name of the server default destination.
+        :returns: None
+        """
+        self.destinations = {}
+        self.default = default
+
+        for attributes in printers:
+            if 'printer-name' not in attributes:
+                continue
+
+            dest = self._destination(attributes['printer-name'][0])
+
+            if (attributes.get('printer-type') or [0])[0] & CUPSIPPBackend.PRINTER_TYPE_CLASS:
+                dest['printer_or_class'] = 'class'
+                dest['members'] = list(attributes.get('member-names') or [])
+            else:
+                dest['device-uri'] = (attributes.get('device-uri') or [None])[0]
+
+            dest['accepting'] = bool((attributes.get('printer-is-accepting-jobs') or [False])[0])
+            dest['enabled'] = (attributes.get('printer-state') or [0])[0] != CUPSIPPBackend.PRINTER_STATE_STOPPED
+
+    def parse_config(self, destinations, default=None):
+        """
+        Loads this inventory from the destinations read out of printers.conf and classes.conf.
+
+        :param destinations: The hash of destinations, see CUPSConfigReader.
+        :param default: Name of the server default destination.
+        :returns: None
+        """
+        self.destinations = {}
+        self.default = default
+
+        for (name, config) in destinations.items():
+            dest = self._destination(name)
+            dest['printer_or_class'] = config['printer_or_class']
+            dest['members'] = list(config['members'])
+            dest['device-uri'] = config['options'].get('device-uri')
+            dest['accepting'] = config['options'].get('printer-is-accepting-jobs') == 'true'
+            dest['enabled'] = config['options'].get('printer-state') != CUPSConfigReader.CONFIG_STATES['Stopped']
+
+    def names(self):
+        """
+        :returns: A sorted list of all printer and class names.
+        """
+        with self.lock:
+            return sorted(self.destinations)
+
+    def exists(self, name):
+        """
+        :param name: Name of the printer or class.
+        :returns: True if the printer or class exists.
+        """
+        return name in self.destinations
+
+    def is_class(self, name):
+        """
+        :param name: Name of the printer or class.
+        :returns: True if name exists and is a class.
+        """
+        return self.exists(name) and self.destinations[name]['printer_or_class'] == 'class'
+
+    def get_class_members(self, name):
+        """
+        :param name: Name of the class.
+        :returns: A list of members of the class or None if the class doesn't exist.
+        """
+        with self.lock:
+            if not self.is_class(name):
+                return None
+
+            return list(self.destinations[name]['members'])
+
+    def add_printer(self, name, uri=None, enabled=False):
+        """
+        Records a printer that has been installed or modified.
+
+        :param name: Name of the printer.
+        :param uri: The device URI of the printer.
+        :param enabled: Whether the printer is enabled and accepting jobs.
+        :returns: None
+        """
+        with self.lock:
+            dest = self._destination(name)
+            if uri is not None:
+                dest['device-uri'] = uri
+            if enabled:
+                dest['enabled'] = dest['accepting'] = True
+
+    def add_class_member(self, class_name, printer):
+        """
+        Records a printer that has been added to a class, creating the class if needed.
+
+        :param class_name: Name of the class.
+        :param printer: Name of the printer added.
+        :returns: None
+        """
+        with self.lock:
+            dest = self._destination(class_name)
+            dest['printer_or_class'] = 'class'
+            if printer not in dest['members']:
+                dest['members'].append(printer)
+
+    def remove_class_member(self, class_name, printer):
+        """
+        Records a printer that has been removed from a class. Like CUPS, a class left without members is removed.
+
+        :param class_name: Name of the class.
+        :param printer: Name of the printer removed.
+        :returns: None
+        """
+        with self.lock:
+            if not self.is_class(class_name):
+                return
+
+            members = self.destinations[class_name]['members']
+            if printer in members:
+                members.remove(printer)
+
+            if not members:
+                self.remove(class_name)
+
+    def remove(self, name):
+        """
+        Records a printer or class that has been deleted. A deleted printer is also removed from every class.
+
+        :param name: Name of the printer or class.
+        :returns: None
+        """
+        with self.lock:
+            if self.destinations.pop(name, None) is None:
+                return
+
+            if self.default == name:
+                self.default = None
+
+            for class_name in [c for c in self.destinations if self.is_class(c)]:
+                if name in self.destinations[class_name]['members']:
+                    self.remove_class_member(class_name, name)
+
+
+class CUPSPPD(object):
+    """
+        Helpers to read PPD files without going through the CUPS command-line tools.
+    """
+
+    @staticmethod
+    def get_nickname(path):
+        """
+        A static method to read the *NickName of a PPD file, which CUPS uses as printer-make-and-model, eg:
+            *NickName: "HP LaserJet 4250 Postscript (recommended)"
+
+        :param path: Path of the PPD file.
+        :returns: The NickName or None if the file can't be read or has no NickName.
+        """
+        return CUPSPPD.get_keyword(path, 'NickName')
+
+    @staticmethod
+    def get_keyword(path, keyword):
+        """
+        A static method to read the value of a main keyword of a PPD file, eg. for keyword='PCFileName':
+            *PCFileName: "laserjet.ppd"
+
+        The file is only read up to the keyword's line.
+
+        :param path: Path of the PPD file.
+        :param keyword: The keyword without its leading '*'.
+        :returns: The value or None if the file can't be read or doesn't have the keyword.
+        """
+        prefix = '*{0}:'.format(keyword)
+
+        try:
+            with open(path) as f:
+                for line in f:
+                    if line.startswith(prefix):
+                        return line.split(':', 1)[1].strip().strip('"')
+        except (IOError, OSError):
+            pass
+
+        return None
+
+    @staticmethod
+    def queue_ppd_dir(cups_dir=None):
+        """
+        A static method to find the directory cupsd keeps the PPDs of its printers in.
+
+        :param cups_dir: The CUPS configuration directory. Default=/etc/cups
+        :returns: The path of the directory. None if it can't be read, eg. if the module isn't run as root.
+        """
+        path = os.path.join(cups_dir or '/etc/cups', 'ppd')
+
+        return path if os.access(path, os.R_OK | os.X_OK) else None
+
+    @staticmethod
+    def parse_schema(lines):
+        """
+        A static method to parse the user selectable options of a PPD, eg:
+            *OpenUI *PageSize/Page Size: PickOne
+            *DefaultPageSize: Letter
+            *PageSize Letter/US Letter: "<</PageSize[612 792]>>setpagedevice"
+            *PageSize A4/A4: "<</PageSize[595 842]>>setpagedevice"
+            *CloseUI: *PageSize
+
+        into the option schema, i.e. the names, labels and allowed values of the options:
+            'PageSize': 'label': 'Page Size'
+                        'values': 'Letter'
+                                  'A4'
+
+        and their defaults:
+            'PageSize': 'Letter'
+
+        Quoted values spanning several lines are skipped over.
+
+        :param lines: An iterable of the lines of the PPD.
+        :returns: A tuple of the option schema and the hash of defaults.
+        """
+        schema = {}
+        defaults = {}
+        current = None
+        in_quote = False
+
+        for line in lines:
+            if in_quote:
+                if '"' in line:
+                    in_quote = False
+                continue
+
+            if not line.startswith('*') or line.startswith('*%'):
+                continue
+
+            (keyword, sep, value) = line.partition(':')
+            value = value.strip()
+            if value.startswith('"') and value.count('"') == 1:
+                in_quote = True
+
+            if keyword.startswith('*OpenUI') or keyword.startswith('*JCLOpenUI'):
+                spec = keyword.split(None, 1)[1].lstrip('*') if len(keyword.split(None, 1)) > 1 else ''
+                (name, sep, label) = spec.partition('/')
+                current = name
+                schema[name] = {'label': label or name, 'values': []}
+            elif keyword.startswith('*CloseUI') or keyword.startswith('*JCLCloseUI'):
+                current = None
+            elif keyword.startswith('*Default'):
+                defaults[keyword[len('*Default'):]] = value.split('/', 1)[0].strip()
+            elif current is not None and keyword.startswith('*{0} '.format(current)):
+                choice = keyword.split(None, 1)[1].split('/', 1)[0]
+                schema[current]['values'].append(choice)
+
+        return schema, defaults
+
+    @staticmethod
+    def read_defaults(lines, names):
+        """
+        A static method to read only the defaults of the given options of a PPD, eg:
+            *DefaultPageSize: Letter
+
+        Every other line is skipped without being parsed, which makes this a lot cheaper than parse_schema() once the
+        option schema of the driver is known.
+
+        :param lines: An iterable of the lines of the PPD.
+        :param names: The names of the options to read the defaults of.
+        :returns: A hash of option name and default, for the options that have one.
+        """
+        wanted = set('*Default{0}'.format(name) for name in names)
+
+        defaults = {}
+        for line in lines:
+            if not line.startswith('*Default'):
+                continue
+
+            (keyword, sep, value) = line.partition(':')
+            if keyword in wanted:
+                defaults[keyword[len('*Default'):]] = value.strip().split('/', 1)[0].strip()
+
+        return defaults
+
+    @staticmethod
+    def options_from_schema(schema, defaults, names=None):
+        """
+        A static method to combine an option schema and defaults into the format returned by
+        CUPSCommand.printer_get_specific_options, eg:
+            'PageSize': 'current': 'Letter'
+                        'label': 'Page Size'
+                        'values': '*Letter'
+                                  'A4'
+
+        :param schema: The option schema, see parse_schema().
+        :param defaults: The hash of option defaults.
+        :param names: Optional list of the options to include. Default=all options of the schema.
+        :returns: A hash of options.
+        """
+        options = {}
+
+        for name in (schema if names is None else names):
+            if name not in schema:
+                continue
+
+            current = defaults.get(name)
+            options[name] = {
+                'current': current,
+                'label': schema[name]['label'],
+                'values': ['*{0}'.format(v) if v == current else v for v in schema[name]['values']],
+            }
+
+        return options
+
+    @staticmethod
+    def schema_from_options(options):
+        """
+        A static method to extract the option schema from a hash in the format returned by
+        CUPSCommand.printer_get_specific_options, i.e. the reverse of options_from_schema().
+
+        :returns: The option schema, see parse_schema().
+        """
+        return dict((name, {'label': option['label'], 'values': [v.lstrip('*') for v in option['values']]})
+                    for (name, option) in options.items())
+
+    @staticmethod
+    def parse_options(lines):
+        """
+        A static method to parse the user selectable options of a PPD with their current values, see parse_schema()
+        and options_from_schema().
+
+        :param lines: An iterable of the lines of the PPD.
+        :returns: A hash in the same format as CUPSCommand.printer_get_specific_options.
+        """
+        (schema, defaults) = CUPSPPD.parse_schema(lines)
+
+        return CUPSPPD.options_from_schema(schema, defaults)
+
+
+class CUPSConfigReader(object):
+    """
+        Reads the current state of all printers and classes directly from the CUPS configuration files.
+
+        printers.conf and classes.conf are parsed in a single streaming pass each, building the same option hashes
+        'lpoptions -p' returns and the class members 'lpstat -c' lists. Printer driver options are read from the copy
+        of the PPD cupsd keeps in ppd/<name>.ppd. This works without connecting to cupsd, even while it's stopped.
+
+        Note that cupsd writes printers.conf and classes.conf lazily (see DirtyCleanInterval in cupsd.conf), so changes
+        made just before reading them might not be visible yet.
+
+        Every destination is stored as a hash, eg:
+            'TestPrinter1': 'printer_or_class': 'printer'
+                            'options': 'device-uri': 'file:///dev/null'
+                                       'printer-info': 'TestPrinter1'
+                                       'printer-is-shared': 'true'
+                                       ...
+                            'members': []
+    """
+
+    # Keys of printers.conf/classes.conf and the lpoptions option they correspond to.
+    CONFIG_OPTIONS = {
+        'DeviceURI': 'device-uri',
+        'Info': 'printer-info',
+        'KLimit': 'job-k-limit',
+        'Location': 'printer-location',
+        'MakeModel': 'printer-make-and-model',
+        'OpPolicy': 'printer-op-policy',
+        'PageLimit': 'job-page-limit',
+        'QuotaPeriod': 'job-quota-period',
+        'Type': 'printer-type',
+    }
+
+    CONFIG_BOOLEAN_OPTIONS = {
+        'Accepting': 'printer-is-accepting-jobs',
+        'Shared': 'printer-is-shared',
+    }
+
+    CONFIG_STATES = {
+        'Idle': '3',
+        'Stopped': '5',
+    }
+
+    def __init__(self, module, path):
+        """
+        Assigns module vars to object. The files are only read when needed.
+
+        :param module: The AnsibleModule this reader works for.
+        :param path: The CUPS configuration directory, eg. /etc/cups.
+        """
+        self.module = module
+        self.path = path
+
+        self.destinations = None
+        self.default = None
+
+    def files(self):
+        """
+        :returns: A list of the configuration files read by load().
+        """
+        return [os.path.join(self.path, 'printers.conf'), os.path.join(self.path, 'classes.conf')]
+
+    def load(self):
+        """
+        Parses printers.conf and classes.conf, unless it has already been done.
+
+        A missing file means there are no printers or classes. Module fails and exits if a file can't be read.
+
+        :returns: The hash of destinations.
+        """
+        if self.destinations is None:
+            self.destinations = {}
+            self.default = None
+
+            for path in self.files():
+                try:
+                    with open(path) as f:
+                        self._parse(f)
+                except (IOError, OSError) as e:
+                    if os.path.exists(path):
+                        self.module.fail_json(msg="Unable to read CUPS configuration '{0}': {1}".format(path, e))
+
+        return self.destinations
+
+    def _parse(self, lines):
+        """
+        Parses the lines of printers.conf or classes.conf, eg:
+            <DefaultPrinter TestPrinter1>
+            Info Printer Info
+            Location Room 404
+            MakeModel HP LaserJet 4250 Postscript (recommended)
+            DeviceURI socket://127.0.0.1:9100
+            State Idle
+            Accepting Yes
+            Shared No
+            Option media iso_a4_210x297mm
+            </DefaultPrinter>
+            <Class TestClass>
+            Printer TestPrinter1
+            Printer TestPrinter2
+            </Class>
+
+        :param lines: An iterable of lines of the file.
+        :returns: None
+        """
+        current = None
+
+        for line in lines:
+            line = line.strip()
+
+            if not line or line.startswith('#'):
+                continue
+
+            if line.startswith('</'):
+                current = None
+                continue
+
+            if line.startswith('<') and line.endswith('>'):
+                (section, sep, name) = line[1:-1].partition(' ')
+                name = name.strip()
+                printer_or_class = 'class' if section.endswith('Class') else 'printer'
+
+                current = {'printer_or_class': printer_or_class, 'options': {}, 'members': []}
+                self.destinations[name] = current
+
+                if section.startswith('Default'):
+                    self.default = name
+                continue
+
+            if current is None:
+                continue
+
+            (key, sep, value) = line.partition(' ')
+            value = value.strip().replace('\\#', '#')
+
+            if key in self.CONFIG_OPTIONS:
+                current['options'][self.CONFIG_OPTIONS[key]] = value
+            elif key in self.CONFIG_BOOLEAN_OPTIONS:
+                current['options'][self.CONFIG_BOOLEAN_OPTIONS[key]] = 'true' if value.lower() == 'yes' else 'false'
+            elif key == 'State':
+                current['options']['printer-state'] = self.CONFIG_STATES.get(value, value)
+            elif key == 'Printer':
+                current['members'].append(value)
+            elif key == 'Option':
+                (option, sep, option_value) = value.partition(' ')
+                current['options'][option] = option_value.strip()
+
+        for dest in self.destinations.values():
+            if dest['printer_or_class'] == 'class':
+                dest['options']['member-names'] = ','.join(dest['members'])
+
+    def get_cups_options(self, name):
+        """
+        :param name: Name of the printer or class.
+        :returns: A hash of options in the same format as CUPSCommand.cups_item_get_cups_options or an empty hash if
+        the printer or class doesn't exist.
+        """
+        dest = self.load().get(name)
+
+        if dest is None:
+            return {}
+
+        return dict(dest['options'])
+
+
+class CUPSServer(object):
+    """
+        The cupsd the module talks to and how.
+
+        Without 'server' that's the local cupsd, reached the way the CUPS tools reach it by default. With 'server' it
+        may be any cupsd, so a single control node can reconcile many print servers, eg. by delegating the task to
+        localhost for every print server of the inventory.
+
+        The CUPS command-line tools are told about the server with '-h server:port' (and '-E' to force encryption),
+        added right after the name of the tool when a command is run, see command(). The IPP backend connects to the
+        server itself and keeps a pool of kept-alive connections to it, see CUPSIPPBackend.
+
+        At most 'concurrency' commands or requests are sent to the server at the same time, whichever pool of workers
+        (see workers and query_concurrency) they come from. Everything talking to the server holds one of its slots
+        for the duration of a command or request.
+
+        There's one CUPSServer per server and port for the lifetime of the module run, see from_module, so all
+        CUPSCommand objects share its slots and connections.
+    """
+
+    ENCRYPTIONS = ['never', 'ifrequested', 'required', 'always']
+
+    LOCAL_HOSTS = ['localhost', '127.0.0.1', '::1']
+
+    # The CUPSServer objects created, by server and port
+    servers = {}
+    lock = threading.Lock()
+
+    def __init__(self, host=None, port=631, encryption='ifrequested', username=None, password=None,
+                 validate_certs=True, concurrency=8):
+        """
+        Assigns module vars to object.
+
+        :param host: Host name or absolute path of a domain socket of cupsd. Default=The local cupsd
+        :param port: The port cupsd listens on when connecting to a host. Default=631
+        :param encryption: One of ENCRYPTIONS, like the Encryption directive of client.conf. Default=ifrequested
+        :param username: Optional user to authenticate as on a remote server.
+        :param password: Optional password of the user.
+        :param validate_certs: Whether the certificate of the server is validated when encrypting. Default=True
+        :param concurrency: The maximum number of commands or requests sent to the server at the same time. Default=8
+        """
+        self.host = host
+        self.port = port
+        self.encryption = encryption
+        self.username = username
+        self.password = password
+        self.validate_certs = validate_certs
+        self.concurrency = max(1, concurrency)
+
+        self.slots = threading.BoundedSemaphore(self.concurrency)
+
+    def is_remote(self):
+        """
+        :returns: True if the server is a cupsd on another host, whose files and drivers can't be looked at locally.
+        """
+        return bool(self.host) and not self.host.startswith('/') and self.host not in self.LOCAL_HOSTS
+
+    def encrypt(self):
+        """
+        :returns: True if connections to the server have to be encrypted right away.
+        """
+        return self.encryption in ['required', 'always']
+
+    def cli_args(self):
+        """
+        :returns: The options telling the CUPS command-line tools which server to talk to and how.
+        """
+        args = []
+
+        if self.encrypt():
+            args.append('-E')
+
+        if self.host:
+            args.extend(['-h', self.host if self.host.startswith('/') else '{0}:{1}'.format(self.host, self.port)])
+
+        return args
+
+    def command(self, cmd):
+        """
+        Adds the options of cli_args to a command. They have to come first, lpadmin eg. treats a '-E' following '-p'
+        as enabling the printer.
+
+        :param cmd: The command as a list, starting with the name of the tool.
+        :returns: The command to run.
+        """
+        args = self.cli_args()
+        if not args:
+            return cmd
+
+        return cmd[:1] + args + cmd[1:]
+
+    @staticmethod
+    def from_module(module):
+        """
+        A static method to get the server defined by the module parameters.
+
+        Module fails and exits if the parameters can't be used with that server.
+
+        :returns: The CUPSServer, the same one for every call with the same server and port.
+        """
+        params = module.params
+        key = (params['server'], params['port'])
+
+        with CUPSServer.lock:
+            if key not in CUPSServer.servers:
+                CUPSServer.servers[key] = CUPSServer(host=params['server'], port=params['port'],
+                                                     encryption=params['encryption'], username=params['username'],
+                                                     password=params['password'],
+                                                     validate_certs=params['validate_certs'],
+                                                     concurrency=params['server_concurrency'])
+            server = CUPSServer.servers[key]
+
+        if server.is_remote() and params['config_dir']:
+            module.fail_json(msg="config_dir can't be used with the remote server '{0}', its configuration files "
+                                 "aren't accessible from here.".format(server.host))
+
+        return server
+
+
+class _UnixHTTPConnection(HTTPConnection):
+    """
+        A HTTPConnection to cupsd's local domain socket.
+    """
+
+    def __init__(self, path, timeout=None):
+        HTTPConnection.__init__(self, 'localhost')
+        self.socket_path = path
+        self.socket_timeout = timeout
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.socket_timeout is not None:
+            self.sock.settimeout(self.socket_timeout)
+        self.sock.connect(self.socket_path)
+
+
+class CUPSIPPBackend(object):
+    """
+        Talks IPP directly to cupsd over kept-alive HTTP connections instead of forking lpadmin, lpstat, lpoptions
+        and lpinfo.
+
+        It provides the information CUPSCommand otherwise parses out of the CUPS command-line tools:
+            - CUPS-Get-Printers and CUPS-Get-Default for the inventory of printers and classes.
+            - Get-Printer-Attributes with requested-attributes for the options listed by 'lpoptions -p'.
+            - The PPD of the printer (GET /printers/<name>.ppd) for the options listed by 'lpoptions -p -l'.
+            - CUPS-Get-PPDs for the driver catalog listed by 'lpinfo -l -m'.
+
+        Changes are still described as lpadmin command lines (which keeps the journal meaningful) and lpadmin() turns
+        them into CUPS-Add-Modify-Printer/Class, CUPS-Delete-Printer/Class and CUPS-Set-Default requests.
+
+        The connections go to the server of the CUPSServer given, or to the local domain socket if it exists and
+        localhost:631 otherwise. They're kept in a pool: a request takes an idle connection (or opens a new one), and
+        puts it back once the response is read. As every request holds a slot of the server, there are never more
+        connections than the server allows concurrent requests. So several threads can share one backend.
+
+        Connections are encrypted (TLS) right away with encryption=required or always. With ifrequested they're
+        only encrypted once the server asks for it (HTTP 426 Upgrade Required).
+
+        Administrative requests to the local cupsd are authenticated the same way the CUPS tools do it locally: with
+        'PeerCred' over the domain socket or with the local certificate in /run/cups/certs/0 over TCP. A remote cupsd
+        is only sent the username and password given, using Basic authentication.
+    """
+
+    IPP_VERSION = (2, 0)
+
+    # Operations
+    GET_PRINTER_ATTRIBUTES = 0x000B
+    CUPS_GET_DEFAULT = 0x4001
+    CUPS_GET_PRINTERS = 0x4002
+    CUPS_ADD_MODIFY_PRINTER = 0x4003
+    CUPS_DELETE_PRINTER = 0x4004
+    CUPS_ADD_MODIFY_CLASS = 0x4006
+    CUPS_DELETE_CLASS = 0x4007
+    CUPS_SET_DEFAULT = 0x400A
+    CUPS_GET_PPDS = 0x400C
+
+    OPERATION_NAMES = {
+        GET_PRINTER_ATTRIBUTES: 'Get-Printer-Attributes',
+        CUPS_GET_DEFAULT: 'CUPS-Get-Default',
+        CUPS_GET_PRINTERS: 'CUPS-Get-Printers',
+        CUPS_ADD_MODIFY_PRINTER: 'CUPS-Add-Modify-Printer',
+        CUPS_DELETE_PRINTER: 'CUPS-Delete-Printer',
+        CUPS_ADD_MODIFY_CLASS: 'CUPS-Add-Modify-Class',
+        CUPS_DELETE_CLASS: 'CUPS-Delete-Class',
+        CUPS_SET_DEFAULT: 'CUPS-Set-Default',
+        CUPS_GET_PPDS: 'CUPS-Get-PPDs',
+    }
+
+    # Status codes
+    STATUS_NOT_FOUND = 0x0406
+
+    # Delimiter tags
+    TAG_OPERATION = 0x01
+    TAG_PRINTER = 0x04
+    TAG_END = 0x03
+
+    # Value tags
+    TAG_INTEGER = 0x21
+    TAG_BOOLEAN = 0x22
+    TAG_ENUM = 0x23
+    TAG_BEGIN_COLLECTION = 0x34
+    TAG_TEXT_WITH_LANGUAGE = 0x35
+    TAG_NAME_WITH_LANGUAGE = 0x36
+    TAG_END_COLLECTION = 0x37
+    TAG_TEXT = 0x41
+    TAG_NAME = 0x42
+    TAG_KEYWORD = 0x44
+    TAG_URI = 0x45
+    TAG_CHARSET = 0x47
+    TAG_LANGUAGE = 0x48
+    TAG_MEMBER_NAME = 0x4A
+
+    # printer-type bit marking a class
+    PRINTER_TYPE_CLASS = 0x0001
+
+    # printer-state value of a stopped (disabled) printer
+    PRINTER_STATE_STOPPED = 5
+
+    # Attributes returned by Get-Printer-Attributes that 'lpoptions -p' lists for a printer or class, plus the ones
+    # CUPSCommand sets as mandatory options.
+    CUPS_OPTION_ATTRIBUTES = [
+        'device-uri',
+        'job-k-limit',
+        'job-page-limit',
+        'job-quota-period',
+        'member-names',
+        'printer-info',
+        'printer-is-accepting-jobs',
+        'printer-is-shared',
+        'printer-location',
+        'printer-make-and-model',
+        'printer-op-policy',
+        'printer-state',
+        'printer-type',
+    ]
+
+    # Options of 'lpadmin -o' that are printer attributes rather than PPD options, and how they are encoded.
+    LPADMIN_PRINTER_ATTRIBUTE_OPTIONS = {
+        'printer-is-shared': TAG_BOOLEAN,
+        'printer-op-policy': TAG_NAME,
+        'printer-error-policy': TAG_NAME,
+        'job-k-limit': TAG_INTEGER,
+        'job-page-limit': TAG_INTEGER,
+        'job-quota-period': TAG_INTEGER,
+    }
+
+    # PPD keywords that lpadmin writes into the PPD instead of changing a *Default<option> line.
+    PPD_SUPPLIES_KEYWORDS = ['cupsIPPSupplies', 'cupsSNMPSupplies']
+
+    DOMAIN_SOCKETS = ['/run/cups/cups.sock', '/var/run/cups/cups.sock']
+    LOCAL_CERTIFICATES = ['/run/cups/certs/0', '/var/run/cups/certs/0']
+
+    def __init__(self, module, server=None, timeout=30):
+        """
+        Assigns module vars to object. The connections themselves are only opened with the first requests.
+
+        :param module: The AnsibleModule this backend works for.
+        :param server: The CUPSServer to talk to. Default=The local cupsd
+        :param timeout: Timeout in seconds for every request. Default=30
+        """
+        self.module = module
+        self.timeout = timeout
+
+        self.server = server
+        if self.server is None:
+            self.server = CUPSServer()
+
+        self.host = self.server.host
+        if not self.host:
+            self.host = 'localhost'
+            for path in self.DOMAIN_SOCKETS:
+                if os.path.exists(path):
+                    self.host = path
+                    break
+
+        self.encrypt = self.server.encrypt()
+
+        # The idle connections of the pool
+        self.connections = []
+        self.lock = threading.Lock()
+
+        self.authorization = None
+        self.request_id = 0
+
+        self.user = self.server.username
+        if not self.user:
+            try:
+                self.user = getpass.getuser()
+            except Exception:
+                self.user = 'root'
+
+    # ---------- Transport ----------
+
+    def _connect(self):
+        """
+        Opens a new connection to cupsd.
+
+        :returns: The HTTP connection.
+        """
+        if self.host.startswith('/'):
+            return _UnixHTTPConnection(self.host, timeout=self.timeout)
+
+        if not self.encrypt:
+            return HTTPConnection(self.host, self.server.port, timeout=self.timeout)
+
+        if self.server.validate_certs:
+            context = ssl.create_default_context()
+        else:
+            context = ssl._create_unverified_context()
+
+        return HTTPSConnection(self.host, self.server.port, timeout=self.timeout, context=context)
+
+    def _checkout(self):
+        """
+        :returns: An idle connection of the pool, or a new one if there's none.
+        """
+        with self.lock:
+            if self.connections:
+                return self.connections.pop()
+
+        return self._connect()
+
+    def _checkin(self, connection):
+        """
+        Puts a connection back into the pool once its response has been read.
+        """
+        with self.lock:
+            self.connections.append(connection)
+
+    def close(self):
+        """
+        Closes all idle connections to cupsd.
+        """
+        with self.lock:
+            connections = self.connections
+            self.connections = []
+
+        for connection in connections:
+            connection.close()
+
+    def _authorization(self, challenge):
+        """
+        Builds the Authorization header to answer a challenge of cupsd with.
+
+        For the local cupsd that's what the CUPS tools use for local administration, for a remote one Basic
+        authentication with the username and password of the server.
+
+        :param challenge: The WWW-Authenticate header sent by cupsd.
+        :returns: The value of the Authorization header or None if no authentication is possible.
+        """
+        if self.server.is_remote():
+            if challenge.startswith('Basic') and self.server.username and self.server.password is not None:
+                credentials = '{0}:{1}'.format(self.server.username, self.server.password)
+                return 'Basic {0}'.format(self._to_text(base64.b64encode(self._to_bytes(credentials))))
+            return None
+
+        if challenge.startswith('PeerCred') and self.host.startswith('/'):
+            return 'PeerCred {0}'.format(self.user)
+
+        for path in self.LOCAL_CERTIFICATES:
+            try:
+                with open(path) as f:
+                    return 'Local {0}'.format(f.read().strip())
+            except (IOError, OSError):
+                continue
+
+        return None
+
+    def _http(self, method, path, body=None, content_type=None):
+        """
+        Sends a HTTP request over a connection of the pool, re-connecting once if cupsd closed it in the meantime,
+        encrypting if cupsd asks for it and authenticating if cupsd asks for it.
+
+        :returns: HTTP status and body of the response.
+        """
+        with self.server.slots:
+            for attempt in range(4):
+                headers = {'Host': 'localhost' if self.host.startswith('/') else self.host}
+                if content_type:
+                    headers['Content-Type'] = content_type
+                if self.authorization:
+                    headers['Authorization'] = self.authorization
+
+                connection = self._checkout()
+                try:
+                    connection.request(method, path, body, headers)
+                    response = connection.getresponse()
+                    data = response.read()
+                except (socket.error, ssl.SSLError, HTTPException) as e:
+                    connection.close()
+                    if attempt == 0:
+                        continue
+                    self.module.fail_json(msg="Unable to talk IPP to CUPS at '{0}': {1}".format(self.host, e))
+
+                if response.getheader('Connection', '').lower() == 'close':
+                    connection.close()
+                else:
+                    self._checkin(connection)
+
+                if response.status == 426 and not self.encrypt and self.server.encryption != 'never':
+                    self.encrypt = True
+                    self.close()
+                    continue
+
+                if response.status == 401 and not self.authorization:
+                    self.authorization = self._authorization(response.getheader('WWW-Authenticate', ''))
+                    if self.authorization:
+                        continue
+
+                return response.status, data
+
+        return response.status, data
+
+    # ---------- Encoding ----------
+
+    @staticmethod
+    def _to_bytes(value):
+        """
+        A static method to encode text as utf-8 bytes.
+        """
+        if isinstance(value, bytes):
+            return value
+        return value.encode('utf-8')
+
+    @staticmethod
+    def _to_text(value):
+        """
+        A static method to decode utf-8 bytes into text.
+        """
+        return value.decode('utf-8', 'replace')
+
+    @staticmethod
+    def _encode_attribute(tag, name, values):
+        """
+        Encodes a single attribute with one or more values.
+
+        :param tag: The value tag of the attribute.
+        :param name: Name of the attribute.
+        :param values: A value or a list of values.
+        :returns: The encoded attribute.
+        """
+        if not isinstance(values, list):
+            values = [values]
+
+        data = b''
+        for (i, value) in enumerate(values):
+            if tag in (CUPSIPPBackend.TAG_INTEGER, CUPSIPPBackend.TAG_ENUM):
+                value = struct.pack('>i', int(value))
+            elif tag == CUPSIPPBackend.TAG_BOOLEAN:
+                value = struct.pack('>B', 1 if value else 0)
+            else:
+                value = CUPSIPPBackend._to_bytes(value)
+
+            # Additional values of the same attribute have an empty name
+            name_bytes = CUPSIPPBackend._to_bytes(name) if i == 0 else b''
+            data += struct.pack('>BH', tag, len(name_bytes)) + name_bytes
+            data += struct.pack('>H', len(value)) + value
+
+        return data
+
+    def _encode_request(self, operation, attributes, printer_attributes=None):
+        """
+        Encodes an IPP request.
+
+        :param operation: The operation-id of the request.
+        :param attributes: A list of (tag, name, value(s)) tuples for the operation attributes group.
+        :param printer_attributes: An optional list of (tag, name, value(s)) tuples for the printer attributes group.
+        :returns: The encoded request.
+        """
+        with self.lock:
+            self.request_id += 1
+            request_id = self.request_id
+
+        data = struct.pack('>BBHI', self.IPP_VERSION[0], self.IPP_VERSION[1], operation, request_id)
+
+        data += struct.pack('>B', self.TAG_OPERATION)
+        data += self._encode_attribute(self.TAG_CHARSET, 'attributes-charset', 'utf-8')
+        data += self._encode_attribute(self.TAG_LANGUAGE, 'attributes-natural-language', 'en')
+        for (tag, name, values) in attributes:
+            data += self._encode_attribute(tag, name, values)
+        data += self._encode_attribute(self.TAG_NAME, 'requesting-user-name', self.user)
+
+        if printer_attributes:
+            data += struct.pack('>B', self.TAG_PRINTER)
+            for (tag, name, values) in printer_attributes:
+                data += self._encode_attribute(tag, name, values)
+
+        data += struct.pack('>B', self.TAG_END)
+
+        return data
+
+    @staticmethod
+    def _decode_response(data):
+        """
+        Decodes an IPP response.
+
+        Integers and enums are decoded as int, booleans as bool, strings as text and anything else is kept as bytes.
+        Collections are skipped.
+
+        :param data: The response body.
+        :returns: status-code and a list of (group tag, attribute hash) tuples where every attribute maps to a list of
+        its values.
+        """
+        (status,) = struct.unpack('>H', data[2:4])
+
+        groups = []
+        attributes = None
+        name = None
+        depth = 0
+        pos = 8
+        while pos < len(data):
+            tag = struct.unpack('>B', data[pos:pos + 1])[0]
+            pos += 1
+
+            if tag == CUPSIPPBackend.TAG_END:
+                break
+
+            if tag < 0x10:
+                attributes = {}
+                groups.append((tag, attributes))
+                continue
+
+            (name_length,) = struct.unpack('>H', data[pos:pos + 2])
+            pos += 2
+            new_name = CUPSIPPBackend._to_text(data[pos:pos + name_length])
+            pos += name_length
+            (value_length,) = struct.unpack('>H', data[pos:pos + 2])
+            pos += 2
+            value = data[pos:pos + value_length]
+            pos += value_length
+
+            if tag == CUPSIPPBackend.TAG_BEGIN_COLLECTION:
+                depth += 1
+                continue
+            elif tag == CUPSIPPBackend.TAG_END_COLLECTION:
+                depth -= 1
+                continue
+            elif depth or attributes is None:
+                continue
+
+            if tag in (CUPSIPPBackend.TAG_INTEGER, CUPSIPPBackend.TAG_ENUM) and value_length == 4:
+                value = struct.unpack('>i', value)[0]
+            elif tag == CUPSIPPBackend.TAG_BOOLEAN and value_length == 1:
+                value = value != b'\x00'
+            elif tag in (CUPSIPPBackend.TAG_TEXT_WITH_LANGUAGE, CUPSIPPBackend.TAG_NAME_WITH_LANGUAGE):
+                (language_length,) = struct.unpack('>H', value[0:2])
+                value = CUPSIPPBackend._to_text(value[4 + language_length:])
+            elif 0x40 <= tag <= 0x5F:
+                value = CUPSIPPBackend._to_text(value)
+            elif tag < 0x20:
+                value = None  # Out-of-band values such as 'no-value' or 'unknown'
+
+            if name_length:
+                name = new_name
+                attributes[name] = [value]
+            elif name is not None:
+                attributes[name].append(value)
+
+        return status, groups
+
+    def request(self, operation, attributes, printer_attributes=None, path='/', document=None):
+        """
+        Sends an IPP request to cupsd and decodes the response.
+
+        :param operation: The operation-id of the request.
+        :param attributes: A list of (tag, name, value(s)) tuples for the operation attributes group.
+        :param printer_attributes: An optional list of (tag, name, value(s)) tuples for the printer attributes group.
+        :param path: The resource to post the request to. Default='/'
+        :param document: Optional data (eg. a PPD file) to send after the request.
+        :returns: status-code, status-message and a list of attribute hashes of all the groups except the operation
+        attributes group.
+        """
+        body = self._encode_request(operation, attributes, printer_attributes)
+        if document:
+            body += document
+
+        (http_status, data) = self._http('POST', path, body, 'application/ipp')
+
+        if http_status != 200 or len(data) < 8:
+            return 0xFFFF, "HTTP status {0}".format(http_status), []
+
+        (status, groups) = self._decode_response(data)
+
+        message = ''
+        for (tag, attributes) in groups:
+            if tag == self.TAG_OPERATION:
+                message = (attributes.get('status-message') or [''])[0]
+
+        return status, message, [a for (tag, a) in groups if tag != self.TAG_OPERATION]
+
+    @staticmethod
+    def destination_uri(name, is_class=False):
+        """
+        A static method to build the printer-uri of a printer or class.
+
+        :returns: The ipp:// URI of the destination on the local cupsd.
+        """
+        return 'ipp://localhost/{0}/{1}'.format('classes' if is_class else 'printers', quote(CUPSIPPBackend._to_bytes(name)))
+
+    @staticmethod
+    def _uri_resource(uri):
+        """
+        A static method to get the resource of a printer-uri, eg. '/printers/Office' of
+        'ipp://localhost:631/printers/Office'.
+        """
+        (scheme, sep, rest) = uri.partition('://')
+        (host, sep, resource) = rest.partition('/')
+        return sep + resource
+
+    def _fail_on_error(self, operation, status, message):
+        """
+        Exits the module if a request meant to read information failed.
+        """
+        if status > 0xFF:
+            self.module.fail_json(msg="IPP request {0} to CUPS failed with status 0x{1:04x}: {2}"
+                                  .format(self.OPERATION_NAMES[operation], status, message))
+
+    # ---------- Reads ----------
+
+    def get_printers(self):
+        """
+        Returns all printers and classes in CUPS using CUPS-Get-Printers.
+
+        :returns: A list of attribute hashes, one per printer or class.
+        """
+        requested = ['printer-name', 'printer-type', 'printer-state', 'printer-is-accepting-jobs', 'device-uri',
+                     'member-names']
+        (status, message, printers) = self.request(self.CUPS_GET_PRINTERS,
+                                                   [(self.TAG_KEYWORD, 'requested-attributes', requested)])
+
+        if status == self.STATUS_NOT_FOUND:
+            return []
+        self._fail_on_error(self.CUPS_GET_PRINTERS, status, message)
+
+        return printers
+
+    def get_default(self):
+        """
+        Returns the name of the server default destination using CUPS-Get-Default.
+
+        :returns: Name of the default printer or class or None if there's none.
+        """
+        (status, message, groups) = self.request(self.CUPS_GET_DEFAULT,
+                                                 [(self.TAG_KEYWORD, 'requested-attributes', ['printer-name'])])
+
+        for attributes in groups:
+            if 'printer-name' in attributes:
+                return attributes['printer-name'][0]
+
+        return None
+
+    def get_printer_attributes(self, name, requested, is_class=False):
+        """
+        Returns the requested attributes of a printer or class using Get-Printer-Attributes.
+
+        :param name: Name of the printer or class.
+        :param requested: List of requested-attributes.
+        :param is_class: Whether the destination is a class.
+        :returns: The attribute hash or None if the printer or class doesn't exist.
+        """
+        (status, message, groups) = self.request(self.GET_PRINTER_ATTRIBUTES,
+                                                 [(self.TAG_URI, 'printer-uri',
+                                                   self.destination_uri(name, is_class)),
+                                                  (self.TAG_KEYWORD, 'requested-attributes', requested)])
+
+        if status == self.STATUS_NOT_FOUND:
+            return None
+        self._fail_on_error(self.GET_PRINTER_ATTRIBUTES, status, message)
+
+        return groups[0] if groups else {}
+
+    def get_cups_options(self, name, is_class=False):
+        """
+        Returns the options 'lpoptions -p <name>' lists for a printer or class.
+
+        Values are formatted the way lpoptions prints them: booleans as 'true'/'false' and multiple values joined with
+        a ','.
+
+        :param name: Name of the printer or class.
+        :param is_class: Whether the destination is a class.
+        :returns: A hash of options or an empty hash if the printer or class doesn't exist.
+        """
+        attributes = self.get_printer_attributes(name, self.CUPS_OPTION_ATTRIBUTES, is_class) or {}
+
+        options = {}
+        for (k, values) in attributes.items():
+            formatted = []
+            for v in values:
+                if isinstance(v, bool):
+                    v = 'true' if v else 'false'
+                formatted.append(u'{0}'.format(v))
+            options[k] = ','.join(formatted)
+
+        return options
+
+    def get_ppd(self, name):
+        """
+        Downloads the PPD of a printer.
+
+        :param name: Name of the printer.
+        :returns: The PPD as text or None if the printer has no PPD.
+        """
+        (status, data) = self._http('GET', '/printers/{0}.ppd'.format(quote(CUPSIPPBackend._to_bytes(name))))
+
+        if status != 200:
+            return None
+
+        return self._to_text(data)
+
+    def get_ppd_options(self, name):
+        """
+        Returns the options 'lpoptions -p <name> -l' lists for a printer, read from its PPD.
+
+        :param name: Name of the printer.
+        :returns: A hash in the same format as CUPSCommand.printer_get_specific_options.
+        """
+        ppd = self.get_ppd(name)
+
+        if ppd is None:
+            return {}
+
+        return CUPSPPD.parse_options(ppd.splitlines())
+
+    def get_drivers(self):
+        """
+        Returns the driver catalog 'lpinfo -l -m' lists using CUPS-Get-PPDs.
+
+        :returns: A hash in the same format as CUPSCommand._printer_get_installed_drivers.
+        """
+        requested = ['ppd-name', 'ppd-natural-language', 'ppd-make-and-model', 'ppd-device-id']
+        (status, message, ppds) = self.request(self.CUPS_GET_PPDS,
+                                               [(self.TAG_KEYWORD, 'requested-attributes', requested)])
+
+        if status == self.STATUS_NOT_FOUND:
+            return {}
+        self._fail_on_error(self.CUPS_GET_PPDS, status, message)
+
+        drivers = {}
+        for ppd in ppds:
+            if 'ppd-name' not in ppd:
+                continue
+
+            curr = {}
+            for (attribute, key) in (('ppd-name', 'name'), ('ppd-natural-language', 'natural_language'),
+                                     ('ppd-make-and-model', 'make-and-model'), ('ppd-device-id', 'device-id')):
+                if attribute in ppd:
+                    curr[key] = ppd[attribute][0]
+
+            drivers[curr['name']] = curr
+
+        return drivers
+
+    # ---------- Changes ----------
+
+    def _is_class(self, name):
+        """
+        :returns: True if name is an existing class.
+        """
+        attributes = self.get_printer_attributes(name, ['printer-type']) or {}
+        return bool((attributes.get('printer-type') or [0])[0] & self.PRINTER_TYPE_CLASS)
+
+    @staticmethod
+    def _rewrite_ppd(ppd, ppd_options):
+        """
+        A static method to change the defaults of a PPD the way lpadmin does for '-o option=value'.
+
+        *Default<option> lines are changed to the new value. cupsIPPSupplies and cupsSNMPSupplies are written as
+        keywords of their own and appended if the PPD doesn't contain them yet.
+
+        :param ppd: The PPD as text.
+        :param ppd_options: A hash of options to set.
+        :returns: The changed PPD as text.
+        """
+        remaining = dict(ppd_options)
+        lines = []
+
+        for line in ppd.splitlines():
+            (keyword, sep, value) = line.partition(':')
+
+            if keyword.startswith('*Default') and keyword[len('*Default'):] in remaining:
+                option = keyword[len('*Default'):]
+                line = '{0}: {1}'.format(keyword, remaining.pop(option))
+            elif keyword.lstrip('*') in CUPSIPPBackend.PPD_SUPPLIES_KEYWORDS and keyword.lstrip('*') in remaining:
+                option = keyword.lstrip('*')
+                line = '{0}: {1}'.format(keyword, 'True' if remaining.pop(option).lower() == 'true' else 'False')
+
+            lines.append(line)
+
+        for option in CUPSIPPBackend.PPD_SUPPLIES_KEYWORDS:
+            if option in remaining:
+                lines.append('*{0}: {1}'.format(option, 'True' if remaining.pop(option).lower() == 'true' else 'False'))
+
+        return '\n'.join(lines) + '\n'
+
+    def _modify(self, name, is_class, printer_attributes, document=None):
+        """
+        Sends a CUPS-Add-Modify-Printer or CUPS-Add-Modify-Class request.
+
+        :returns: status-code and status-message of the response.
+        """
+        operation = self.CUPS_ADD_MODIFY_CLASS if is_class else self.CUPS_ADD_MODIFY_PRINTER
+        (status, message, groups) = self.request(operation,
+                                                 [(self.TAG_URI, 'printer-uri', self.destination_uri(name, is_class))],
+                                                 printer_attributes, path='/admin/', document=document)
+        return status, message
+
+    def _class_member_uris(self, class_name):
+        """
+        :returns: The member-uris of a class or None if the class doesn't exist.
+        """
+        attributes = self.get_printer_attributes(class_name, ['member-uris', 'printer-type'], is_class=True)
+
+        if attributes is None or not (attributes.get('printer-type') or [0])[0] & self.PRINTER_TYPE_CLASS:
+            return None
+
+        return list(attributes.get('member-uris') or [])
+
+    def lpadmin(self, args):
+        """
+        Applies the changes described by lpadmin arguments using IPP requests.
+
+        Supported are the arguments CUPSCommand uses: -p, -x, -d, -v, -E, -m, -P, -D, -L, -o, -c and -r.
+        Options given with -o are sent as printer attributes if lpadmin would do so, everything else is written into
+        the PPD of the printer which is then uploaded with the request, just like lpadmin does it.
+
+        :param args: The lpadmin arguments (without 'lpadmin' itself).
+        :returns: rc, out, err like running lpadmin would.
+        """
+        name = None
+        printer_attributes = []
+        ppd_options = {}
+        ppd_file = None
+        actions = []
+
+        args = list(args)
+        while args:
+            arg = args.pop(0)
+
+            if arg == '-E':
+                printer_attributes.append((self.TAG_ENUM, 'printer-state', 3))
+                printer_attributes.append((self.TAG_BOOLEAN, 'printer-is-accepting-jobs', True))
+                continue
+
+            if not args:
+                return 1, '', "lpadmin: Expected an argument after '{0}'.".format(arg)
+            value = args.pop(0)
+
+            if arg == '-p':
+                name = value
+            elif arg in ('-x', '-d'):
+                actions.append((arg, value))
+            elif arg in ('-c', '-r'):
+                actions.append((arg, value))
+            elif arg == '-v':
+                printer_attributes.append((self.TAG_URI, 'device-uri', value))
+            elif arg == '-m':
+                printer_attributes.append((self.TAG_NAME, 'ppd-name', value))
+            elif arg == '-P':
+                ppd_file = value
+            elif arg == '-D':
+                printer_attributes.append((self.TAG_TEXT, 'printer-info', value))
+            elif arg == '-L':
+                printer_attributes.append((self.TAG_TEXT, 'printer-location', value))
+            elif arg == '-o':
+                (k, sep, v) = value.partition('=')
+                tag = self.LPADMIN_PRINTER_ATTRIBUTE_OPTIONS.get(k)
+                if tag == self.TAG_BOOLEAN:
+                    printer_attributes.append((tag, k, v.lower() in ('true', 'yes', 'on')))
+                elif tag:
+                    printer_attributes.append((tag, k, v))
+                else:
+                    ppd_options[k] = v
+            else:
+                return 1, '', "lpadmin: Unsupported option '{0}' for the IPP backend.".format(arg)
+
+        if name is not None and (printer_attributes or ppd_file):
+            is_class = self._is_class(name)
+            document = None
+
+            if ppd_file:
+                try:
+                    with open(ppd_file, 'rb') as f:
+                        document = f.read()
+                except (IOError, OSError) as e:
+                    return 1, '', "lpadmin: Unable to open PPD file '{0}': {1}".format(ppd_file, e)
+
+            (status, message) = self._modify(name, is_class, printer_attributes, document)
+            if status > 0xFF:
+                return 1, '', 'lpadmin: {0}'.format(message)
+
+        if name is not None and ppd_options:
+            ppd = self.get_ppd(name)
+
+            if ppd is None:
+                # Without a PPD lpadmin stores the options as printer defaults
+                attributes = [(self.TAG_TEXT, '{0}-default'.format(k), v) for (k, v) in ppd_options.items()]
+                (status, message) = self._modify(name, self._is_class(name), attributes)
+            else:
+                document = self._to_bytes(self._rewrite_ppd(ppd, ppd_options))
+                (status, message) = self._modify(name, False, [], document)
+
+            if status > 0xFF:
+                return 1, '', 'lpadmin: {0}'.format(message)
+
+        for (action, value) in actions:
+            if action == '-x':
+                is_class = self._is_class(value)
+                operation = self.CUPS_DELETE_CLASS if is_class else self.CUPS_DELETE_PRINTER
+                (status, message, groups) = self.request(operation,
+                                                         [(self.TAG_URI, 'printer-uri',
+                                                           self.destination_uri(value, is_class))],
+                                                         path='/admin/')
+            elif action == '-d':
+                (status, message, groups) = self.request(self.CUPS_SET_DEFAULT,
+                                                         [(self.TAG_URI, 'printer-uri',
+                                                           self.destination_uri(value, self._is_class(value)))],
+                                                         path='/admin/')
+            else:
+                if name is None:
+                    return 1, '', "lpadmin: Unable to add or remove a printer to/from class '{0}' without '-p'."\
+                        .format(value)
+
+                member_uris = self._class_member_uris(value)
+                member_uri = self.destination_uri(name)
+
+                # cupsd builds the member-uris from the host and port it was reached at, so only their resources
+                # can be compared with member_uri
+                matching = [uri for uri in member_uris or []
+                            if self._uri_resource(uri) == self._uri_resource(member_uri)]
+
+                if action == '-c' and matching:
+                    continue
+                elif action == '-c':
+                    member_uris = (member_uris or []) + [member_uri]
+                elif not matching:
+                    return 1, '', "lpadmin: Printer '{0}' is not a member of class '{1}'.".format(name, value)
+                else:
+                    member_uris.remove(matching[0])
+
+                if member_uris:
+                    (status, message) = self._modify(value, True, [(self.TAG_URI, 'member-uris', member_uris)])
+                else:
+                    # Like lpadmin, remove a class that's left without members
+                    (status, message, groups) = self.request(self.CUPS_DELETE_CLASS,
+                                                             [(self.TAG_URI, 'printer-uri',
+                                                               self.destination_uri(value, True))],
+                                                             path='/admin/')
+
+            if status > 0xFF:
+                return 1, '', 'lpadmin: {0}'.format(message)
+
+        return 0, '', ''
+
+
+class CUPSJournal(object):
+    """
+        A bounded, structured record of the commands run for a printer or class.
+
+        Every entry is a hash, eg:
+            'argv': ['lpadmin', '-p', 'TEST', '-L', 'Room 404']
+            'rc': 0
+            'duration': 0.012
+            'stdout': ''
+            'stderr': ''
+
+        Only the last 'limit' entries are kept, older ones are dropped and counted. stdout and stderr are cut to
+        'output_limit' characters. The cmd_history and stdout strings older versions of this module returned are only
+        rendered from it on request.
+    """
+
+    def __init__(self, limit=None, output_limit=None):
+        """
+        :param limit: The maximum number of entries to keep. None or 0 keeps all of them.
+        :param output_limit: The maximum number of characters of stdout/stderr to keep. None or 0 keeps all of it.
+        """
+        self.entries = collections.deque(maxlen=limit or None)
+        self.output_limit = output_limit
+        self.dropped = 0
+
+        # The stdout of the commands that changed something, for render_stdout()
+        self.output = collections.deque(maxlen=limit or None)
+
+    def truncate(self, text):
+        """
+        :returns: text cut to output_limit characters, noting how much was cut off.
+        """
+        if not text or not self.output_limit or len(text) <= self.output_limit:
+            return text
+
+        return "{0}... [{1} more characters]".format(text[:self.output_limit], len(text) - self.output_limit)
+
+    def add(self, argv, rc=None, duration=None, stdout=None, stderr=None):
+        """
+        Adds an entry for a command that was run.
+        """
+        if self.entries.maxlen is not None and len(self.entries) == self.entries.maxlen:
+            self.dropped += 1
+
+        self.entries.append({
+            'argv': [str(x) for x in argv],
+            'rc': rc,
+            'duration': round(duration, 3) if duration is not None else None,
+            'stdout': self.truncate(stdout),
+            'stderr': self.truncate(stderr),
+        })
+
+    def log_output(self, out):
+        """
+        Records the stdout of a command that changed something.
+        """
+        if out:
+            self.output.append(self.truncate(out))
+
+    def render_cmd_history(self):
+        """
+        :returns: All entries as a single string, one command per line followed by its return code and wall time.
+        """
+        lines = []
+        for entry in self.entries:
+            safe_cmd = ""
+            for x in entry['argv']:
+                if " " in x:
+                    if not ((x.startswith('"') and x.endswith('"')) or (x.startswith("'") and x.endswith("'"))):
+                        x = '{0}{1}{0}'.format('"', x)
+                safe_cmd = "{0}{1}{2}".format(safe_cmd, x, " ")
+            if entry['rc'] is not None:
+                safe_cmd = "{0}(rc={1}, {2:.3f}s) ".format(safe_cmd, entry['rc'], entry['duration'])
+            lines.append(safe_cmd)
+
+        return "".join("\n{0}".format(line) for line in lines)
+
+    def render_stdout(self):
+        """
+        :returns: The stdout of all commands that changed something as a single string.
+        """
+        return "".join("\n{0}".format(out) for out in self.output)
+
+    def add_to_result(self, result, legacy_output=False):
+        """
+        Adds the journal (and the legacy strings if asked for) to a module result.
+        """
+        result['journal'] = list(self.entries)
+
+        if self.dropped:
+            result['journal_dropped'] = self.dropped
+
+        if legacy_output:
+            if self.output:
+                result['stdout'] = self.render_stdout()
+            if self.entries:
+                result['cmd_history'] = self.render_cmd_history()
+
+        return result
+
+
+# ===========================================
+
+
+class CUPSTimer(object):
+    """
+        Measures the wall time spent in the phases of a module run, see PHASES.
+
+        Phases can be nested, eg. the driver lookup needed to compare a printer. The time spent in the inner phase
+        isn't counted towards the outer one, so for a single thread the phases add up to the time measured.
+
+        Several threads can share a timer, eg. the items CUPSBulkCommand processes at the same time. Every thread
+        measures its phases with a CUPSTimer of its own that has the shared one as parent. A phase of the parent counts
+        the wall time in which at least one of the threads was in it, not the sum of their times. So no phase exceeds
+        the total, but as the threads may be in different phases at the same time the phases may add up to more.
+    """
+
+    # inventory: reading the printers and classes, queries: reading the settings of all items ahead of time (see
+    # CUPSQueryEngine), driver_lookup: reading the driver catalog, comparison: reading and comparing the current
+    # settings, apply: making changes
+    PHASES = ['inventory', 'queries', 'driver_lookup', 'comparison', 'apply']
+
+    def __init__(self, parent=None):
+        """
+        :param parent: Optional CUPSTimer shared with other threads, that measures the phases of this one as well.
+        """
+        self.start = time.time()
+        self.timings = dict((phase, 0.0) for phase in self.PHASES)
+        self.parent = parent
+
+        self._stack = []
+
+        # The number of threads in every phase entered and since when at least one has been, see _enter
+        self._active = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Context manager measuring the time spent within it as phase 'name'.
+        """
+        now = time.time()
+        if self._stack:
+            self._leave(self._stack[-1], now)
+        self._stack.append(name)
+        self._enter(name, now)
+
+        try:
+            yield
+        finally:
+            now = time.time()
+            self._leave(self._stack.pop(), now)
+            if self._stack:
+                self._enter(self._stack[-1], now)
+
+    def _enter(self, name, now):
+        """
+        Records that a thread is in phase 'name' from now on.
+        """
+        with self._lock:
+            (count, since) = self._active.get(name, (0, now))
+            self._active[name] = (count + 1, since)
+
+        if self.parent is not None:
+            self.parent._enter(name, now)
+
+    def _leave(self, name, now):
+        """
+        Records that a thread isn't in phase 'name' any more. Once no thread is the time since the first one entered
+        it is added to the phase.
+        """
+        with self._lock:
+            (count, since) = self._active.pop(name)
+            if count > 1:
+                self._active[name] = (count - 1, since)
+            else:
+                self.add(name, now - since)
+
+        if self.parent is not None:
+            self.parent._leave(name, now)
+
+    def add(self, name, seconds):
+        """
+        Adds seconds to phase 'name'.
+        """
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def summary(self):
+        """
+        :returns: A hash of the seconds spent per phase plus the 'total' since this timer was created.
+        """
+        summary = dict((name, round(seconds, 3)) for (name, seconds) in self.timings.items())
+        summary['total'] = round(time.time() - self.start, 3)
+        return summary
+
+
+# ===========================================
+
+
+class CUPSChangePlan(object):
+    """
+        Collects all lpadmin changes for a single printer or class so they can be sent as one lpadmin command.
+
+        Every change makes cupsd rewrite printers.conf/classes.conf, so merging them saves both the fork and the write.
+        Every option (-o) is only sent once with the last value given for it.
+
+        Options can be added as forced. They are sent because their current value can't be read back (eg. the
+        mandatory options), not because they are known to differ. A command made up of forced options only isn't
+        counted as a change of the system.
+    """
+
+    def __init__(self, name):
+        """
+        :param name: Name of the printer or class the changes are for.
+        """
+        self.name = name
+
+        self.args = []
+        self.options = []
+        self.option_values = {}
+        self.default = False
+        self.changes = False
+
+    def add_args(self, *args):
+        """
+        Adds lpadmin arguments, eg. ('-L', 'Room 404').
+        """
+        self.args.extend(args)
+        self.changes = True
+
+    def args_value(self, arg):
+        """
+        :returns: The value given for an lpadmin argument (eg. '-v') or None if it isn't part of the plan.
+        """
+        for (i, a) in enumerate(self.args[:-1]):
+            if a == arg:
+                return self.args[i + 1]
+        return None
+
+    def set_option(self, key, value, forced=False):
+        """
+        Adds or replaces an option to be sent with -o.
+
+        :param key: Name of the option.
+        :param value: Value of the option.
+        :param forced: Whether the option is only sent because its current value isn't known.
+        """
+        if key not in self.option_values:
+            self.options.append(key)
+        self.option_values[key] = value
+
+        if not forced:
+            self.changes = True
+
+    def set_default(self):
+        """
+        Makes the printer or class the server default.
+        """
+        self.default = True
+        self.changes = True
+
+    def empty(self):
+        """
+        :returns: True if there's nothing to change.
+        """
+        return not self.args and not self.options and not self.default
+
+    def command(self):
+        """
+        :returns: The lpadmin command applying all changes of the plan.
+        """
+        cmd = ['lpadmin']
+
+        if self.args or self.options:
+            cmd.extend(['-p', self.name])
+            cmd.extend(self.args)
+
+            for k in self.options:
+                cmd.extend(['-o', '{0}={1}'.format(k, self.option_values[k])])
+
+        if self.default:
+            cmd.extend(['-d', self.name])
+
+        return cmd
+
+
+# ===========================================
+
+
+class CUPSComparison(object):
+    """
+        Compares the expected settings of a printer or class with its current ones as a list of checks that are
+        only evaluated when they're run, cheapest first.
+
+        Every check states what it has to look at, see COSTS. 'query' checks share a single lpoptions command (or IPP
+        request), so once one of them ran the others are free. A 'file' check reads a file on the host, eg. the PPD
+        of the queue. A 'driver' check may have to look the driver up in the driver catalog, i.e. run 'lpinfo -l -m'.
+
+        A setting may have several checks, cheaper ones that can only decide some cases and a dearer one that always
+        can. They are run cheapest first and stop at the first one that decides: the remaining ones are skipped
+        without being evaluated, so eg. the driver isn't looked up once the PPD of the queue shows it's the right one.
+        Checks whose expected value can't be determined are undetermined, the next check of the setting decides
+        then. If none of them can, the setting counts as matching.
+
+        Every setting is compared, as all differences have to be changed and only a different driver makes a printer
+        reinstalled, see CUPSCommand.printer_install.
+
+        Every check is reported in 'report', in the order they were run, eg:
+            {'name': 'printer-location', 'cost': 'query', 'outcome': 'mismatch'}
+        The outcome is one of 'match', 'mismatch', 'undetermined' or 'skipped'.
+    """
+
+    # What a check has to look at, cheapest first
+    COSTS = ['query', 'file', 'driver']
+
+    def __init__(self):
+        self.checks = []
+        self.report = []
+
+        # The expected values of the checks run, by name
+        self.expected = {}
+
+    def add(self, name, cost, current, expected):
+        """
+        Adds a check. Several checks may be added for the same setting, see the class description.
+
+        :param name: Name of the setting, eg. 'printer-location'.
+        :param cost: What the check has to look at, one of COSTS.
+        :param current: A function returning the current value.
+        :param expected: A function returning the expected value, None if it can't be determined.
+        """
+        self.checks.append((name, cost, current, expected))
+
+    def run(self):
+        """
+        Runs the checks, cheapest first, skipping the ones of settings that have been decided already.
+
+        :returns: A hash of the settings that differ with their expected value.
+        """
+        diff = {}
+
+        for (name, cost, current, expected) in sorted(self.checks, key=lambda c: self.COSTS.index(c[1])):
+            if name in self.expected:
+                self.report.append({'name': name, 'cost': cost, 'outcome': 'skipped'})
+                continue
+
+            expected_value = expected()
+            if expected_value is None:
+                outcome = 'undetermined'
+            elif current() != expected_value:
+                outcome = 'mismatch'
+                diff[name] = expected_value
+            else:
+                outcome = 'match'
+
+            if expected_value is not None:
+                self.expected[name] = expected_value
+
+            self.report.append({'name': name, 'cost': cost, 'outcome': outcome})
+
+        return diff
+
+    @staticmethod
+    def once(function):
+        """
+        A static method to make a function only run the first time it's called, eg. to share a query between checks.
+
+        :returns: A function returning what the first call of function returned.
+        """
+        results = []
+
+        def wrapper():
+            if not results:
+                results.append(function())
+            return results[0]
+
+        return wrapper
+
+
+# ===========================================
+
+
+class CUPSQueryEngine(object):
+    """
+        Runs read-only CUPS commands ahead of time, several at once.
+
+        The settings of the printers and classes are read with one lpoptions command each. These don't depend on each
+        other and cupsd serves many readers at the same time, so CUPSBulkCommand has them all run up front by this
+        engine, at most 'concurrency' at a time. The CUPSCommand objects of the items then take the output of their
+        commands from here instead of running them, see CUPSCommand.process_query_command. Every result is handed
+        out only once, so a command that has to be run again later (eg. after a change) is really run again.
+
+        Every command may run for 'timeout' seconds before it's killed. As Ansible's run_command doesn't support a
+        timeout, the commands are run with subprocess directly, in the same environment.
+    """
+
+    def __init__(self, concurrency, timeout=None, server=None):
+        """
+        :param concurrency: The maximum number of commands run at the same time.
+        :param timeout: Optional number of seconds a command may run for. Default=No timeout
+        :param server: The CUPSServer the commands are run against. Default=The local cupsd
+        """
+        self.concurrency = concurrency
+        self.timeout = timeout or None
+
+        self.server = server
+        if self.server is None:
+            self.server = CUPSServer()
+
+        # The return code, command output, error output, wall time and whether it timed out of every command run,
+        # by command
+        self.results = {}
+
+        self.lock = threading.Lock()
+
+    def _run_one(self, cmd):
+        """
+        Runs a single command, killing it once it runs for longer than self.timeout.
+
+        :returns: The return code, command output, error output, wall time and whether the command timed out.
+        """
+        with self.server.slots:
+            return self._run_one_slotted(cmd)
+
+    def _run_one_slotted(self, cmd):
+        """
+        Runs a single command while holding a slot of the server, see _run_one.
+        """
+        start = time.time()
+        state = {'timed_out': False}
+
+        try:
+            process = subprocess.Popen(self.server.command(cmd), stdin=open(os.devnull), stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE, close_fds=True, universal_newlines=True)
+        except (IOError, OSError) as e:
+            return 1, '', str(e), time.time() - start, False
+
+        def kill():
+            state['timed_out'] = True
+            try:
+                process.kill()
+            except OSError:
+                pass
+
+        timer = None
+        if self.timeout is not None:
+            timer = threading.Timer(self.timeout, kill)
+            timer.start()
+
+        try:
+            (out, err) = process.communicate()
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+        return process.returncode, out, err, time.time() - start, state['timed_out']
+
+    def run(self, cmds):
+        """
+        Runs a list of commands using a pool of at most self.concurrency threads and keeps their results.
+
+        :param cmds: A list of commands to run.
+        """
+        pending = [list(cmd) for cmd in cmds]
+
+        def run_pending():
+            while True:
+                with self.lock:
+                    if not pending:
+                        return
+                    cmd = pending.pop(0)
+
+                result = self._run_one(cmd)
+
+                with self.lock:
+                    self.results[tuple(cmd)] = result
+
+        workers = max(1, min(self.concurrency, len(pending)))
+        if workers == 1:
+            run_pending()
+        else:
+            threads = [threading.Thread(target=run_pending) for i in range(workers)]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+    def pop(self, cmd):
+        """
+        Hands out the result of a command run ahead of time, once.
+
+        :param cmd: The command.
+        :returns: The return code, command output, error output, wall time and whether the command timed out. None if
+        the command wasn't run (or its result was handed out already).
+        """
+        with self.lock:
+            return self.results.pop(tuple(cmd), None)
+
+    @staticmethod
+    def from_module(module):
+        """
+        A static method to create the query engine defined by the module parameters.
+
+        :returns: A CUPSQueryEngine or None if queries aren't run ahead of time, see query_concurrency.
+        """
+        if module.params['query_concurrency'] <= 0 or module.params['backend'] == 'ipp' or \
+                module.params['config_dir']:
+            return None
+
+        return CUPSQueryEngine(module.params['query_concurrency'], module.params['query_timeout'],
+                               server=CUPSServer.from_module(module))
+
+
+# ===========================================
+
+
+class CUPSCommand(object):
+    """
+        This is the main class that directly deals with the lpadmin command.
+
+        Method naming methodology:
+            - Methods prefixed with 'cups_item' or '_cups_item' can be used with both printer and classes.
+            - Methods prefixed with 'class' or '_class' are meant to work with classes only.
+            - Methods prefixed with 'printer' or '_printer' are meant to work with printers only.
+
+        CUPSCommand handles printers like so:
+            - If state=absent:
+                - Printer exists: Deletes printer
+                - Printer doesn't exist: Does nothing and exits
+            - If state=present:
+                - Printer exists: Checks printer options and compares them to the ones stated:
+                    - Make and model (driver) is different: Deletes the printer and installs it again with stated
+                      options.
+                    - Other options are different: Changes only those options on the existing printer.
+                    - Options are same: Does nothing and exits.
+                - Printer doesn't exist: Installs printer with stated options.
+            - Mandatory options are set every time if the right variables are defined. They are:
+                - cupsIPPSupplies
+                - cupsSNMPSupplies
+                - printer-op-policy
+                - job-k-limit
+                - job-page-limit
+                - job-quota-period
+
+        CUPSCommand handles classes like so:
+            - If state=absent:
+                - Class exists: Deletes class
+                - Class doesn't exist: Does nothing and exits
+            - If state=present:
+                - Class exists: Checks class options and members and compares them to the ones stated:
+                    - Info or location are different: Changes only those options on the existing class.
+                    - Members are different: Adds the missing printers and removes the superfluous ones.
+                    - Options and members are same: Does nothing and exits.
+                - Class doesn't exist: Installs class with stated options and members.
+            - Mandatory options are set every time if the right variables are defined. They are:
+                - cupsIPPSupplies
+                - cupsSNMPSupplies
+                - printer-op-policy
+            - Notes about how classes are handled:
+                - Members stated will be the final list of printers in that class.
+                - The class is never recreated to change its members, so it stays available to users throughout.
+
+        In check mode every comparison is run as usual but no change command is. Each one is added to 'plan'
+        instead and the inventory is updated as if it had been run, so the later steps (eg. adding a new printer to a
+        class) are planned as they would be run. The settings that change are collected in 'diff' either way.
+    """
+
+    def __init__(self, module, params=None, driver_cache=None, inventory=None, ipp=None, config=None,
+                 state_store=None, queries=None, timer=None):
+        """
+        Assigns module vars to object.
+
+        :param module: The AnsibleModule this object works for.
+        :param params: Optional hash of parameters to use instead of module.params. Used by CUPSBulkCommand to run
+        one CUPSCommand per printer/class item while sharing a single module.
+        :param driver_cache: Optional CUPSDriverCache to share between several CUPSCommand objects.
+        :param inventory: Optional CUPSInventory to share between several CUPSCommand objects.
+        :param ipp: Optional CUPSIPPBackend to share between several CUPSCommand objects. Only used if backend=ipp.
+        :param config: Optional CUPSConfigReader to share between several CUPSCommand objects. Only used if
+        config_dir is defined.
+        :param state_store: Optional CUPSStateStore to skip a converged printer or class with. CUPSBulkCommand
+        consults its own store before running an item instead, so it's only created here for a single printer or class.
+        :param queries: Optional CUPSQueryEngine holding the output of read-only commands run ahead of time.
+        :param timer: Optional CUPSTimer shared by several CUPSCommand objects, that measures the phases of this one as
+        well, see CUPSTimer.
+        """
+        self.module = module
+
+        self.state_store = state_store
+
+        # Set while verifying a pending printer or class, see CUPSStateStore
+        self.skip_forced_options = False
+
+        if params is None:
+            params = module.params
+        self.params = params
+
+        self.driver = CUPSCommand.strip_whitespace(params['driver'])
+        self.name = CUPSCommand.strip_whitespace(params['name'])
+        self.printer_or_class = params['printer_or_class']
+
+        self.state = params['state']
+        self.purge = params['purge']
+
+        self.remove = module.params['remove']
+        self.exclude = module.params['exclude'] or []
+        self.workers = module.params['workers']
+
+        self.uri = CUPSCommand.strip_whitespace(params['uri'])
+
+        self.enabled = params['enabled']
+        self.shared = params['shared']
+        self.default = params['default']
+
+        self.model = CUPSCommand.strip_whitespace(params['model'])
+        self.make_and_model = CUPSCommand.strip_whitespace(params['make_and_model'])
+        self.device_id = CUPSCommand.strip_whitespace(params['device_id'])
+
+        self.info = CUPSCommand.strip_whitespace(params['info'])
+        self.location = CUPSCommand.strip_whitespace(params['location'])
+
+        self.options = params['options']
+
+        self.assign_cups_policy = CUPSCommand.strip_whitespace(params['assign_cups_policy'])
+
+        self.class_members = params['class_members']
+
+        self.report_ipp_supply_levels = params['report_ipp_supply_levels']
+        self.report_snmp_supply_levels = params['report_snmp_supply_levels']
+        self.job_kb_limit = params['job_kb_limit']
+        self.job_quota_limit = params['job_quota_limit']
+        self.job_page_limit = params['job_page_limit']
+
+        self.journal = CUPSJournal(limit=module.params['journal_limit'],
+                                   output_limit=module.params['journal_output_limit'])
+        self.changed = False
+
+        self.timer = CUPSTimer(parent=timer)
+
+        self.cups_current_options = {}
+        self.cups_expected_options = {}
+        self.cups_checks = []
+        self.class_current_members = []
+        self.printer_current_options = {}
+        self.printer_options_read = False
+
+        self.plan = []
+        self.diff = {'before': {}, 'after': {}}
+
+        self.check_mode = module.check_mode
+
+        self.server = CUPSServer.from_module(module)
+
+        # The stored driver catalog is fingerprinted with the local driver directories, see CUPSDriverCache
+        driver_cache_path = None if self.server.is_remote() else module.params['driver_cache']
+
+        self.driver_cache = driver_cache
+        if self.driver_cache is None:
+            self.driver_cache = CUPSDriverCache(module, driver_cache_path)
+
+        if self.state_store is None and params is module.params:
+            self.state_store = CUPSStateStore.from_module(module, self.driver_cache)
+
+        self.inventory = inventory
+        if self.inventory is None:
+            self.inventory = CUPSInventory()
+
+        self.ipp = ipp
+        if self.ipp is None and module.params['backend'] == 'ipp':
+            self.ipp = CUPSIPPBackend(module, server=self.server)
+
+        self.config = config
+        if self.config is None and module.params['config_dir']:
+            self.config = CUPSConfigReader(module, module.params['config_dir'])
+
+        self.queries = queries
+
+        self.check_settings()
+
+    def check_settings(self):
+        """
+        Checks the values provided to the module and see if there are any missing/illegal settings.
+
+        Module fails and exits if it encounters an illegal combination of variables sent to the module.
+        :returns: None
+        """
+        msgs = []
+
+        if self.state == 'printer':
+            if not self.printer_or_class:
+                msgs.append("When state=present printer or class must be defined.")
+
+            if self.printer_or_class == 'printer':
+                if not self.uri and not self.exists_self():
+                    msgs.append("URI is required to install printer.")
+
+            if self.printer_or_class == 'class':
+                if not self.class_members and not self.exists_self():
+                    self.module.fail_json(msg="Empty class cannot be created.")
+
+        if msgs:
+            "\n".join(msgs)
+            self.module.fail_json(msg=msgs)
+
+    @staticmethod
+    def strip_whitespace(text):
+        """
+        A static method to help with stripping white space around object variables.
+
+        :returns: Trailing whitespace removed text or 'None' if input is 'None'.
+        """
+        try:
+            return text.strip()
+        except:
+            return None
+
+    def append_cmd_out(self, cmd_out):
+        """
+        Records the out text from the command that was just run in the journal.
+
+        :param cmd_out: The text that was outputted during last command that was run.
+        :returns: None
+        """
+        self.journal.log_output(cmd_out)
+
+    def append_cmd_history(self, cmd, rc=None, duration=None, out=None, err=None):
+        """
+        Records a command that was run in the journal.
+
+        :param cmd: The command to be recorded.
+        :param rc: The return code of the command, if it was run.
+        :param duration: The wall time it took to run the command in seconds, if it was run.
+        :param out: The output text of the command.
+        :param err: The error text of the command.
+        :returns: None
+        """
+        self.journal.add(cmd, rc=rc, duration=duration, stdout=out, stderr=err)
+
+    def add_journal_to_result(self, result):
+        """
+        Adds the journal of this object to a module result, see CUPSJournal.add_to_result.
+
+        :returns: The result.
+        """
+        return self.journal.add_to_result(result, legacy_output=self.module.params['legacy_output'])
+
+    def plan_command(self, cmd, changes=True, destination=None):
+        """
+        Adds a change command to the plan returned in check mode.
+
+        :param cmd: The command that is (or would be) run.
+        :param changes: False if the command only re-sends settings that can't be compared, see CUPSChangePlan.
+        :param destination: The printer or class the command is for. Default=the one defined in this class.
+        """
+        self.plan.append({
+            'name': destination or self.name,
+            'argv': [str(x) for x in cmd],
+            'changes': changes,
+        })
+
+    def record_diff(self, key, before, after, section=None):
+        """
+        Records a setting of the printer or class that is (or would be) changed, for the diff returned.
+
+        :param key: The name of the setting.
+        :param before: Its current value. None if it isn't set or known.
+        :param after: The value it is changed to.
+        :param section: Optional name of the hash the setting is recorded in, eg. 'options' for the driver options.
+        """
+        for (side, value) in (('before', before), ('after', after)):
+            target = self.diff[side]
+            if section is not None:
+                target = target.setdefault(section, {})
+            target[key] = value
+
+    def add_changes_to_result(self, result):
+        """
+        Adds the diff of the printer or class and, in check mode, the plan to a module result.
+
+        :returns: The result.
+        """
+        if self.diff['before'] or self.diff['after']:
+            result['diff'] = self.diff
+
+        if self.check_mode:
+            result['plan'] = list(self.plan)
+
+        return result
+
+    def _log_results(self, out):
+        """
+        Method to log the details outputted from the command that was just run.
+
+        :param out: Output text from the command that was just run.
+        :returns: None
+        """
+        self.append_cmd_out(out)
+
+    def process_info_command(self, cmd):
+        """
+        Runs a command that's meant to poll information only.
+
+        Wraps around _process_command and ensures command output isn't logged as we're just fetching for information.
+
+        :param cmd: The command to run.
+        :returns: The output of _process_command which is return code, command output and error output.
+        """
+        return self._process_command(cmd, log=False)
+
+    def process_query_command(self, cmd):
+        """
+        Runs a read-only command, unless the query engine ran it ahead of time already. Its output is taken from there
+        then, see CUPSQueryEngine.
+
+        Module fails and exits if the command was killed by the query engine for running too long.
+
+        :param cmd: The command to run.
+        :returns: Return code, command output and error output of the command.
+        """
+        result = self.queries.pop(cmd) if self.queries is not None else None
+        if result is None:
+            return self.process_info_command(cmd)
+
+        (rc, out, err, duration, timed_out) = result
+        self.append_cmd_history(cmd, rc=rc, duration=duration, out=out, err=err)
+
+        if timed_out:
+            self.module.fail_json(msg="Command '{0}' didn't finish within {1} seconds."
+                                  .format(" ".join(cmd), self.queries.timeout))
+
+        return rc, out, err
+
+    def process_change_command(self, cmd, err_msg, only_log_on_error=False):
+        """
+        Runs a command that's meant to change CUPS state/settings.
+
+        Wraps around _process_command and ensures command output is logged as we're making changes to the system.
+        An optional only_log_on_error is provided for the install_mandatory_options methods that are always run
+        almost always and need not pollute the changed/output text with its information. This'll ensure the output
+        and error text is only recorded when there's an error (err != None) and (rc != 0).
+
+        It also is an easy way to centralize change command therefore making support_check_mode easier to implement.
+        In check mode the command is only added to the plan and treated as if it succeeded.
+
+        :param cmd: The command to run.
+        :param err_msg: The error message with which to exit the module if an error occurred.
+        :param only_log_on_error: The optional flag to record output if there's an error. Default=False
+        :returns: The output of _process_command which is return code, command output and error output.
+        """
+        self.plan_command(cmd, changes=not only_log_on_error)
+
+        if self.check_mode:
+            if not only_log_on_error:
+                self.changed = True
+            return 0, "", ""
+
+        with self.timer.phase('apply'):
+            (rc, out, err) = self._process_command(cmd, log=False)
+
+        if rc != 0 and err:
+            self.module.fail_json(msg="Error Message - {0}. Command Error Output - {1}.".format(err_msg, err))
+
+        if not only_log_on_error:
+            self._log_results(out)
+            self.changed = True
+
+        return rc, out, err
+
+    def _process_command(self, cmd, log=True):
+        """
+        Runs a command given to it. Also logs the details if specified.
+
+        :param cmd: The command to run.
+        :param log: Boolean to specify if the command output should be logged. Default=True
+        :returns: Return code, command output and error output of the command that was run.
+        """
+        start = time.time()
+
+        if self.ipp is not None and cmd[0] == 'lpadmin':
+            (rc, out, err) = self.ipp.lpadmin(cmd[1:])
+        else:
+            with self.server.slots:
+                (rc, out, err) = self.module.run_command(self.server.command(cmd))
+
+        self.append_cmd_history(cmd, rc=rc, duration=time.time() - start, out=out, err=err)
+
+        if log:
+            self._log_results(out)
+
+        return rc, out, err
+
+    def process_ipp_request(self, description, method, *args):
+        """
+        Runs a read-only request of the IPP backend and records it in the command history.
+
+        :param description: The IPP operation (and destination) to record in the command history.
+        :param method: The CUPSIPPBackend method to call.
+        :param args: The arguments to pass to the method.
+        :returns: What the method returned.
+        """
+        start = time.time()
+        result = method(*args)
+        self.append_cmd_history(['ipp'] + description, rc=0, duration=time.time() - start)
+
+        return result
+
+    def _printer_get_installed_drivers(self):
+        """
+        Parses the output of lpinfo -l -m to provide a list of available drivers on machine.
+
+        Example output from lpinfo -l -m:
+        Model:  name = gutenprint.5.2://xerox-wc_m118/expert
                 natural_language = en
                 make-and-model = Xerox WorkCentre M118 - CUPS+Gutenprint v5.2.11
                 device-id = MFG:XEROX;MDL:WorkCentre M118;DES:XEROX WorkCentre M118;
@@ -516,35 +3836,235 @@ class CUPSCommand(object):
                                                  'make-and-model': 'Xerox WorkCentre M118 - CUPS+Gutenprint v5.2.11'
                                                  'device-id': 'MFG:XEROX;MDL:WorkCentre M118;DES:XEROX WorkCentre M118;'
 
+        The result is stored in self.driver_cache and lpinfo is only run again when the installed drivers change.
+        Concurrent CUPSCommand objects sharing the cache wait for the first one to fetch the drivers.
+
+        :returns: Hash defining all the drivers installed on the system.
+        """
+        with self.timer.phase('driver_lookup'), self.driver_cache.lock:
+            index = self.driver_cache.load()
+            if index is None:
+                return self._printer_fetch_installed_drivers()
+
+        return index.drivers()
+
+    def _printer_fetch_installed_drivers(self):
+        """
+        Fetches the drivers installed on the system, see _printer_get_installed_drivers.
+
         :returns: Hash defining all the drivers installed on the system.
         """
+        if self.ipp is not None:
+            drivers = self.process_ipp_request(['CUPS-Get-PPDs'], self.ipp.get_drivers)
+            self.driver_cache.save(drivers)
+            return drivers
+
+        (rc, drivers) = self._printer_read_drivers(['lpinfo', '-l', '-m'])
+
+        if rc == 0:
+            self.driver_cache.save(drivers)
+
+        return drivers
+
+    def _printer_get_driver(self, name):
+        """
+        Returns a single driver installed on the system.
+
+        The driver catalog is used if it's cached already or if it can be cached for later runs (i.e. driver_cache is
+        defined or backend=ipp). Otherwise only this driver is looked up with lpinfo, see _printer_lookup_driver.
+
+        :param name: The name of the driver, eg. 'drv:///sample.drv/laserjet.ppd'.
+        :returns: The hash describing the driver like _printer_get_installed_drivers does or None if it isn't installed.
+        """
+        with self.timer.phase('driver_lookup'), self.driver_cache.lock:
+            index = self.driver_cache.load()
+            if index is None and (self.driver_cache.path or self.ipp is not None):
+                self._printer_fetch_installed_drivers()
+                index = self.driver_cache.load()
+
+            if index is not None:
+                return index.get(name)
+
+            if name not in self.driver_cache.lookups:
+                self.driver_cache.lookups[name] = self._printer_lookup_driver(name)
+
+            return self.driver_cache.lookups[name]
+
+    def _printer_find_driver(self, make_and_model=None, device_id=None):
+        """
+        Finds the driver with the given make-and-model or device ID in the driver catalog, see CUPSDriverIndex.
+
+        The catalog is read with lpinfo (and cached, see CUPSDriverCache) unless a valid one is cached already.
+
+        :param make_and_model: The make-and-model of the driver, eg. 'HP LaserJet 4250 Postscript (recommended)'.
+        :param device_id: The IEEE-1284 device ID of the printer, eg. 'MFG:HP;MDL:LaserJet 4250;'.
+        :returns: A list of the hashes describing the matching drivers, ordered by name.
+        """
+        with self.timer.phase('driver_lookup'), self.driver_cache.lock:
+            index = self.driver_cache.load()
+            if index is None:
+                self._printer_fetch_installed_drivers()
+                index = self.driver_cache.load()
+
+            if index is None:
+                return []
+
+            if make_and_model:
+                return index.find_make_and_model(make_and_model)
+
+            return index.find_device_id(device_id)
+
+    def _printer_resolve_model(self):
+        """
+        Sets model to the name of the driver matching make_and_model or device_id, if model isn't defined.
+
+        Module fails and exits if no installed driver matches.
+
+        :returns: None
+        """
+        if self.driver != 'model' or self.model or not (self.make_and_model or self.device_id):
+            return
+
+        drivers = self._printer_find_driver(make_and_model=self.make_and_model, device_id=self.device_id)
+
+        if not drivers:
+            self.module.fail_json(msg="No installed driver matches {0} '{1}' of printer '{2}'.".format(
+                'make_and_model' if self.make_and_model else 'device_id', self.make_and_model or self.device_id,
+                self.name))
+
+        self.model = drivers[0]['name']
+
+    def _printer_lookup_driver(self, name):
+        """
+        Looks up a single driver with lpinfo without reading the whole driver catalog.
+
+        If name has a scheme (eg. 'drv:///...' or 'gutenprint.5.2://...') lpinfo is asked for drivers of that scheme
+        only (--include-schemes). Its output is parsed while it's read and lpinfo is stopped as soon as the driver has
+        been found.
+
+        :param name: The name of the driver.
+        :returns: The hash describing the driver like _printer_get_installed_drivers does or None if it isn't installed.
+        """
         cmd = ['lpinfo', '-l', '-m']
-        (rc, out, err) = self.process_info_command(cmd)
+        if '://' in name:
+            cmd.extend(['--include-schemes', name.split('://', 1)[0]])
+
+        (rc, drivers) = self._printer_read_drivers(cmd, name=name)
 
-        # We want to split on sections starting with "Model:" as that specifies a new available driver
-        prog = re.compile("^Model:", re.MULTILINE)
-        cups_drivers = re.split(prog, out)
+        return drivers.get(name)
 
+    def _printer_read_drivers(self, cmd, name=None):
+        """
+        Runs lpinfo -l -m and parses its output line by line while it's read, eg:
+        Model:  name = gutenprint.5.2://xerox-wc_m118/expert
+                natural_language = en
+                make-and-model = Xerox WorkCentre M118 - CUPS+Gutenprint v5.2.11
+                device-id = MFG:XEROX;MDL:WorkCentre M118;DES:XEROX WorkCentre M118;
+
+        :param cmd: The lpinfo command to run.
+        :param name: Optional name of the only driver wanted. lpinfo is stopped as soon as it has been read and no
+        other drivers are kept.
+        :returns: The return code of lpinfo and a hash of the drivers read, see _printer_get_installed_drivers.
+        """
         drivers = {}
-        for d in cups_drivers:
+        driver = None
+        found = False
 
-            # Skip if the line contains only whitespace
-            if not d.strip():
-                continue
+        start = time.time()
+        self.server.slots.acquire()
+        devnull = open(os.devnull, 'w')
+        try:
+            process = subprocess.Popen(self.server.command(cmd), stdout=subprocess.PIPE, stderr=devnull,
+                                       universal_newlines=True, env=dict(os.environ, LANG='C', LC_ALL='C'))
+        except (IOError, OSError) as e:
+            devnull.close()
+            self.server.slots.release()
+            self.module.fail_json(msg="Failed to run '{0}': {1}".format(' '.join(cmd), e))
 
-            curr = {}
-            for l in d.splitlines():
-                kv = l.split('=', 1)
+        try:
+            for line in iter(process.stdout.readline, ''):
+                # Every driver starts with a "Model:" line
+                if line.startswith('Model:'):
+                    if name is not None and name in drivers:
+                        found = True
+                        break
+
+                    driver = {}
+                    line = line[len('Model:'):]
+
+                (key, sep, value) = line.partition('=')
+                if driver is None or not sep:
+                    continue
 
                 # Strip out any excess whitespace from the key/value
-                kv = tuple(map(str.strip, kv))
+                driver[key.strip()] = value.strip()
 
-                curr[kv[0]] = kv[1]
+                # Store drivers by their 'name' (i.e. path to driver file)
+                if key.strip() == 'name' and (name is None or value.strip() == name):
+                    drivers[value.strip()] = driver
+        finally:
+            process.stdout.close()
+            devnull.close()
 
-            # Store drivers by their 'name' (i.e. path to driver file)
-            drivers[curr['name']] = curr
+            if found:
+                process.terminate()
+            rc = process.wait()
+            self.server.slots.release()
 
-        return drivers
+        if found:
+            rc = 0
+
+        self.append_cmd_history(cmd, rc=rc, duration=time.time() - start)
+
+        return rc, drivers
+
+    def cups_get_inventory(self):
+        """
+        Returns the inventory of all printers and classes in CUPS.
+
+        The inventory is read with a single lpstat command the first time it's needed and kept up to date as changes
+        are applied, so all further existence and membership checks don't need to query CUPS again.
+
+        :returns: The CUPSInventory of this object.
+        """
+        if self.inventory.loaded():
+            return self.inventory
+
+        with self.timer.phase('inventory'):
+            if not self.inventory.loaded() and self.config is not None:
+                destinations = self.cups_get_config()
+                self.inventory.parse_config(destinations, self.config.default)
+
+            if not self.inventory.loaded() and self.ipp is not None:
+                printers = self.process_ipp_request(['CUPS-Get-Printers'], self.ipp.get_printers)
+                default = self.process_ipp_request(['CUPS-Get-Default'], self.ipp.get_default)
+                self.inventory.parse_ipp_printers(printers, default)
+
+            if not self.inventory.loaded():
+                cmd = ['lpstat', '-v', '-a', '-c', '-p', '-d']
+                (rc, out, err) = self.process_info_command(cmd)
+
+                # lpstat returns an error if there are no printers or classes at all, which is a valid (empty) inventory
+                if rc != 0 and not out.strip() and err and 'No destinations' not in err:
+                    self.module.fail_json(msg="Error occurred while trying to read the CUPS inventory: {0}".format(err))
+
+                self.inventory.parse_lpstat(out)
+
+        return self.inventory
+
+    def cups_get_config(self):
+        """
+        Returns the printers and classes read out of the CUPS configuration files, see CUPSConfigReader.
+
+        The files are read only once and the reads are recorded in the command history.
+
+        :returns: The hash of destinations of the CUPSConfigReader of this object.
+        """
+        if self.config.destinations is None:
+            for path in self.config.files():
+                self.append_cmd_history(['read', path])
+
+        return self.config.load()
 
     def _printer_get_all_printers(self):
         """
@@ -552,215 +4072,404 @@ class CUPSCommand(object):
 
         :returns: list of printer or classes names.
         """
-        cmd = ['lpstat', '-a']
-        (rc, out, err) = self.process_info_command(cmd)
-        all_printers = []
+        return self.cups_get_inventory().names()
 
-        if rc == 0:
-            # Match only 1st column, where placed printer name
-            all_printers = [line.split()[0] for line in out.splitlines()]
+    def cups_purge_all_items(self):
+        """
+        Purge all printers and classes installed on CUPS, except the ones matching exclude.
 
-        return all_printers
+        :returns: A list of the printers and classes removed.
+        """
+        return self.cups_remove_items(self.cups_select_items(['*']))
 
-    def cups_purge_all_items(self):
+    @staticmethod
+    def cups_item_matches(name, selector):
+        """
+        Checks if a printer or class name matches a selector.
+
+        :param name: The name of the printer or class.
+        :param selector: A name, a glob pattern or a regular expression prefixed with 're:'.
+        :returns: True if the name matches the selector.
+        """
+        if selector.startswith('re:'):
+            return re.match('(?:{0})$'.format(selector[3:]), name) is not None
+
+        return name == selector or fnmatch.fnmatchcase(name, selector)
+
+    def cups_select_items(self, selectors):
+        """
+        Selects the printers and classes matching any of the selectors but none of the ones in exclude.
+
+        The current printers and classes are taken from the inventory, so selecting doesn't query CUPS for every
+        selector or name.
+
+        :param selectors: A list of names, glob patterns or regular expressions prefixed with 're:'.
+        :returns: The sorted list of matching printers and classes.
+        """
+        for selector in list(selectors) + list(self.exclude):
+            if selector.startswith('re:'):
+                try:
+                    re.compile(selector[3:])
+                except re.error as e:
+                    self.module.fail_json(msg="Invalid regular expression '{0}': {1}.".format(selector, e))
+
+        selected = []
+        for name in self.cups_get_inventory().names():
+            if not any(self.cups_item_matches(name, selector) for selector in selectors):
+                continue
+            if any(self.cups_item_matches(name, selector) for selector in self.exclude):
+                continue
+            selected.append(name)
+
+        return selected
+
+    def cups_remove_items(self, items):
+        """
+        Removes a list of printers and classes, running up to self.workers lpadmin commands at the same time.
+
+        Classes are removed first, as CUPS removes a class on its own when its last member is removed and a later
+        'lpadmin -x' of that class would fail. The items are known to exist as they were just selected from the
+        inventory, so they aren't checked again one by one.
+
+        All commands are run even if some of them fail. The module fails with the errors of all failed commands at the
+        end.
+
+        :param items: A list of printer and class names that exist.
+        :returns: A list of the printers and classes removed.
+        """
+        inventory = self.cups_get_inventory()
+
+        classes = [item for item in items if inventory.is_class(item)]
+        printers = [item for item in items if not inventory.is_class(item)]
+
+        for item in classes + printers:
+            self.plan_command(['lpadmin', '-x', item], destination=item)
+
+        if self.check_mode:
+            if items:
+                self.changed = True
+            for item in classes + printers:
+                inventory.remove(item)
+            return classes + printers
+
+        removed = []
+        errors = []
+        for batch in (classes, printers):
+            cmds = [['lpadmin', '-x', item] for item in batch]
+
+            with self.timer.phase('apply'):
+                results = self._process_commands_parallel(cmds)
+
+            for (item, cmd, (rc, out, err, duration)) in zip(batch, cmds, results):
+                self.append_cmd_history(cmd, rc=rc, duration=duration, out=out, err=err)
+
+                if rc != 0 and err:
+                    errors.append("Uninstalling CUPS Item '{0}' failed. Command Error Output - {1}.".format(item, err))
+                    continue
+
+                self._log_results(out)
+                self.changed = True
+                inventory.remove(item)
+                removed.append(item)
+
+        if errors:
+            self.module.fail_json(**self.add_journal_to_result({'msg': "Error Message - {0}".format(" ".join(errors)),
+                                                                'removed': removed}))
+
+        return removed
+
+    def _process_commands_parallel(self, cmds):
         """
-        Purge all printers and classes installed on CUPS.
+        Runs a list of commands using a pool of at most self.workers threads.
+
+        Nothing is logged and the module isn't failed here, that's left to the caller once all commands are done.
+        No more commands than the server allows are sent to it at the same time, see CUPSServer.
+
+        :param cmds: A list of commands to run.
+        :returns: A list of the return code, command output, error output and wall time of every command, in the same
+        order.
         """
-        all_printers = self._printer_get_all_printers()
+        results = [None] * len(cmds)
+        pending = list(enumerate(cmds))
+        lock = threading.Lock()
+
+        def run_pending():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    (i, cmd) = pending.pop(0)
+
+                start = time.time()
+                try:
+                    if self.ipp is not None and cmd[0] == 'lpadmin':
+                        (rc, out, err) = self.ipp.lpadmin(cmd[1:])
+                    else:
+                        with self.server.slots:
+                            (rc, out, err) = self.module.run_command(self.server.command(cmd))
+                except Exception as e:
+                    (rc, out, err) = (1, '', str(e))
+                results[i] = (rc, out, err, time.time() - start)
+
+        workers = max(1, min(self.workers, len(cmds)))
+        if workers == 1:
+            run_pending()
+        else:
+            threads = [threading.Thread(target=run_pending) for i in range(workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
 
-        for printer in all_printers:
-            self.cups_item_uninstall(item_to_uninstall=printer)
+        return results
 
     def _printer_get_make_and_model(self):
         """
         Method to return the make and model of the driver/printer that is supplied to the object.
 
-        If ppd is provided, ignore this as the ppd provided takes priority over finding a driver.
+        If ppd is provided, the NickName of the PPD file is used as that's what CUPS reports as its make and model.
 
         If not ppd is provided (default behaviour), the model specified is used.
-        It checks to see if the model specified is in the list of drivers installed on the system. If not, the whole
-        module fails out with an error message.
+        It checks to see if the model specified is in the list of drivers installed on the system (see
+        _printer_get_driver). If not, the whole module fails out with an error message.
 
         :returns: make-and-model of the model specified.
         """
+        self._printer_resolve_model()
+
         if self.driver == 'model':
             # Raw printer is defined
             if not self.model or self.model == 'raw':
                 return "Remote Printer"
         elif self.driver == 'ppd':
-            return
+            return CUPSPPD.get_nickname(self.model)
 
-        installed_drivers = self._printer_get_installed_drivers()
+        driver = self._printer_get_driver(self.model)
 
-        if self.model in installed_drivers:
-            return installed_drivers[self.model]['make-and-model']
+        if driver is not None:
+            return driver['make-and-model']
 
         self.module.fail_json(msg="Unable to determine printer make and model for printer '{0}'.".format(self.model))
 
-    def _printer_install(self):
+    def apply_change_plan(self, plan, err_msg):
+        """
+        Runs the single lpadmin command collected in a CUPSChangePlan, if there's anything to change.
+
+        A command that only carries forced options (see CUPSChangePlan) is run like the mandatory options always were,
+        i.e. without marking the module as changed and only logging its output if there's an error.
+
+        :param plan: The CUPSChangePlan to apply.
+        :param err_msg: The error message with which to exit the module if an error occurred.
+        """
+        if plan.empty():
+            return
+
+        self.process_change_command(plan.command(), err_msg=err_msg, only_log_on_error=not plan.changes)
+
+        if plan.default:
+            self.cups_get_inventory().default = plan.name
+
+    def _printer_plan_install(self, plan):
         """
-        Installs the printer with the settings defined.
+        Adds the settings defined for a new printer to the change plan.
+
+        :param plan: The CUPSChangePlan of this printer.
         """
-        cmd = ['lpadmin', '-p', self.name, '-v', self.uri]
+        plan.add_args('-v', self.uri)
 
         if self.enabled:
-            cmd.append('-E')
+            plan.add_args('-E')
 
-        if self.shared:
-            cmd.extend(['-o', 'printer-is-shared=true'])
-        else:
-            cmd.extend(['-o', 'printer-is-shared=false'])
+        plan.set_option('printer-is-shared', 'true' if self.shared else 'false')
 
         if self.model:
             if self.driver == 'model':
-                cmd.extend(['-m', self.model])
+                plan.add_args('-m', self.model)
             elif self.driver == 'ppd':
-                cmd.extend(['-P', self.model])
+                plan.add_args('-P', self.model)
 
         if self.info:
-            cmd.extend(['-D', self.info])
+            plan.add_args('-D', self.info)
 
         if self.location:
-            cmd.extend(['-L', self.location])
-
-        self.process_change_command(cmd,
-                                    err_msg="Installing printer '{0}' failed"
-                                    .format(self.name))
+            plan.add_args('-L', self.location)
 
-        if self.default:
-            cmd = ['lpadmin', '-d', self.name]
-            self.process_change_command(cmd,
-                                        err_msg="Setting printer '{0}' as default failed"
-                                        .format(self.name))
+    def _printer_plan_modify(self, plan, cups_options_diff):
+        """
+        Adds only the given options of an existing printer to the change plan, so they are changed in place keeping
+        its queue, jobs and PPD.
 
-    def _printer_install_mandatory_options(self):
+        :param plan: The CUPSChangePlan of this printer.
+        :param cups_options_diff: A hash of options to change with their expected value, as returned by
+        printer_get_cups_options_diff(). printer-make-and-model can't be changed in place.
         """
-        Installs mandatory printer options.
+        if 'device-uri' in cups_options_diff:
+            plan.add_args('-v', cups_options_diff['device-uri'])
+
+        if 'printer-info' in cups_options_diff:
+            plan.add_args('-D', cups_options_diff['printer-info'])
+
+        if 'printer-location' in cups_options_diff:
+            plan.add_args('-L', cups_options_diff['printer-location'])
 
-        cupsIPPSupplies, cupsSNMPSupplies, job-k-limit, job-page-limit, printer-op-policy,job-quota-period
-        cannot be checked via cups command-line tools yet. Therefore force set these options if they are defined.
-        If there's an error running the command, the whole module will fail with an error message.
+        if 'printer-is-shared' in cups_options_diff:
+            plan.set_option('printer-is-shared', cups_options_diff['printer-is-shared'])
+
+    def _cups_item_get_mandatory_options(self):
         """
-        orig_cmd = ['lpadmin', '-p', self.name]
-        cmd = list(orig_cmd)  # Making a copy of the list/array
+        Returns the mandatory options defined for the printer or class.
 
-        if self.report_ipp_supply_levels:
-            cmd.extend(['-o', 'cupsIPPSupplies=true'])
-        else:
-            cmd.extend(['-o', 'cupsIPPSupplies=false'])
+        job-k-limit, job-page-limit and job-quota-period only apply to printers.
 
-        if self.report_snmp_supply_levels:
-            cmd.extend(['-o', 'cupsSNMPSupplies=true'])
-        else:
-            cmd.extend(['-o', 'cupsSNMPSupplies=false'])
+        :returns: A list of (option, value) tuples.
+        """
+        options = [
+            ('cupsIPPSupplies', 'true' if self.report_ipp_supply_levels else 'false'),
+            ('cupsSNMPSupplies', 'true' if self.report_snmp_supply_levels else 'false'),
+        ]
 
-        if self.job_kb_limit:
-            cmd.extend(['-o', 'job-k-limit={0}'.format(self.job_kb_limit)])
+        if self.printer_or_class == 'printer':
+            if self.job_kb_limit:
+                options.append(('job-k-limit', str(self.job_kb_limit)))
 
-        if self.job_page_limit:
-            cmd.extend(['-o', 'job-page-limit={0}'.format(self.job_page_limit)])
+            if self.job_page_limit:
+                options.append(('job-page-limit', str(self.job_page_limit)))
 
-        if self.job_quota_limit:
-            cmd.extend(['-o', 'job-quota-period={0}'.format(self.job_quota_limit)])
+            if self.job_quota_limit:
+                options.append(('job-quota-period', str(self.job_quota_limit)))
 
         if self.assign_cups_policy:
-            cmd.extend(['-o', 'printer-op-policy={0}'.format(self.assign_cups_policy)])
+            options.append(('printer-op-policy', self.assign_cups_policy))
 
-        if cmd != orig_cmd:
-            self.process_change_command(cmd,
-                                        err_msg="Install mandatory options for printer '{0}'"
-                                        .format(self.name),
-                                        only_log_on_error=True)
+        return options
 
-    def _printer_install_options(self):
+    def _cups_item_plan_mandatory_options(self, plan):
         """
-        Installs any printer driver specific options defined.
+        Adds the mandatory printer or class options to the change plan.
 
-        :returns: rc, out, err. The output of the lpadmin installation command.
+        cupsIPPSupplies, cupsSNMPSupplies, job-k-limit, job-page-limit, printer-op-policy, job-quota-period
+        cannot be checked via cups command-line tools yet. Therefore these options are forced if they are defined,
+        unless the current options read (eg. from printers.conf or via IPP) show they are already set, or they were
+        just sent with the same parameters in the last run (see CUPSStateStore).
+        """
+        for (k, v) in self._cups_item_get_mandatory_options():
+            if k not in self.cups_current_options:
+                if not self.skip_forced_options:
+                    plan.set_option(k, v, forced=True)
+            elif self.cups_current_options[k] != v:
+                plan.set_option(k, v)
+                self.record_diff(k, self.cups_current_options[k], v)
+
+    def _printer_plan_options(self, plan, new_printer=False):
         """
-        cmd = ['lpadmin', '-p', self.name]
+        Adds the printer driver specific options defined that differ from the current ones to the change plan.
 
-        for k, v in self.options.iteritems():
-            cmd.extend(['-o', '{0}={1}'.format(k, v)])
+        :param plan: The CUPSChangePlan of this printer.
+        :param new_printer: If the printer is only being installed by this plan, all options are added as there are no
+        current ones to compare with yet.
+        """
+        if new_printer:
+            options = self.options
+        else:
+            with self.timer.phase('comparison'):
+                options = self.printer_get_options_diff()
 
-        if self.default:
-            cmd.extend(['-d', self.name])
+        for k in sorted(options):
+            plan.set_option(k, options[k])
 
-        return self.process_change_command(cmd,
-                                           err_msg="Install printer options for printer '{0}' failed".format(self.name))
+            current = self.printer_current_options.get(k, {}).get('current') if not new_printer else None
+            self.record_diff(k, current, options[k], section='options')
 
-    def _class_install(self):
+    def _class_add_member(self, printer):
         """
-        Installs the class with the settings defined.
+        Adds a printer to the class, creating the class if it doesn't exist yet.
 
-        It loops through the list of printers that are supposed to be in the class and confirms if they exists and
-        adds them to the class. If any one of the printers don't exist, the whole module will fail with an error
-        message.
+        If the printer doesn't exist, the whole module will fail with an error message.
+
+        :param printer: Name of the printer to add.
         """
-        for printer in self.class_members:
-            # Going through all the printers that are supposed to be in the class and adding them to said class
-            # Ensuring first the printer exists
-            if self.exists(item_to_check=printer):
-                cmd = ['lpadmin', '-p', printer, '-c', self.name]
-                self.process_change_command(cmd,
-                                            err_msg="Failed to add printer '{0}' to class '{1}'"
-                                            .format(printer, self.name))
-            else:
-                self.module.fail_json(msg="Printer '{0}' doesn't exist and cannot be added to class '{1}'."
-                                      .format(printer, self.name))
+        # Ensuring first the printer exists
+        if not self.exists(item_to_check=printer):
+            self.module.fail_json(msg="Printer '{0}' doesn't exist and cannot be added to class '{1}'."
+                                  .format(printer, self.name))
 
-        # Now that the printers are added to the class and the class created, we are setting up a few
-        # settings for the class itself
-        if self.exists_self():
-            cmd = ['lpadmin', '-p', self.name]
+        cmd = ['lpadmin', '-p', printer, '-c', self.name]
+        self.process_change_command(cmd,
+                                    err_msg="Failed to add printer '{0}' to class '{1}'".format(printer, self.name))
+        self.cups_get_inventory().add_class_member(self.name, printer)
+
+    def _class_remove_member(self, printer):
+        """
+        Removes a printer from the class.
 
-            if self.enabled:
-                cmd.append('-E')
+        :param printer: Name of the printer to remove.
+        """
+        cmd = ['lpadmin', '-p', printer, '-r', self.name]
+        self.process_change_command(cmd,
+                                    err_msg="Failed to remove printer '{0}' from class '{1}'"
+                                    .format(printer, self.name))
+        self.cups_get_inventory().remove_class_member(self.name, printer)
 
-            if self.shared:
-                cmd.extend(['-o', 'printer-is-shared=true'])
-            else:
-                cmd.extend(['-o', 'printer-is-shared=false'])
+    def _class_sync_members(self):
+        """
+        Brings the members of the class in line with the ones defined.
+
+        Only the missing printers are added and the superfluous ones removed, the class itself is kept. Printers are
+        added before any are removed as CUPS deletes a class once its last member is gone.
+        """
+        with self.timer.phase('comparison'):
+            (members_to_add, members_to_remove) = self.class_get_members_diff()
 
-            if self.info:
-                cmd.extend(['-D', self.info])
+        if members_to_add or members_to_remove:
+            current_members = list(self.class_current_members) if self.exists_self() else []
+            self.record_diff('members', current_members, list(self.class_members))
 
-            if self.location:
-                cmd.extend(['-L', self.location])
+        for printer in members_to_add:
+            self._class_add_member(printer)
 
-            self.process_change_command(cmd,
-                                        err_msg="Failed to set Class options for class '{0}'"
-                                        .format(self.name))
+        for printer in members_to_remove:
+            self._class_remove_member(printer)
 
-    def _class_install_mandatory_options(self):
+    def _class_plan_install(self, plan):
         """
-        Installs mandatory class options.
+        Adds the settings defined for a new class to the change plan.
 
-        cupsIPPSupplies, cupsSNMPSupplies, printer-op-policy,job-quota-period cannot be checked via
-        cups command-line tools yet. Therefore force set these options if they are defined.
-        If there's an error running the command, the whole module will fail with an error message.
+        :param plan: The CUPSChangePlan of this class.
         """
-        orig_cmd = ['lpadmin', '-p', self.name]
-        cmd = list(orig_cmd)  # Making a copy of the list/array
+        if self.enabled:
+            plan.add_args('-E')
 
-        if self.report_ipp_supply_levels:
-            cmd.extend(['-o', 'cupsIPPSupplies=true'])
-        else:
-            cmd.extend(['-o', 'cupsIPPSupplies=false'])
+        plan.set_option('printer-is-shared', 'true' if self.shared else 'false')
 
-        if self.report_snmp_supply_levels:
-            cmd.extend(['-o', 'cupsSNMPSupplies=true'])
-        else:
-            cmd.extend(['-o', 'cupsSNMPSupplies=false'])
+        if self.info:
+            plan.add_args('-D', self.info)
 
-        if self.assign_cups_policy:
-            cmd.extend(['-o', 'printer-op-policy={0}'.format(self.assign_cups_policy)])
+        if self.location:
+            plan.add_args('-L', self.location)
+
+    def _class_plan_modify(self, plan, cups_options_diff):
+        """
+        Adds only the given options of an existing class to the change plan.
+
+        :param plan: The CUPSChangePlan of this class.
+        :param cups_options_diff: A hash of options to change with their expected value, as returned by
+        class_get_cups_options_diff().
+        """
+        if 'printer-info' in cups_options_diff:
+            plan.add_args('-D', cups_options_diff['printer-info'])
+
+        if 'printer-location' in cups_options_diff:
+            plan.add_args('-L', cups_options_diff['printer-location'])
 
-        if cmd != orig_cmd:
-            self.process_change_command(cmd,
-                                        err_msg="Installing mandatory options for class '{0}' failed"
-                                        .format(self.name),
-                                        only_log_on_error=True)
+    def cups_item_set_default(self):
+        """
+        Makes the printer or class defined in this class the server default if it isn't already.
+        """
+        if self.cups_get_inventory().default != self.name:
+            self.record_diff('default', False, True)
+            plan = CUPSChangePlan(self.name)
+            plan.set_default()
+            self.apply_change_plan(plan, err_msg="Setting '{0}' as the default destination failed".format(self.name))
 
     def cups_item_uninstall_self(self):
         """
@@ -778,10 +4487,14 @@ class CUPSCommand(object):
 
         if self.exists(item_to_check=item_to_uninstall):
             if item_to_uninstall:
+                if item_to_uninstall == self.name and self.state == 'absent':
+                    self.record_diff('state', 'present', 'absent')
+
                 cmd.append(item_to_uninstall)
                 self.process_change_command(cmd,
                                             err_msg="Uninstalling CUPS Item '{0}' failed"
                                             .format(item_to_uninstall))
+                self.cups_get_inventory().remove(item_to_uninstall)
             else:
                 self.module.fail_json(msg="Cannot delete/uninstall a cups item (printer/class) with no name.")
 
@@ -789,8 +4502,6 @@ class CUPSCommand(object):
         """
         Checks to see if the printer or class defined in this class exists.
 
-        Using the lpstat command and based on if an error code is returned it can confirm if a printer or class exists.
-
         :returns: The return value of self.exists()
         """
         return self.exists(item_to_check=self.name)
@@ -799,17 +4510,14 @@ class CUPSCommand(object):
         """
         Checks to see if a printer or class exists.
 
-        Using the lpstat command and based on if an error code is returned it can confirm if a printer or class exists.
+        The check is answered from the inventory returned by cups_get_inventory().
 
         :param item_to_check: The print or class name to check if it exists.
 
-        :returns: True if return code form the command is 0 and therefore there where no errors and printer/class
-        exists. Module exits if item_to_check is not defined.
+        :returns: True if the printer/class exists. Module exits if item_to_check is not defined.
         """
         if item_to_check:
-            cmd = ['lpstat', '-p', item_to_check]
-            (rc, out, err) = self.process_info_command(cmd)
-            return rc == 0
+            return self.cups_get_inventory().exists(item_to_check)
         else:
             self.module.fail_json(msg="Cannot check if a cups item (printer/class) exists that has no name.")
 
@@ -826,10 +4534,25 @@ class CUPSCommand(object):
             printer-state-change-time=1463902120 printer-state-reasons=none printer-type=8425668
             printer-uri-supported=ipp://localhost/printers/TestPrinter
 
+        With config_dir defined the same options are read from printers.conf/classes.conf instead, with backend=ipp
+        they are read using Get-Printer-Attributes.
+
         :returns: A hash of the above info.
         """
+        if self.config is not None:
+            self.cups_get_config()
+            options = self.config.get_cups_options(self.name)
+            self.cups_current_options = options
+            return options
+
+        if self.ipp is not None:
+            options = self.process_ipp_request(['Get-Printer-Attributes', self.name], self.ipp.get_cups_options,
+                                               self.name, self.printer_or_class == 'class')
+            self.cups_current_options = options
+            return options
+
         cmd = ['lpoptions', '-p', self.name]
-        (rc, out, err) = self.process_info_command(cmd)
+        (rc, out, err) = self.process_query_command(cmd)
 
         options = {}
         for s in shlex.split(out):
@@ -844,108 +4567,212 @@ class CUPSCommand(object):
 
         return options
 
-    def printer_check_cups_options(self):
+    def printer_get_cups_options_diff(self):
         """
-        Creates a hash of the defined options sent to this module.
-        Polls and retrieves a hash of options currently set for the printer.
-        Compares them and returns True if the option values are satisfied or False if not satisfied.
+        Compares the defined options sent to this module with the options currently set for the printer and returns
+        the options whose values are not satisfied, see CUPSComparison.
 
-        :returns: 'True' if the option values match else 'False'.
+        The current options are only polled once the first check needs them. The make and model is checked last, as
+        finding the expected one may need a lookup in the driver catalog, see _printer_get_make_and_model. That lookup
+        is skipped if a cheaper check shows the printer has the right driver already: a printer defined by
+        make_and_model whose make and model matches that, see _printer_matches_make_and_model, or one whose queue PPD
+        was made from the defined driver, see _printer_matches_queue_ppd.
+
+        :returns: A hash of the options that differ with their expected value. Empty if all option values match.
         """
-        expected_cups_options = {
-            'printer-make-and-model': self._printer_get_make_and_model(),
-            'printer-is-shared': 'true' if self.shared else 'false',
-        }
+        comparison = CUPSComparison()
+        cups_options = CUPSComparison.once(self.cups_item_get_cups_options)
+
+        def expected(value):
+            return lambda: value
+
+        def current(k):
+            return lambda: cups_options().get(k)
+
+        comparison.add('printer-is-shared', 'query', current('printer-is-shared'),
+                       expected('true' if self.shared else 'false'))
 
         if self.info:
-            expected_cups_options['printer-info'] = self.info
+            comparison.add('printer-info', 'query', current('printer-info'), expected(self.info))
         if self.uri:
-            expected_cups_options['device-uri'] = self.uri
+            comparison.add('device-uri', 'query', current('device-uri'), expected(self.uri))
         if self.location:
-            expected_cups_options['printer-location'] = self.location
+            comparison.add('printer-location', 'query', current('printer-location'), expected(self.location))
+
+        cost = self._printer_make_and_model_cost()
+        if cost == 'driver':
+            comparison.add('printer-make-and-model', 'query', current('printer-make-and-model'),
+                           lambda: self._printer_matches_make_and_model(cups_options().get('printer-make-and-model')))
+            comparison.add('printer-make-and-model', 'file', current('printer-make-and-model'),
+                           lambda: self._printer_matches_queue_ppd(cups_options().get('printer-make-and-model')))
+        comparison.add('printer-make-and-model', cost, current('printer-make-and-model'),
+                       self._printer_get_make_and_model)
+
+        diff = comparison.run()
+
+        self.cups_checks = comparison.report
+        self.cups_expected_options = comparison.expected
+
+        return diff
+
+    def _printer_make_and_model_cost(self):
+        """
+        :returns: What checking the make and model of the printer has to look at, see CUPSComparison.
+        """
+        if self.driver == 'ppd':
+            return 'file'
 
-        self.cups_expected_options = expected_cups_options
+        if self.model == 'raw' or not (self.model or self.device_id):
+            return 'query'
+
+        return 'driver'
+
+    def _printer_defined_by_make_and_model(self):
+        """
+        :returns: True if the driver of the printer is only defined by make_and_model, see _printer_resolve_model.
+        """
+        return self.driver == 'model' and not self.model and bool(self.make_and_model)
+
+    def _printer_matches_make_and_model(self, current):
+        """
+        Checks whether a printer defined by make_and_model has the right driver, without looking it up.
+
+        It has if its make and model matches make_and_model the way the driver catalog matches it, see
+        CUPSDriverIndex.make_and_model_key.
+
+        :param current: The current make and model of the printer.
+        :returns: current if it matches, None if that can't be told this way.
+        """
+        if self._printer_defined_by_make_and_model() and current and \
+                CUPSDriverIndex.make_and_model_key(current) == CUPSDriverIndex.make_and_model_key(self.make_and_model):
+            return current
+
+        return None
+
+    def _printer_matches_queue_ppd(self, current):
+        """
+        Checks whether the printer has the driver defined by model, without looking it up, from the PPD cupsd made
+        for the queue out of it.
+
+        The PPDs of drivers compiled from a .drv file are named after their *PCFileName, eg.
+        'drv:///sample.drv/laserjet.ppd' for *PCFileName: "LASERJET.PPD", which cupsd keeps in the queue PPD.
+
+        :param current: The current make and model of the printer.
+        :returns: current if the queue PPD was made from model, None if that can't be told this way (eg. other kinds
+        of drivers, a remote server or an unreadable PPD directory).
+        """
+        if self.driver != 'model' or not self.model or not current or not self.model.startswith('drv:///') or \
+                self.server.is_remote():
+            return None
 
-        cups_options = self.cups_item_get_cups_options()
+        ppd_dir = CUPSPPD.queue_ppd_dir(self.config.path if self.config is not None else None)
+        if ppd_dir is None:
+            return None
 
-        # Comparing expected options as stated above to the options of the actual printer object.
-        for k in expected_cups_options:
-            if k not in cups_options:
-                return False
+        path = os.path.join(ppd_dir, '{0}.ppd'.format(self.name))
+        self.append_cmd_history(['read', path])
+        pc_file_name = CUPSPPD.get_keyword(path, 'PCFileName')
 
-            if expected_cups_options[k] != cups_options[k]:
-                return False
+        if pc_file_name and pc_file_name.lower() == self.model.rsplit('/', 1)[1].lower():
+            return current
 
-        return True
+        return None
 
-    def class_check_cups_options(self):
+    def class_get_cups_options_diff(self):
         """
-        Creates a hash of the defined options sent to this module.
-        Polls and retrieves a hash of options currently set for the class.
-        Compares them and returns True if the option values are satisfied or False if not satisfied.
+        Compares the defined options sent to this module with the options currently set for the class and returns
+        the options whose values are not satisfied, see CUPSComparison. The current options are only polled if
+        there's anything to compare.
 
-        :returns: 'True' if the option values match else 'False'.
+        :returns: A hash of the options that differ with their expected value. Empty if all option values match.
         """
-        expected_cups_options = {
-            'printer-location': self.location,
-        }
+        comparison = CUPSComparison()
+        cups_options = CUPSComparison.once(self.cups_item_get_cups_options)
 
         if self.info:
-            expected_cups_options['printer-info'] = self.info
+            comparison.add('printer-info', 'query', lambda: cups_options().get('printer-info'), lambda: self.info)
         if self.location:
-            expected_cups_options['printer-location'] = self.location
+            comparison.add('printer-location', 'query', lambda: cups_options().get('printer-location'),
+                           lambda: self.location)
 
-        self.cups_expected_options = expected_cups_options
+        diff = comparison.run()
 
-        options = self.cups_item_get_cups_options()
-        options_status = True
+        self.cups_checks = comparison.report
+        self.cups_expected_options = comparison.expected
 
-        # Comparing expected options as stated above to the options of the actual class object
-        for k in expected_cups_options:
-            if k not in options:
-                options_status = False
-                break
+        return diff
 
-            if expected_cups_options[k] != options[k]:
-                options_status = False
-                break
+    def class_get_members_diff(self):
+        """
+        Compares the defined class members with the current ones.
+
+        :returns: A tuple of the list of printers missing from the class and the list of printers that shouldn't be
+        in it, both in the order they are defined or listed in.
+        """
+        current_members = self.class_get_current_members() if self.exists_self() else []
 
-        # Comparing expected class members and actual class members
-        class_members_status = sorted(self.class_members) == sorted(self.class_get_current_members())
+        members_to_add = [m for m in self.class_members if m not in current_members]
+        members_to_remove = [m for m in current_members if m not in self.class_members]
 
-        return options_status and class_members_status
+        return members_to_add, members_to_remove
 
     def class_get_current_members(self):
         """
-        Uses the lpstat -c command to get a list of members, eg:
+        Returns the current members of the class, as listed by lpstat -c, eg:
         members of class TestClass:
             TestPrinter1
             TestPrinter2
 
-        This is parsed into a list. The first line is skipped.
+        The members are taken from the inventory returned by cups_get_inventory() which parses the above.
 
         :returns: A list of members for class specified in the module.
         """
-        cmd = ['lpstat', '-c', self.name]
-        (rc, out, err) = self.process_info_command(cmd)
+        members = self.cups_get_inventory().get_class_members(self.name)
 
-        if rc != 0:
+        if members is None:
             self.module.fail_json(
                 msg="Error occurred while trying to discern class '{0}' members.".format(self.name))
 
-        members = []
-        # Skip first line as it's an information line, it end with a ':'
-        (info, out) = out.split(':', 1)
-        out = shlex.split(out)
-        for m in out:
-            str.strip(m)
-            members.append(m)
-
         self.class_current_members = members
 
         return members
 
-    def printer_get_specific_options(self):
+    def cups_item_get_facts(self, sections):
+        """
+        Returns the current state of the printer or class as gathered by gather_facts, eg:
+            'device-uri': 'file:///dev/null'
+            'enabled': True
+            'accepting': True
+            'attributes': 'printer-location': 'Room 404'
+                          ...
+            'driver_options': 'PageSize': 'A4'
+
+        The state is taken from the inventory (see cups_get_inventory), the sections asked for are read the same way
+        they're read to be compared: attributes with cups_item_get_cups_options, members with
+        class_get_current_members and driver_options with printer_get_specific_options.
+
+        :param sections: The sections to gather on top of the state, see CUPSFactsCommand.SECTIONS.
+        :returns: A hash of the facts of the printer or class.
+        """
+        dest = self.cups_get_inventory().destinations[self.name]
+
+        facts = {'enabled': dest['enabled'], 'accepting': dest['accepting']}
+
+        if self.printer_or_class == 'printer':
+            facts['device-uri'] = dest['device-uri']
+        elif 'members' in sections:
+            facts['members'] = self.class_get_current_members()
+
+        if 'attributes' in sections:
+            facts['attributes'] = self.cups_item_get_cups_options()
+
+        if 'driver_options' in sections and self.printer_or_class == 'printer':
+            facts['driver_options'] = dict((k, v['current'])
+                                           for (k, v) in self.printer_get_specific_options(all_options=True).items())
+
+        return facts
+
+    def printer_get_specific_options(self, all_options=False):
         """
         Returns a hash of printer specific options with its current value, available values and its label.
         Runs lpoptions -p <printer_name> -l, eg:
@@ -972,10 +4799,47 @@ class CUPSCommand(object):
                                   'values': 'True288'
                                             'False288'
 
+        Unless backend=ipp, the PPD cupsd keeps for the printer in ppd/<name>.ppd of config_dir (or /etc/cups) is read
+        directly instead if it's accessible, see _printer_read_ppd_options. Only the defined options are returned then,
+        unless all_options is set. With backend=ipp the PPD is fetched from cupsd, see CUPSPPD.parse_options.
+
+        The options are only read once. The option schema found is kept for all printers using the same driver, see
+        _printer_get_option_schema.
+
+        :param all_options: Return all options of the printer even if they're read from its PPD, eg. for gather_facts.
         :returns: A hash of printer options. It includes currently set option and other available options.
         """
+        if self.printer_options_read:
+            return self.printer_current_options
+
+        options = None
+
+        if self.ipp is None:
+            options = self._printer_read_ppd_options(all_options)
+
+        if options is None and self.ipp is not None:
+            options = self.process_ipp_request(['GET', '/printers/{0}.ppd'.format(self.name)],
+                                               self.ipp.get_ppd_options, self.name)
+
+        if options is None:
+            options = self._printer_run_lpoptions()
+
+        if options and self._printer_option_schema_key() not in self.driver_cache.option_schemas:
+            self.driver_cache.option_schemas[self._printer_option_schema_key()] = CUPSPPD.schema_from_options(options)
+
+        self.printer_current_options = options
+        self.printer_options_read = True
+
+        return options
+
+    def _printer_run_lpoptions(self):
+        """
+        Runs 'lpoptions -p <printer_name> -l' and parses its output, see printer_get_specific_options.
+
+        :returns: A hash of printer options.
+        """
         cmd = ['lpoptions', '-p', self.name, '-l']
-        (rc, out, err) = self.process_info_command(cmd)
+        (rc, out, err) = self.process_query_command(cmd)
 
         options = {}
         for l in out.splitlines():
@@ -1003,74 +4867,244 @@ class CUPSCommand(object):
                 'values': values,
             }
 
-        self.printer_current_options = options
-
         return options
 
-    def printer_check_options(self):
+    def _printer_option_schema_key(self):
         """
-        Returns if the defined options is the same as the options currently set for the printer.
-        :returns: Returns if the defined options is the same as the options currently set for the printer.
+        :returns: The key the option schema of the driver of this printer is cached under, or None if the printer has
+        no driver (i.e. it's a raw queue).
+        """
+        if not self.model or (self.driver == 'model' and self.model == 'raw'):
+            return None
+
+        return "{0}:{1}".format(self.driver, self.model)
+
+    def _printer_read_ppd_options(self, all_options=False):
+        """
+        Reads the current values of the defined options from the PPD cupsd keeps for the printer, ppd/<name>.ppd in
+        config_dir (or /etc/cups).
+
+        The whole PPD is only parsed for the first printer of a driver, its option schema is kept for all others. For
+        those only the *Default lines of the defined options are picked out, see CUPSPPD.read_defaults.
+
+        :param all_options: Read all options of the PPD instead of the defined ones only.
+        :returns: A hash in the same format as printer_get_specific_options holding the defined options that are in
+        the PPD. Empty if the printer has no PPD. None if the PPD directory can't be read, eg. if CUPS keeps its
+        configuration elsewhere, the module isn't run as root or a remote server is managed.
+        """
+        if self.server.is_remote():
+            return None
+
+        ppd_dir = CUPSPPD.queue_ppd_dir(self.config.path if self.config is not None else None)
+        if ppd_dir is None:
+            return None
+
+        path = os.path.join(ppd_dir, '{0}.ppd'.format(self.name))
+
+        self.append_cmd_history(['read', path])
+
+        key = self._printer_option_schema_key()
+        schema = self.driver_cache.option_schemas.get(key) if key is not None else None
+
+        try:
+            with open(path) as f:
+                if schema is None:
+                    (schema, defaults) = CUPSPPD.parse_schema(f)
+                    if key is not None:
+                        self.driver_cache.option_schemas[key] = schema
+                else:
+                    defaults = CUPSPPD.read_defaults(f, schema if all_options else self.options)
+        except (IOError, OSError):
+            if os.path.exists(path):
+                return None
+            return {}
+
+        return CUPSPPD.options_from_schema(schema, defaults, names=None if all_options else sorted(self.options))
+
+    def _printer_get_option_schema(self, installed):
+        """
+        Returns the option schema of the driver of this printer, see CUPSPPD.parse_schema.
+
+        It's taken from another printer using the same driver if one was read already. Otherwise it's read from the
+        PPD of this printer if it's installed with the defined driver, or from the PPD file defined if driver=ppd.
+
+        :param installed: True if the printer is installed with the defined driver.
+        :returns: The option schema or None if it can't be determined before the printer is installed.
+        """
+        key = self._printer_option_schema_key()
+        if key is None:
+            return None
+
+        if key not in self.driver_cache.option_schemas:
+            if installed:
+                with self.timer.phase('comparison'):
+                    self.printer_get_specific_options()
+            elif self.driver == 'ppd':
+                try:
+                    with open(self.model) as f:
+                        self.driver_cache.option_schemas[key] = CUPSPPD.parse_schema(f)[0]
+                except (IOError, OSError):
+                    pass
+
+        return self.driver_cache.option_schemas.get(key)
+
+    def _printer_validate_options(self, installed):
         """
-        expected_printer_options = self.options
+        Checks the defined options against the option schema of the driver before anything is changed.
+
+        Options the driver doesn't know are left alone, as they might be handled by CUPS itself (eg. media).
+        The module fails and exits if a value isn't one the driver allows.
+
+        :param installed: True if the printer is installed with the defined driver.
+        """
+        if not self.options:
+            return
+
+        schema = self._printer_get_option_schema(installed)
+        if not schema:
+            return
+
+        for k in sorted(self.options):
+            if k not in schema or not schema[k]['values']:
+                continue
+
+            v = str(self.options[k])
+            allowed = schema[k]['values']
+            if v in allowed or (v.startswith('Custom.') and 'Custom' in allowed):
+                continue
+
+            self.module.fail_json(msg="Value '{0}' of option '{1}' isn't supported by the driver of printer '{2}'. "
+                                      "Supported values are: {3}.".format(v, k, self.name, ", ".join(allowed)))
+
+    def printer_get_options_diff(self):
+        """
+        Compares the defined options with the options currently set for the printer.
+
+        :returns: A hash of the defined options whose current value differs, with their defined value.
+        """
+        if not self.options:
+            return {}
 
         printer_options = self.printer_get_specific_options()
-        for k in expected_printer_options:
-            if k not in printer_options:
-                return False
 
-            if expected_printer_options[k] != printer_options[k]['current']:
-                return False
+        diff = {}
+        for (k, v) in self.options.items():
+            if k not in printer_options or v != printer_options[k]['current']:
+                diff[k] = v
+
+        return diff
 
-        return True
+    def printer_check_options(self):
+        """
+        Returns if the defined options is the same as the options currently set for the printer.
+        :returns: Returns if the defined options is the same as the options currently set for the printer.
+        """
+        return not self.printer_get_options_diff()
 
     def printer_install(self):
         """
         The main method that's called when state is 'present' and printer_or_class is 'printer'.
 
         It checks to see if printer exists and if its settings are the same as defined.
-        If not, it deletes it.
+        If only the location, info, uri or sharing differ, just those are changed in place.
+        If its make and model (i.e. driver) differs, it deletes it.
 
         It then checks to see if it exists again and installs it with defined settings if it doesn't exist.
 
-        It also installs mandatory settings.
+        It also installs mandatory settings and the printer specific options that aren't the same. Their values are
+        checked against the options the driver supports before anything is changed.
+
+        All of the above is collected in a CUPSChangePlan and sent as a single lpadmin command. Only making a new
+        printer the default needs a second one.
 
-        Lastly it sets the printer specific options to the printer if it isn't the same.
+        If the driver is defined by make_and_model or device_id, it's looked up before the printer is (re)installed,
+        see _printer_resolve_model. A printer that has the driver matching make_and_model already is compared without
+        looking it up, see printer_get_cups_options_diff.
         """
-        if self.exists_self() and not self.printer_check_cups_options():
+        plan = CUPSChangePlan(self.name)
+        cups_options_diff = {}
+
+        if self.exists_self():
+            with self.timer.phase('comparison'):
+                cups_options_diff = self.printer_get_cups_options_diff()
+
+            for k in sorted(cups_options_diff):
+                self.record_diff(k, self.cups_current_options.get(k), cups_options_diff[k])
+        else:
+            self.record_diff('state', 'absent', 'present')
+            self.record_diff('device-uri', None, self.uri)
+
+        # A different driver needs the queue to be set up from scratch
+        reinstall = 'printer-make-and-model' in cups_options_diff
+
+        if reinstall or not self.exists_self():
+            self._printer_resolve_model()
+
+        # Unsupported option values are caught before anything is changed
+        self._printer_validate_options(installed=self.exists_self() and not reinstall)
+
+        if reinstall:
             self.cups_item_uninstall_self()
+        elif cups_options_diff:
+            self._printer_plan_modify(plan, cups_options_diff)
 
-        if not self.exists_self():
-            self._printer_install()
+        new_printer = not self.exists_self()
+        if new_printer:
+            self._printer_plan_install(plan)
 
         # cupsIPPSupplies, cupsSNMPSupplies, job-k-limit, job-page-limit, printer-op-policy,
         # job-quota-period cannot be checked via cups command-line tools yet
         # Therefore force set these options if they exist
-        if self.exists_self():
-            self._printer_install_mandatory_options()
+        self._cups_item_plan_mandatory_options(plan)
+
+        self._printer_plan_options(plan, new_printer=new_printer)
 
-        if not self.printer_check_options():
-            self._printer_install_options()
+        if self.default and self.cups_get_inventory().default != self.name:
+            self.record_diff('default', False, True)
+            if new_printer:
+                # lpadmin sets the default before creating the printer, so it needs a command of its own
+                self.apply_change_plan(plan, err_msg="Installing printer '{0}' failed".format(self.name))
+                plan = CUPSChangePlan(self.name)
+            plan.set_default()
+
+        self.apply_change_plan(plan, err_msg="Installing printer '{0}' failed".format(self.name))
+
+        if new_printer:
+            self.cups_get_inventory().add_printer(self.name, uri=self.uri, enabled=self.enabled)
+        else:
+            self.cups_get_inventory().add_printer(self.name, uri=plan.args_value('-v'))
 
     def class_install(self):
         """
         The main method that's called when state is 'present' and printer_or_class is 'class'.
 
-        It checks to see if class exists and if its settings are the same as defined.
-        If not, it deletes it.
+        It adds the printers missing from the class (creating it if it doesn't exist) and removes the ones that
+        shouldn't be in it, without recreating the class.
 
-        It then checks to see if it exists again and installs it with defined settings if it doesn't exist.
+        A new class gets all its settings, an existing one only the info and location that differ.
 
-        It also installs mandatory settings.
+        It also installs mandatory settings. The settings of the class itself are sent as a single lpadmin command.
         """
-        if self.exists_self() and not self.class_check_cups_options():
-            self.cups_item_uninstall_self()
+        plan = CUPSChangePlan(self.name)
+
+        if self.exists_self():
+            with self.timer.phase('comparison'):
+                cups_options_diff = self.class_get_cups_options_diff()
+
+            for k in sorted(cups_options_diff):
+                self.record_diff(k, self.cups_current_options.get(k), cups_options_diff[k])
 
-        if not self.exists_self():
-            self._class_install()
+            self._class_plan_modify(plan, cups_options_diff)
+            self._class_sync_members()
+        else:
+            self.record_diff('state', 'absent', 'present')
+            self._class_sync_members()
+            self._class_plan_install(plan)
 
         if self.exists_self():
-            self._class_install_mandatory_options()
+            self._cups_item_plan_mandatory_options(plan)
+
+        self.apply_change_plan(plan, err_msg="Failed to set Class options for class '{0}'".format(self.name))
 
     def start_process(self):
         """
@@ -1085,21 +5119,45 @@ class CUPSCommand(object):
         - state=absent:
             - Call CUPSCommand.cups_item_uninstall() to uninstall either a printer or a class.
 
+        If purge or remove is defined, CUPSCommand.cups_remove_items() removes all selected printers and classes
+        instead.
+
+        If state_file is defined and the printer or class is known to be converged (see CUPSStateStore), nothing is
+        checked at all.
+
         :returns: 'result' a hash containing the desired state.
         """
         result = {}
+        store = None
 
         if self.purge:
-            self.cups_purge_all_items()
+            result['removed'] = self.cups_purge_all_items()
             result['purge'] = self.purge
 
+        elif self.remove is not None:
+            result['removed'] = self.cups_remove_items(self.cups_select_items(self.remove))
+
         else:
             result['state'] = self.state
             result['printer_or_class'] = self.printer_or_class
             result['assign_cups_policy'] = self.assign_cups_policy
             result['name'] = self.name
 
-            if self.printer_or_class == 'printer':
+            store = self.state_store
+            if store is not None:
+                params_hash = CUPSStateStore.params_hash(self.params)
+                fingerprint = store.fingerprint(self.params)
+
+                self.skip_forced_options = store.pending(self.name, params_hash, fingerprint)
+
+            if store is not None and store.matches(self.name, params_hash, fingerprint):
+                result['fingerprint_matched'] = True
+                if self.printer_or_class == 'printer':
+                    result['uri'] = self.uri
+                else:
+                    result['class_members'] = self.class_members
+
+            elif self.printer_or_class == 'printer':
                 if self.state == 'present':
                     self.printer_install()
                 else:
@@ -1114,17 +5172,25 @@ class CUPSCommand(object):
                 result['class_members'] = self.class_members
 
         result['changed'] = self.changed
+        result['timings'] = self.timer.summary()
 
-        if self.out:
-            result['stdout'] = self.out
+        if store is not None and not result.get('fingerprint_matched') and not self.check_mode:
+            if self.plan:
+                store.refresh()
+                fingerprint = store.fingerprint(self.params)
+            store.update(self.name, params_hash, fingerprint, commands_run=bool(self.plan))
+            store.save()
+
+        self.add_changes_to_result(result)
 
         # Verbose Logging info
-        if self.cmd_history:
-            result['cmd_history'] = self.cmd_history
+        self.add_journal_to_result(result)
         if self.cups_current_options:
             result['cups_current_options'] = self.cups_current_options
         if self.cups_expected_options:
             result['cups_expected_options'] = self.cups_expected_options
+        if self.cups_checks:
+            result['checks'] = self.cups_checks
         if self.class_current_members:
             result['class_current_members'] = self.class_current_members
         if self.printer_current_options:
@@ -1133,6 +5199,563 @@ class CUPSCommand(object):
         return result
 
 
+class CUPSItemExit(Exception):
+    """
+        Raised instead of failing the module when a single printer or class item of a CUPSBulkCommand fails.
+
+        The keyword arguments given to fail_json() are kept in 'result'.
+    """
+
+    def __init__(self, **result):
+        Exception.__init__(self, result.get('msg', ''))
+        self.result = result
+
+
+class CUPSItemModule(object):
+    """
+        Stands in for the AnsibleModule of a single printer or class item processed by CUPSBulkCommand.
+
+        Everything is handed through to the real module except fail_json(), which raises a CUPSItemExit instead.
+        That way an error only ends the processing of its own item (and whatever depends on it) while all other items
+        are processed as usual.
+    """
+
+    def __init__(self, module):
+        self._module = module
+
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+    def fail_json(self, **kwargs):
+        kwargs['failed'] = True
+        raise CUPSItemExit(**kwargs)
+
+
+class CUPSBulkCommand(object):
+    """
+        Reconciles a whole list of printers and classes within a single module run.
+
+        Every item in 'printers' and 'classes' accepts the same keys as the single printer/class invocation of this
+        module. Each item is normalised against CUPS_ITEM_ARGUMENT_SPEC and handed to its own CUPSCommand, so the
+        printer and class handling documented in CUPSCommand applies unchanged to every item.
+
+        The settings of the items that exist already are read up front, with up to 'query_concurrency' queries
+        running at the same time, see CUPSQueryEngine.
+
+        The items are scheduled on a pool of up to 'workers' threads:
+            - Every printer can be processed on its own.
+            - A class waits for the printers it has or is going to have as members. If any of them fails, the class is
+              skipped.
+            - Items with the same name are processed in the order they are defined.
+            - The default destination is set last, once all printers and classes are done. If several items are
+              marked as default the last one wins.
+        No more commands or requests than the server allows are sent to it at the same time, see CUPSServer. The
+        items are processed one after the other when profiling as cProfile only sees the thread it was started in.
+
+        In check mode every item is planned in full (see CUPSCommand) and the commands of all items are returned in
+        'plan' in the order they would be run.
+
+        An item that fails doesn't stop the other items. The results are reported in the order the items are defined
+        and the module fails at the end if any item failed.
+
+        With state_file defined, items known to be converged (see CUPSStateStore) are skipped without being checked.
+        A class is still checked if any printer it depends on was changed in this run, as eg. reinstalling a printer
+        removes it from its classes.
+    """
+
+    def __init__(self, module):
+        """
+        Assigns module vars to object.
+        """
+        self.module = module
+
+        self.printers = module.params['printers'] or []
+        self.classes = module.params['classes'] or []
+        self.workers = module.params['workers']
+
+        self.timer = CUPSTimer()
+
+        self.server = CUPSServer.from_module(module)
+
+        # The helpers shared by all items are used from the worker threads, so they must not exit the module when
+        # they fail. Like the items themselves they get a CUPSItemModule, failing only the item that used them.
+        item_module = CUPSItemModule(module)
+
+        # The stored driver catalog is fingerprinted with the local driver directories, see CUPSDriverCache
+        driver_cache_path = None if self.server.is_remote() else module.params['driver_cache']
+
+        self.driver_cache = CUPSDriverCache(item_module, driver_cache_path)
+        self.inventory = CUPSInventory()
+
+        self.ipp = None
+        if module.params['backend'] == 'ipp':
+            self.ipp = CUPSIPPBackend(item_module, server=self.server)
+
+        self.config = None
+        if module.params['config_dir']:
+            self.config = CUPSConfigReader(item_module, module.params['config_dir'])
+
+        self.state_store = CUPSStateStore.from_module(module, self.driver_cache)
+        self.queries = CUPSQueryEngine.from_module(module)
+
+        self.changed = False
+
+    def item_params(self, item, printer_or_class):
+        """
+        Builds the parameter hash for a single printer or class item.
+
+        Missing keys are filled with the defaults from CUPS_ITEM_ARGUMENT_SPEC and values are converted to the type
+        stated there, the same way AnsibleModule does it for the top level parameters.
+        Module fails and exits if the item is not a hash, has no name or has unknown or illegal values.
+
+        :param item: The hash describing the printer or class as given in the 'printers' or 'classes' list.
+        :param printer_or_class: Whether the item comes from the 'printers' or 'classes' list.
+        :returns: A hash of parameters that can be handed to CUPSCommand.
+        """
+        if not isinstance(item, dict):
+            self.module.fail_json(msg="Every {0} item must be a hash, got '{1}'.".format(printer_or_class, item))
+
+        if not item.get('name'):
+            self.module.fail_json(msg="Every {0} item must have a name.".format(printer_or_class))
+
+        unknown = [k for k in item if k not in CUPS_ITEM_ARGUMENT_SPEC]
+        if unknown:
+            self.module.fail_json(msg="Unsupported parameters for {0} '{1}': {2}."
+                                  .format(printer_or_class, item['name'], ", ".join(sorted(unknown))))
+
+        params = {'purge': False}
+        for k, spec in CUPS_ITEM_ARGUMENT_SPEC.items():
+            v = item.get(k, copy.deepcopy(spec.get('default')))
+
+            if v is not None:
+                try:
+                    if spec.get('type') == 'bool':
+                        v = self.module.boolean(v)
+                    elif spec.get('type') == 'int':
+                        v = int(v)
+                    elif spec.get('type') == 'list' and not isinstance(v, list):
+                        v = [m.strip() for m in str(v).split(',')]
+                    elif spec.get('type') == 'dict' and not isinstance(v, dict):
+                        raise ValueError("{0} is not a hash".format(v))
+                    elif spec.get('type') == 'str' and isinstance(v, (int, float)):
+                        v = str(v)
+                except (TypeError, ValueError) as e:
+                    self.module.fail_json(msg="Value of '{0}' for {1} '{2}' is invalid: {3}."
+                                          .format(k, printer_or_class, item['name'], e))
+
+            if 'choices' in spec and v not in spec['choices']:
+                self.module.fail_json(msg="Value of '{0}' for {1} '{2}' must be one of: {3}."
+                                      .format(k, printer_or_class, item['name'], ", ".join(spec['choices'])))
+
+            params[k] = v
+
+        params['printer_or_class'] = printer_or_class
+
+        return params
+
+    def _item_dependencies(self, items):
+        """
+        Works out which items have to be processed before each item.
+
+        :param items: A list of (printer_or_class, params) tuples, printers first.
+        :returns: A list with the set of indexes of the items each item depends on.
+        """
+        inventory = self.inventory
+        printers = {}
+        dependencies = []
+        last_by_name = {}
+
+        for (i, (printer_or_class, params)) in enumerate(items):
+            deps = set()
+
+            if params['name'] in last_by_name:
+                deps.add(last_by_name[params['name']])
+            last_by_name[params['name']] = i
+
+            if printer_or_class == 'printer':
+                printers.setdefault(params['name'], []).append(i)
+            else:
+                members = set(params['class_members'])
+                if inventory.loaded():
+                    members.update(inventory.get_class_members(params['name']) or [])
+                for member in members:
+                    deps.update(printers.get(member, []))
+
+            dependencies.append(deps)
+
+        return dependencies
+
+    def _item_queries(self, items, dependencies, converged):
+        """
+        Works out which read-only commands the items will run to compare their settings, see CUPSQueryEngine.
+
+        Only the items that exist already and don't depend on other items are included, as the others are compared
+        against what those items change.
+
+        :param items: A list of (printer_or_class, params) tuples.
+        :param dependencies: A list with the set of indexes of the items each item depends on.
+        :param converged: The set of indexes of the items known to be converged.
+        :returns: A list of commands.
+        """
+        ppd_dir = None if self.server.is_remote() else CUPSPPD.queue_ppd_dir()
+        cmds = []
+
+        for (i, (printer_or_class, params)) in enumerate(items):
+            name = params['name']
+            if i in converged or dependencies[i] or params['state'] != 'present' or not self.inventory.exists(name) \
+                    or self.inventory.is_class(name) != (printer_or_class == 'class'):
+                continue
+
+            cmds.append(['lpoptions', '-p', name])
+
+            # The current values of the printer specific options are read from its PPD directly if possible
+            if printer_or_class == 'printer' and params['options'] and ppd_dir is None:
+                cmds.append(['lpoptions', '-p', name, '-l'])
+
+        return cmds
+
+    def _process_item(self, printer_or_class, params, skip_forced_options=False):
+        """
+        Processes a single printer or class item.
+
+        :param skip_forced_options: True if the item is pending, see CUPSStateStore.
+        :returns: The CUPSCommand used (None if it couldn't be created) and the result of the item.
+        """
+        cups_command = None
+
+        try:
+            cups_command = CUPSCommand(CUPSItemModule(self.module), params=params,
+                                       driver_cache=self.driver_cache, inventory=self.inventory,
+                                       ipp=self.ipp, config=self.config, queries=self.queries, timer=self.timer)
+            cups_command.skip_forced_options = skip_forced_options
+            item_result = cups_command.start_process()
+        except CUPSItemExit as e:
+            item_result = {'name': params['name'], 'printer_or_class': printer_or_class, 'state': params['state']}
+            item_result.update(e.result)
+
+            if cups_command is not None:
+                item_result.setdefault('changed', cups_command.changed)
+                cups_command.add_changes_to_result(item_result)
+                cups_command.add_journal_to_result(item_result)
+                item_result['timings'] = cups_command.timer.summary()
+            item_result.setdefault('changed', False)
+        except Exception as e:
+            item_result = {'name': params['name'], 'printer_or_class': printer_or_class, 'state': params['state'],
+                           'changed': cups_command is not None and cups_command.changed, 'failed': True,
+                           'msg': "Unexpected error: {0}".format(e)}
+
+        return cups_command, item_result
+
+    def _run_scheduled(self, items, dependencies, converged=None, pending=None):
+        """
+        Processes all items on a pool of up to self.workers threads, respecting their dependencies.
+
+        :param items: A list of (printer_or_class, params) tuples.
+        :param dependencies: A list with the set of indexes of the items each item depends on.
+        :param converged: Optional set of indexes of the items known to be converged. These are skipped unless an
+        item they depend on was changed.
+        :param pending: Optional set of indexes of the items that are pending, see CUPSStateStore.
+        :returns: A list of (CUPSCommand, result) tuples, in the same order as items.
+        """
+        converged = converged or set()
+        pending = pending or set()
+        results = [None] * len(items)
+        waiting_for = [set(deps) for deps in dependencies]
+        dependents = [[] for i in items]
+        for (i, deps) in enumerate(dependencies):
+            for dep in deps:
+                dependents[dep].append(i)
+
+        ready = [i for (i, deps) in enumerate(waiting_for) if not deps]
+        state = {'done': 0}
+        condition = threading.Condition()
+
+        def finish(i, outcome):
+            # Called with the condition held. Items depending on a failed item are skipped.
+            results[i] = outcome
+            state['done'] += 1
+
+            for dependent in dependents[i]:
+                waiting_for[dependent].discard(i)
+
+                if outcome[1].get('failed') and results[dependent] is None:
+                    (printer_or_class, params) = items[dependent]
+                    finish(dependent, (None, {'name': params['name'], 'printer_or_class': printer_or_class,
+                                              'state': params['state'], 'changed': False, 'failed': True,
+                                              'msg': "Skipped as '{0}' failed.".format(items[i][1]['name'])}))
+                elif not waiting_for[dependent] and results[dependent] is None and dependent not in ready:
+                    ready.append(dependent)
+
+            condition.notify_all()
+
+        def run_ready():
+            while True:
+                with condition:
+                    while not ready and state['done'] < len(items):
+                        condition.wait()
+
+                    if not ready:
+                        return
+
+                    i = ready.pop(0)
+                    skip = i in converged and not any(results[dep][1].get('changed') for dep in dependencies[i])
+
+                (printer_or_class, params) = items[i]
+                outcome = None
+                try:
+                    if skip:
+                        outcome = (None, {'name': params['name'], 'printer_or_class': printer_or_class,
+                                          'state': params['state'], 'changed': False, 'fingerprint_matched': True})
+                    else:
+                        outcome = self._process_item(printer_or_class, params, skip_forced_options=i in pending)
+                finally:
+                    # Even if the item took the whole thread down the other threads must not wait for it forever
+                    if outcome is None:
+                        outcome = (None, {'name': params['name'], 'printer_or_class': printer_or_class,
+                                          'state': params['state'], 'changed': False, 'failed': True,
+                                          'msg': "Processing of '{0}' was aborted.".format(params['name'])})
+                    with condition:
+                        finish(i, outcome)
+
+        workers = max(1, min(self.workers, len(items)))
+        if self.module.params['profile']:
+            workers = 1
+
+        if workers == 1:
+            run_ready()
+        else:
+            threads = [threading.Thread(target=run_ready) for i in range(workers)]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        return results
+
+    def start_process(self):
+        """
+        Processes every printer and class defined and then sets the default destination.
+
+        :returns: 'result' a hash containing the per item results under 'printers' and 'classes'.
+        """
+        result = {}
+
+        # Every item is validated before anything is changed
+        items = []
+        for (printer_or_class, item_list) in (('printer', self.printers), ('class', self.classes)):
+            for item in item_list:
+                items.append((printer_or_class, self.item_params(item, printer_or_class)))
+
+        # Items known to be converged are looked up before 'default' is taken out of them. Names defined more than once
+        # are always checked, as an item can undo what another one with the same name did.
+        converged = set()
+        pending = set()
+        fingerprints = {}
+        if self.state_store is not None:
+            names = [params['name'] for (printer_or_class, params) in items]
+            for (i, (printer_or_class, params)) in enumerate(items):
+                if names.count(params['name']) > 1:
+                    continue
+
+                fingerprints[i] = (CUPSStateStore.params_hash(params), self.state_store.fingerprint(params))
+                if self.state_store.matches(params['name'], *fingerprints[i]):
+                    converged.add(i)
+                elif self.state_store.pending(params['name'], *fingerprints[i]):
+                    pending.add(i)
+
+        # The default destination is set once everything else is in place
+        default = None
+        for (i, (printer_or_class, params)) in enumerate(items):
+            if params['default']:
+                default = i
+                params['default'] = False
+
+        if len(converged) < len(items):
+            # Loaded once up front so the items don't race to read it. Errors are reported by the items themselves.
+            try:
+                cups_command = CUPSCommand(CUPSItemModule(self.module), params=items[0][1],
+                                           driver_cache=self.driver_cache, inventory=self.inventory,
+                                           ipp=self.ipp, config=self.config, timer=self.timer)
+                cups_command.cups_get_inventory()
+            except CUPSItemExit:
+                pass
+
+        dependencies = self._item_dependencies(items)
+
+        if self.queries is not None and self.inventory.loaded():
+            with self.timer.phase('queries'):
+                self.queries.run(self._item_queries(items, dependencies, converged))
+
+        outcomes = self._run_scheduled(items, dependencies, converged, pending)
+
+        # The commands of the items in the order they were run, the default destination is only set afterwards
+        plan = []
+        for (cups_command, item_result) in outcomes:
+            plan.extend(item_result.get('plan', []))
+
+        if default is not None:
+            (cups_command, item_result) = outcomes[default]
+
+            if cups_command is not None and not item_result.get('failed') and items[default][1]['state'] == 'present':
+                try:
+                    cups_command.cups_item_set_default()
+                except CUPSItemExit as e:
+                    item_result.update(e.result)
+                item_result['changed'] = item_result.get('changed') or cups_command.changed
+                plan.extend(cups_command.plan[len(item_result.get('plan', [])):])
+                cups_command.add_changes_to_result(item_result)
+                cups_command.add_journal_to_result(item_result)
+                item_result['timings'] = cups_command.timer.summary()
+
+        result['printers'] = [r for ((printer_or_class, params), (c, r)) in zip(items, outcomes)
+                              if printer_or_class == 'printer']
+        result['classes'] = [r for ((printer_or_class, params), (c, r)) in zip(items, outcomes)
+                             if printer_or_class == 'class']
+
+        self.changed = any(r.get('changed') for (c, r) in outcomes)
+        result['changed'] = self.changed
+        result['timings'] = self.timer.summary()
+
+        if self.module.check_mode:
+            result['plan'] = plan
+
+        if self.state_store is not None and not self.module.check_mode:
+            # The items commands were run for are recorded with the state they left them in
+            self.state_store.refresh()
+
+            for (i, (cups_command, item_result)) in enumerate(outcomes):
+                if i not in fingerprints or item_result.get('fingerprint_matched'):
+                    continue
+
+                (params_hash, fingerprint) = fingerprints[i]
+                commands_run = cups_command is None or bool(cups_command.plan)
+                if commands_run:
+                    fingerprint = self.state_store.fingerprint(items[i][1])
+
+                self.state_store.update(items[i][1]['name'], params_hash, fingerprint,
+                                        failed=bool(item_result.get('failed')), commands_run=commands_run)
+            self.state_store.save()
+
+        failed = [r['name'] for (c, r) in outcomes if r.get('failed')]
+        if failed:
+            result['msg'] = "Failed to process {0} of {1} printers/classes: {2}.".format(len(failed), len(items),
+                                                                                          ", ".join(failed))
+            self.module.fail_json(**result)
+
+        return result
+
+
+# ===========================================
+
+
+class CUPSFactsCommand(object):
+    """
+        Gathers the printers and classes of CUPS as facts, see gather_facts.
+
+        The printers and classes are listed with a single inventory read (see CUPSCommand.cups_get_inventory). The
+        sections asked for are read by a CUPSCommand per printer or class, the same way they're read to be compared,
+        see CUPSCommand.cups_item_get_facts. Their lpoptions commands are run ahead of time by the query engine, at
+        most query_concurrency at a time. Nothing is changed.
+    """
+
+    SECTIONS = ['attributes', 'members', 'driver_options']
+
+    def __init__(self, module):
+        """
+        Assigns module vars to object.
+        """
+        self.module = module
+
+        subset = module.params['gather_facts']
+        unknown = [s for s in subset if s != 'all' and s not in self.SECTIONS]
+        if unknown:
+            module.fail_json(msg="Unsupported gather_facts: {0}. Supported are: all, {1}."
+                             .format(", ".join(unknown), ", ".join(self.SECTIONS)))
+
+        self.sections = [s for s in self.SECTIONS if 'all' in subset or s in subset]
+        self.names = module.params['gather_names'] or ['*']
+
+        self.timer = CUPSTimer()
+
+        self.server = CUPSServer.from_module(module)
+
+        # The stored driver catalog is fingerprinted with the local driver directories, see CUPSDriverCache
+        driver_cache_path = None if self.server.is_remote() else module.params['driver_cache']
+
+        self.driver_cache = CUPSDriverCache(module, driver_cache_path)
+        self.inventory = CUPSInventory()
+
+        self.ipp = None
+        if module.params['backend'] == 'ipp':
+            self.ipp = CUPSIPPBackend(module, server=self.server)
+
+        self.config = None
+        if module.params['config_dir']:
+            self.config = CUPSConfigReader(module, module.params['config_dir'])
+
+        self.queries = CUPSQueryEngine.from_module(module)
+
+    def item_command(self, name, printer_or_class):
+        """
+        :param name: Name of the printer or class.
+        :param printer_or_class: Whether name is a 'printer' or a 'class'.
+        :returns: A CUPSCommand reading the printer or class, sharing the inventory and backends of this object.
+        """
+        params = dict((k, copy.deepcopy(spec.get('default'))) for (k, spec) in CUPS_ITEM_ARGUMENT_SPEC.items())
+        params.update({'name': name, 'printer_or_class': printer_or_class, 'purge': False})
+
+        return CUPSCommand(self.module, params=params, driver_cache=self.driver_cache, inventory=self.inventory,
+                           ipp=self.ipp, config=self.config, queries=self.queries, timer=self.timer)
+
+    def _item_queries(self, names):
+        """
+        Works out which read-only commands gathering the given printers and classes will run, see CUPSQueryEngine.
+
+        :param names: The names of the printers and classes to gather.
+        :returns: A list of commands.
+        """
+        ppd_dir = None if self.server.is_remote() else CUPSPPD.queue_ppd_dir()
+        cmds = []
+
+        for name in names:
+            if 'attributes' in self.sections:
+                cmds.append(['lpoptions', '-p', name])
+
+            # The current values of the printer specific options are read from its PPD directly if possible
+            if 'driver_options' in self.sections and not self.inventory.is_class(name) and ppd_dir is None:
+                cmds.append(['lpoptions', '-p', name, '-l'])
+
+        return cmds
+
+    def start_process(self):
+        """
+        Gathers the printers and classes matching gather_names.
+
+        :returns: 'result' a hash holding the facts under ansible_facts.cups, see RETURN.
+        """
+        cups_command = self.item_command(None, 'printer')
+        cups_command.cups_get_inventory()
+
+        names = [name for name in self.inventory.names()
+                 if any(CUPSCommand.cups_item_matches(name, selector) for selector in self.names)]
+
+        if self.queries is not None:
+            with self.timer.phase('queries'):
+                self.queries.run(self._item_queries(names))
+
+        facts = {'default': self.inventory.default, 'printers': {}, 'classes': {}}
+
+        for name in names:
+            printer_or_class = 'class' if self.inventory.is_class(name) else 'printer'
+
+            cups_command = self.item_command(name, printer_or_class)
+            facts['classes' if printer_or_class == 'class' else 'printers'][name] = \
+                cups_command.cups_item_get_facts(self.sections)
+
+        return {'changed': False, 'ansible_facts': {'cups': facts}, 'timings': self.timer.summary()}
+
+
 # ===========================================
 
 
@@ -1143,41 +5766,70 @@ def main():
     First an Ansible Module is defined with the variable definitions and default values.
     Then a CUPSCommand is created using using this module. CUPSCommand populates its own values with the module vars.
 
+    If a 'printers' and/or 'classes' list is given a CUPSBulkCommand is used instead, which runs a CUPSCommand for
+    every item within this one module run. If gather_facts is given a CUPSFactsCommand is used, which only reads.
+
     This CUPSCommand's start_process() method is called to begin processing the information provided to the module.
+    If profile is defined this happens under cProfile and the statistics are dumped to that file afterwards.
 
     Records the rc, out, err values of the commands run above and accordingly exists the module and sends the status
     back to to Ansible using module.exit_json().
     """
+    argument_spec = dict(
+        purge=dict(required=False, default=False, type='bool'),
+        printers=dict(required=False, default=None, type='list'),
+        classes=dict(required=False, default=None, type='list'),
+        driver_cache=dict(required=False, default=None, type='path'),
+        backend=dict(required=False, default='lpadmin', choices=['lpadmin', 'ipp'], type='str'),
+        server=dict(required=False, default=None, type='str'),
+        port=dict(required=False, default=631, type='int'),
+        encryption=dict(required=False, default='ifrequested', choices=CUPSServer.ENCRYPTIONS, type='str'),
+        username=dict(required=False, default=None, type='str'),
+        password=dict(required=False, default=None, type='str', no_log=True),
+        validate_certs=dict(required=False, default=True, type='bool'),
+        server_concurrency=dict(required=False, default=8, type='int'),
+        config_dir=dict(required=False, default=None, type='path'),
+        state_file=dict(required=False, default=None, type='path'),
+        remove=dict(required=False, default=None, type='list'),
+        exclude=dict(required=False, default=[], type='list'),
+        workers=dict(required=False, default=4, type='int'),
+        query_concurrency=dict(required=False, default=8, type='int'),
+        query_timeout=dict(required=False, default=60, type='int'),
+        journal_limit=dict(required=False, default=200, type='int'),
+        journal_output_limit=dict(required=False, default=1024, type='int'),
+        legacy_output=dict(required=False, default=False, type='bool'),
+        profile=dict(required=False, default=None, type='path'),
+        gather_facts=dict(required=False, default=None, type='list'),
+        gather_names=dict(required=False, default=['*'], type='list'),
+    )
+    argument_spec.update(CUPS_ITEM_ARGUMENT_SPEC)
+
     module = AnsibleModule(
-        argument_spec=dict(
-            state=dict(required=False, default='present', choices=['present', 'absent'], type='str'),
-            driver=dict(required=False, default='model', choices=['model', 'ppd'], type='str'),
-            purge=dict(required=False, default=False, type='bool'),
-            name=dict(required=False, type='str'),
-            printer_or_class=dict(default='printer', required=False, type='str', choices=['printer', 'class']),
-            uri=dict(required=False, default=None, type='str'),
-            enabled=dict(required=False, default=True, type='bool'),
-            shared=dict(required=False, default=False, type='bool'),
-            default=dict(required=False, default=False, type='bool'),
-            model=dict(required=False, default=None, type='str'),
-            info=dict(required=False, default=None, type='str'),
-            location=dict(required=False, default=None, type='str'),
-            assign_cups_policy=dict(required=False, default=None, type='str'),
-            class_members=dict(required=False, default=[], type='list'),
-            report_ipp_supply_levels=dict(required=False, default=True, type='bool'),
-            report_snmp_supply_levels=dict(required=False, default=True, type='bool'),
-            job_kb_limit=dict(required=False, default=None, type='int'),
-            job_quota_limit=dict(required=False, default=None, type='int'),
-            job_page_limit=dict(required=False, default=None, type='int'),
-            options=dict(required=False, default={}, type='dict'),
-        ),
+        argument_spec=argument_spec,
         supports_check_mode=True,
-        required_one_of=[['name', 'purge']],
-        mutually_exclusive=[['name', 'purge']]
+        required_one_of=[['name', 'purge', 'printers', 'classes', 'remove', 'gather_facts']],
+        mutually_exclusive=[['name', 'purge', 'printers', 'remove', 'gather_facts'],
+                            ['name', 'purge', 'classes', 'remove', 'gather_facts']]
     )
 
-    cups_command = CUPSCommand(module)
-    result_info = cups_command.start_process()
+    if module.params['gather_facts'] is not None:
+        cups_command = CUPSFactsCommand(module)
+    elif module.params['printers'] is not None or module.params['classes'] is not None:
+        cups_command = CUPSBulkCommand(module)
+    else:
+        cups_command = CUPSCommand(module)
+
+    if module.params['profile']:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            result_info = cups_command.start_process()
+        finally:
+            profiler.disable()
+            profiler.dump_stats(module.params['profile'])
+    else:
+        result_info = cups_command.start_process()
+
     module.exit_json(**result_info)
 
 # Import statements at the bottom as per Ansible best practices.
@@ -0,0 +1,279 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+(c) 2016, Hitesh Prabhakar <HP41@GitHub>
+
+This file is part of Ansible
+
+This module is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This software is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this software.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import fnmatch
+import gzip
+import tempfile
+import threading
+import zlib
+
+
+# ===========================================
+
+
+DOCUMENTATION = '''
+---
+module: cups_ppd_sync
+author:
+    - "Hitesh Prabhakar <H41P@GitHub>"
+short_description: Decompresses a tree of gzipped PPD files in place incrementally.
+description:
+    - Decompresses the gzipped PPDs (.ppd.gz) found in a directory tree on the host in place, replacing the .gz files
+      like 'gzip --decompress' does.
+    - A PPD is only written if it's new or its content changed, by a pool of worker threads. Every PPD is written
+      to a temporary file first and then moved in place, so cupsd and cups_lpadmin (driver=ppd) never see a partly
+      written one and can use it as soon as this module is done.
+    - A run in which no gzipped PPD is found is a single pass over the tree.
+version_added: "2.1"
+notes: []
+requirements: []
+options:
+    src:
+        description:
+            - The directory on the host to look for PPDs in, including its subdirectories.
+        required: true
+    patterns:
+        description:
+            - Glob patterns the file names of the PPDs match, case is ignored. A matching name ending in .gz is
+              decompressed to the same name without the .gz.
+        required: false
+        default: ["*.ppd", "*.ppd.gz"]
+    mode:
+        description:
+            - The mode of the decompressed PPDs, eg. '0644'.
+        required: false
+        default: "0644"
+    workers:
+        description:
+            - The maximum number of PPDs decompressed and written at the same time.
+        required: false
+        default: 4
+'''
+
+EXAMPLES = '''
+# Decompress the gzipped PPDs of a driver package in place
+- cups_ppd_sync:
+    src: /opt/OpenPrinting-Ricoh/ppds/Ricoh
+    workers: 8
+'''
+
+RETURN = '''
+synced:
+    description: The paths of the PPDs that were written (or would have been in check mode).
+    returned: always
+    type: list
+    sample: ["/opt/OpenPrinting-Ricoh/ppds/Ricoh/Ricoh-Aficio_MP_C3003-Postscript-Ricoh.ppd"]
+total:
+    description: The number of PPDs found in src.
+    returned: always
+    type: int
+    sample: 2412
+'''
+
+
+# ===========================================
+
+
+class CUPSPPDSync(object):
+    """
+        Decompresses the gzipped PPDs of a directory tree in place incrementally.
+
+        For every gzipped PPD of src a job is worked out: its source and its target next to it without the .gz. PPDs
+        that aren't compressed have nothing to do and are skipped right away. The jobs are handed to a pool of
+        'workers' threads, which decompress the source, only write the target if its content differs and remove the
+        source afterwards.
+    """
+
+    def __init__(self, module):
+        """
+        Assigns module vars to object.
+        """
+        self.module = module
+
+        self.src = os.path.abspath(module.params['src'])
+        self.patterns = [p.lower() for p in module.params['patterns'] or []]
+        self.workers = module.params['workers']
+        self.check_mode = module.check_mode
+
+        mode = module.params['mode']
+        try:
+            self.mode = mode if isinstance(mode, int) else int(str(mode), 8)
+        except ValueError:
+            self.module.fail_json(msg="Invalid mode '{0}', it must be octal, eg. '0644'.".format(mode))
+
+        if not os.path.isdir(self.src):
+            self.module.fail_json(msg="Source directory '{0}' doesn't exist.".format(self.src))
+
+    @staticmethod
+    def _read(path, compressed):
+        """
+        A static method to read the content of a PPD.
+
+        :param compressed: True if the file is gzipped.
+        :returns: The content as bytes.
+        """
+        if compressed:
+            f = gzip.open(path, 'rb')
+        else:
+            f = open(path, 'rb')
+
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def find_jobs(self):
+        """
+        Walks src for the PPDs matching the patterns.
+
+        :returns: A list of the source path and the target path of every gzipped PPD. And the number of PPDs found.
+        """
+        jobs = []
+        total = 0
+
+        for (dirpath, dirnames, filenames) in os.walk(self.src):
+            dirnames.sort()
+
+            for filename in sorted(filenames):
+                if not any(fnmatch.fnmatch(filename.lower(), p) for p in self.patterns):
+                    continue
+                total += 1
+
+                if not filename.lower().endswith('.gz'):
+                    continue
+
+                source = os.path.join(dirpath, filename)
+                jobs.append((source, source[:-3]))
+
+        return jobs, total
+
+    def _deploy(self, source, target):
+        """
+        Decompresses a single PPD, unless its target has the same content already.
+
+        :returns: Whether the target was (or in check mode would have been) written.
+        """
+        content = CUPSPPDSync._read(source, True)
+
+        if os.path.exists(target):
+            if content == CUPSPPDSync._read(target, False):
+                if (os.stat(target).st_mode & 0o7777) == self.mode:
+                    return False
+                if not self.check_mode:
+                    os.chmod(target, self.mode)
+                return True
+
+        if self.check_mode:
+            return True
+
+        (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.ppd-sync-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.chmod(tmp_path, self.mode)
+            os.rename(tmp_path, target)
+        except (IOError, OSError):
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        return True
+
+    def sync(self):
+        """
+        Decompresses all gzipped PPDs, see CUPSPPDSync.
+
+        :returns: A hash of changed, synced and total.
+        """
+        (pending, total) = self.find_jobs()
+
+        synced = []
+        errors = []
+        lock = threading.Lock()
+
+        def deploy_pending():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    (source, target) = pending.pop(0)
+
+                try:
+                    written = self._deploy(source, target)
+                except (IOError, OSError, EOFError, zlib.error) as e:
+                    with lock:
+                        errors.append("{0}: {1}".format(source, e))
+                    continue
+
+                # The gzipped source is replaced by the decompressed PPD, which isn't a job any more
+                if not self.check_mode:
+                    os.unlink(source)
+
+                with lock:
+                    if written:
+                        synced.append(target)
+
+        workers = max(1, min(self.workers, len(pending)))
+        if workers == 1:
+            deploy_pending()
+        else:
+            threads = [threading.Thread(target=deploy_pending) for i in range(workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        result = {'changed': bool(synced), 'synced': sorted(synced), 'total': total}
+
+        if errors:
+            result['msg'] = "Failed to decompress {0} PPDs: {1}".format(len(errors), "; ".join(sorted(errors)))
+            self.module.fail_json(**result)
+
+        return result
+
+
+# ===========================================
+
+
+def main():
+    """
+    main function that populates this Ansible module with variables and decompresses the PPDs.
+    """
+    module = AnsibleModule(
+        argument_spec=dict(
+            src=dict(required=True, type='path'),
+            patterns=dict(required=False, default=['*.ppd', '*.ppd.gz'], type='list'),
+            mode=dict(required=False, default='0644'),
+            workers=dict(required=False, default=4, type='int'),
+        ),
+        supports_check_mode=True,
+    )
+
+    result = CUPSPPDSync(module).sync()
+
+    module.exit_json(**result)
+
+# Import statements at the bottom as per Ansible best practices.
+from ansible.module_utils.basic import *
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+"""
+Benchmarks how cups_lpadmin scales with the number of printers and classes.
+
+The module is run as Ansible runs it (python library/cups_lpadmin.py <args file>, so Ansible has to be installed)
+against the stand-in CUPS tools of fakecups.py, which are put first on PATH. For every number of printers given in
+--sizes four scenarios are run one after the other on the same fake CUPS server:
+    fresh: Nothing is installed yet, every printer and class gets installed.
+    converged: Everything is installed as defined already, nothing should change.
+    drifted: Every 10th printer got its location changed and every class lost its first member behind the module's
+             back, only those need to be fixed.
+    reconverged: The drift has been fixed, so like converged nothing should change.
+
+The printers are spread over at most --classes classes, fewer if needed to give every class at least two members so
+the drift of its membership is one the module has to fix.
+
+For every run the number of CUPS commands forked (per command and in total), the wall time, the peak memory of the
+module process and the phase timings reported by the module are printed, eg:
+    python tests/benchmark/benchmark.py --sizes 10,1000 --classes 10 --drivers 5000 --latency 0.01
+
+Every run is also checked for the behaviour expected of its scenario, see check_row. The script exits non-zero if any
+run failed or misbehaved, so it can be used as a test.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+MODULE = os.path.join(BENCHMARK_DIR, '..', '..', 'library', 'cups_lpadmin.py')
+
+COMMANDS = ['lpstat', 'lpinfo', 'lpoptions', 'lpadmin']
+SCENARIOS = ['fresh', 'converged', 'drifted', 'reconverged']
+
+
+def desired_state(printers, classes, drivers):
+    """
+    :returns: The printers and classes parameters of cups_lpadmin for the given number of printers and at most the
+    given number of classes, each with at least two members.
+    """
+    printer_items = []
+    for i in range(printers):
+        printer_items.append({
+            'name': 'Printer{0:05d}'.format(i),
+            'uri': 'socket://10.{0}.{1}.{2}'.format(i // 65536, i // 256 % 256, i % 256),
+            'model': 'drv:///fake/model-{0}.ppd'.format(i % drivers),
+            'location': 'Floor {0}'.format(i % 20),
+            'info': 'Benchmark printer {0}'.format(i),
+            'options': {'PageSize': 'A4'} if i % 2 else {},
+        })
+
+    classes = min(classes, printers // 2)
+
+    class_items = []
+    for i in range(classes):
+        members = [p['name'] for p in printer_items[i::classes]]
+        if members:
+            class_items.append({'name': 'Class{0:03d}'.format(i), 'class_members': members})
+
+    return printer_items, class_items
+
+
+def drift(state_path):
+    """
+    Changes the fake CUPS state behind the module's back.
+
+    :returns: The number of printers and classes changed.
+    """
+    with open(state_path) as f:
+        state = json.load(f)
+
+    changed = 0
+    for (i, name) in enumerate(sorted(state['printers'])):
+        if i % 10 == 0:
+            state['printers'][name]['location'] = 'Somewhere else'
+            changed += 1
+
+    for cups_class in state['classes'].values():
+        if len(cups_class['members']) > 1:
+            cups_class['members'].pop(0)
+            changed += 1
+
+    with open(state_path, 'w') as f:
+        json.dump(state, f)
+
+    return changed
+
+
+def make_bin_dir(path, python):
+    """
+    Creates the wrapper scripts named after the CUPS tools that run fakecups.py.
+    """
+    os.makedirs(path)
+    for command in COMMANDS:
+        wrapper = os.path.join(path, command)
+        with open(wrapper, 'w') as f:
+            f.write('#!/bin/sh\nexec "{0}" "{1}" {2} "$@"\n'
+                    .format(python, os.path.join(BENCHMARK_DIR, 'fakecups.py'), command))
+        os.chmod(wrapper, 0o755)
+
+
+def run_module(python, args, work_dir, env):
+    """
+    Runs cups_lpadmin once.
+
+    :returns: The parsed result of the module, the wall time and the peak memory of the run in KB. The peak memory is
+    the largest resident set size of the module process and the fake CUPS tools it ran.
+    """
+    args_path = os.path.join(work_dir, 'args.json')
+    with open(args_path, 'w') as f:
+        json.dump({'ANSIBLE_MODULE_ARGS': args}, f)
+
+    out_path = os.path.join(work_dir, 'module.out')
+    with open(out_path, 'w') as out:
+        start = time.time()
+        process = subprocess.Popen([python, MODULE, args_path], stdout=out, stderr=subprocess.STDOUT,
+                                   env=env, cwd=work_dir)
+        (pid, status, rusage) = os.wait4(process.pid, 0)
+        wall = time.time() - start
+
+    with open(out_path) as f:
+        out = f.read()
+
+    try:
+        result = json.loads(out[out.index('{'):])
+    except ValueError:
+        result = {'failed': True, 'msg': out.strip()[-2000:]}
+
+    return result, wall, rusage.ru_maxrss
+
+
+def count_forks(log_path):
+    """
+    :returns: A hash of the number of invocations per CUPS command logged by fakecups.py.
+    """
+    counts = dict((command, 0) for command in COMMANDS)
+    if os.path.exists(log_path):
+        with open(log_path) as f:
+            for line in f:
+                counts[json.loads(line)[0]] += 1
+    return counts
+
+
+def benchmark(options):
+    """
+    Runs all scenarios for every size.
+
+    :returns: A list of result rows.
+    """
+    rows = []
+
+    for size in options.sizes:
+        work_dir = tempfile.mkdtemp(prefix='cups-benchmark-')
+        try:
+            bin_dir = os.path.join(work_dir, 'bin')
+            make_bin_dir(bin_dir, options.stub_python)
+
+            state_path = os.path.join(work_dir, 'state.json')
+            log_path = os.path.join(work_dir, 'commands.log')
+
+            env = dict(os.environ)
+            env.update({
+                'PATH': '{0}{1}{2}'.format(bin_dir, os.pathsep, env.get('PATH', '')),
+                'FAKE_CUPS_STATE': state_path,
+                'FAKE_CUPS_LOG': log_path,
+                'FAKE_CUPS_DRIVERS': str(options.drivers),
+                'FAKE_CUPS_LATENCY': str(options.latency),
+            })
+
+            (printers, classes) = desired_state(size, options.classes, options.drivers)
+            args = {'printers': printers, 'classes': classes, 'workers': options.workers}
+            args.update(options.module_args)
+
+            if options.config_dir:
+                env['FAKE_CUPS_ETC'] = os.path.join(work_dir, 'etc')
+                args['config_dir'] = env['FAKE_CUPS_ETC']
+
+            if options.driver_cache:
+                args['driver_cache'] = os.path.join(work_dir, 'drivers.idx')
+
+            converged = None
+            for scenario in SCENARIOS:
+                drifted = 0
+                if scenario == 'drifted':
+                    drifted = drift(state_path)
+                    if options.config_dir:
+                        # Let fakecups.py rewrite the configuration files from the drifted state
+                        subprocess.check_call([os.path.join(bin_dir, 'lpadmin')], env=env)
+
+                if os.path.exists(log_path):
+                    os.unlink(log_path)
+
+                (result, wall, peak_kb) = run_module(options.module_python, args, work_dir, env)
+                forks = count_forks(log_path)
+
+                rows.append({
+                    'queues': size,
+                    'classes': len(classes),
+                    'scenario': scenario,
+                    'drifted': drifted,
+                    'forks': forks,
+                    'total_forks': sum(forks.values()),
+                    'wall': round(wall, 3),
+                    'peak_mb': round(peak_kb / 1024.0, 1),
+                    'changed': result.get('changed'),
+                    'failed': bool(result.get('failed')),
+                    'msg': result.get('msg'),
+                    'timings': result.get('timings', {}),
+                })
+                rows[-1]['problems'] = check_row(rows[-1], args, converged=converged)
+                if scenario == 'converged':
+                    converged = rows[-1]
+                print_row(rows[-1])
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return rows
+
+
+def check_row(row, args, converged=None):
+    """
+    Checks a run for the behaviour expected of its scenario:
+        converged: Nothing is changed.
+        drifted: The drift is fixed, i.e. something is changed.
+        reconverged: Nothing is changed, and no CUPS command is run more often than in the converged run. Unless
+                     state_file or driver_cache kept something from the runs before, both runs face the same state, so
+                     they have to run every CUPS command exactly as often.
+        With driver_cache defined the driver catalog is read with lpinfo at most once per run.
+
+    :param row: The result row of the run.
+    :param args: The parameters the module was run with.
+    :param converged: The result row of the converged run of the same size, if there was one.
+    :returns: A list of descriptions of what's wrong, empty if the run behaved as expected.
+    """
+    problems = []
+
+    if row['failed']:
+        return problems
+
+    if row['scenario'] in ('converged', 'reconverged') and row['changed'] is not False:
+        problems.append('{0} run reported changed={1}'.format(row['scenario'], row['changed']))
+
+    if row['scenario'] == 'reconverged' and converged is not None and not converged['failed']:
+        exact = not (args.get('state_file') or args.get('driver_cache'))
+        for command in COMMANDS:
+            (forks, expected) = (row['forks'][command], converged['forks'][command])
+            if forks > expected or (exact and forks != expected):
+                problems.append('{0} was run {1} times, {2} times in the converged run'
+                                .format(command, forks, expected))
+
+    if row['scenario'] == 'drifted' and row['changed'] is not True:
+        problems.append('drifted run reported changed={0}'.format(row['changed']))
+
+    if args.get('driver_cache') and row['forks']['lpinfo'] > 1:
+        problems.append('lpinfo was run {0} times despite driver_cache'.format(row['forks']['lpinfo']))
+
+    return problems
+
+
+HEADER = '{0:>7} {1:>10} {2:>7} {3:>7} {4:>9} {5:>7} {6:>9} {7:>9} {8:>8} {9:>8}  {10}'
+
+
+def print_header():
+    print(HEADER.format('queues', 'scenario', 'lpstat', 'lpinfo', 'lpoptions', 'lpadmin', 'forks', 'wall(s)',
+                        'peak(MB)', 'changed', 'phases(s)'))
+
+
+def print_row(row):
+    phases = ' '.join('{0}={1}'.format(k, row['timings'][k]) for k in sorted(row['timings']))
+    print(HEADER.format(row['queues'], row['scenario'], row['forks']['lpstat'], row['forks']['lpinfo'],
+                        row['forks']['lpoptions'], row['forks']['lpadmin'], row['total_forks'], row['wall'],
+                        row['peak_mb'], 'FAILED' if row['failed'] else str(row['changed']), phases))
+    if row['failed']:
+        print('        {0}'.format(row['msg']))
+    for problem in row['problems']:
+        print('        UNEXPECTED: {0}'.format(problem))
+    sys.stdout.flush()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmark cups_lpadmin against fake CUPS command-line tools.')
+    parser.add_argument('--sizes', default='10,1000,10000',
+                        help='Comma separated numbers of printers to benchmark. Default=10,1000,10000')
+    parser.add_argument('--classes', type=int, default=10,
+                        help='Number of classes, the printers are spread over them. Default=10')
+    parser.add_argument('--drivers', type=int, default=5000,
+                        help="Number of drivers reported by 'lpinfo -m'. Default=5000")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds every fake CUPS command waits, to simulate a busy cupsd. Default=0')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Value of the workers parameter of cups_lpadmin. Default=4')
+    parser.add_argument('--config-dir', action='store_true',
+                        help='Have the fake tools write printers.conf/classes.conf and use config_dir.')
+    parser.add_argument('--driver-cache', action='store_true',
+                        help='Cache the driver catalog in a driver_cache file, read by the later scenarios.')
+    parser.add_argument('--module-arg', action='append', default=[], metavar='KEY=JSON',
+                        help='Extra cups_lpadmin parameter, eg. driver_cache="/tmp/drivers.json". Repeatable.')
+    parser.add_argument('--module-python', default=sys.executable,
+                        help='Python interpreter to run the module with. Default=the one running this script')
+    parser.add_argument('--stub-python', default=sys.executable,
+                        help='Python interpreter to run fakecups.py with. Default=the one running this script')
+    parser.add_argument('--json', metavar='PATH', help='Also write all results to this file as JSON.')
+
+    options = parser.parse_args(argv)
+    options.sizes = [int(size) for size in options.sizes.split(',')]
+
+    options.module_args = {}
+    for module_arg in options.module_arg:
+        (key, sep, value) = module_arg.partition('=')
+        options.module_args[key] = json.loads(value)
+
+    return options
+
+
+def main(argv=None):
+    options = parse_args(argv if argv is not None else sys.argv[1:])
+
+    print_header()
+    rows = benchmark(options)
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(rows, f, indent=1)
+
+    return 1 if any(row['failed'] or row['problems'] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+"""
+Stand-in for the CUPS command-line tools used by cups_lpadmin: lpadmin, lpstat, lpinfo and lpoptions.
+
+Usage: fakecups.py <lpadmin|lpstat|lpinfo|lpoptions> [arguments of that command]
+
+benchmark.py puts small wrapper scripts named after the CUPS tools on PATH that call this script. Instead of talking to
+cupsd the printers and classes are kept in a JSON state file, so the module can be run against any number of queues
+without a real CUPS server. It's configured through environment variables:
+    FAKE_CUPS_STATE: Path of the JSON state file (required). An empty or missing file is an empty CUPS server.
+    FAKE_CUPS_LOG: Path of a file every invocation is appended to as a JSON list, one per line. Used to count forks.
+    FAKE_CUPS_DRIVERS: Number of drivers 'lpinfo -m' reports, named drv:///fake/model-<n>.ppd. Default=20
+    FAKE_CUPS_LATENCY: Seconds every invocation waits before it does anything, to simulate a busy cupsd. Default=0
+    FAKE_CUPS_ETC: If defined printers.conf, classes.conf and ppd/<name>.ppd are written to this directory after
+                   every change, like cupsd does, for use with the config_dir option of cups_lpadmin.
+
+Only the arguments and the output format cups_lpadmin relies on are implemented.
+"""
+
+import contextlib
+import fcntl
+import json
+import os
+import sys
+import time
+
+# Options every fake PPD offers as (option, label, choices, default choice)
+PPD_OPTIONS = [
+    ('PageSize', 'Page Size', ['Letter', 'A4', 'Legal'], 'Letter'),
+    ('Duplex', '2-Sided Printing', ['None', 'DuplexNoTumble', 'DuplexTumble'], 'None'),
+]
+
+SUPPLY_OPTIONS = ['cupsIPPSupplies', 'cupsSNMPSupplies']
+
+
+def drivers():
+    """
+    Yields the fake driver catalog.
+    """
+    for i in range(int(os.environ.get('FAKE_CUPS_DRIVERS', '20'))):
+        yield {
+            'name': 'drv:///fake/model-{0}.ppd'.format(i),
+            'natural_language': 'en',
+            'make-and-model': 'Fake Model {0}'.format(i),
+            'device-id': 'MFG:Fake;MDL:Model {0};'.format(i),
+        }
+
+
+def find_driver(name):
+    """
+    :returns: The driver named name or None, without building the whole catalog.
+    """
+    prefix = 'drv:///fake/model-'
+    if name.startswith(prefix) and name.endswith('.ppd'):
+        number = name[len(prefix):-len('.ppd')]
+        if number.isdigit() and int(number) < int(os.environ.get('FAKE_CUPS_DRIVERS', '20')):
+            return {'name': name, 'make-and-model': 'Fake Model {0}'.format(number)}
+    return None
+
+
+def new_printer():
+    return {'uri': '', 'info': '', 'location': '', 'shared': 'true', 'enabled': False, 'accepting': False,
+            'make': 'Remote Printer', 'options': {}, 'ppd': {}}
+
+
+def new_class():
+    return {'members': [], 'info': '', 'location': '', 'shared': 'true', 'enabled': False, 'accepting': False,
+            'options': {}}
+
+
+def load_state(f):
+    f.seek(0)
+    data = f.read()
+    if not data.strip():
+        return {'printers': {}, 'classes': {}, 'default': None}
+    return json.loads(data)
+
+
+def save_state(f, state):
+    f.seek(0)
+    f.truncate()
+    f.write(json.dumps(state))
+    f.flush()
+
+    if os.environ.get('FAKE_CUPS_ETC'):
+        write_config(os.environ['FAKE_CUPS_ETC'], state)
+
+
+def ppd_text(printer):
+    lines = ['*PPD-Adobe: "4.3"', '*NickName: "{0}"'.format(printer['make'])]
+    if printer.get('pc_file_name'):
+        lines.append('*PCFileName: "{0}"'.format(printer['pc_file_name']))
+    for (option, label, choices, default) in PPD_OPTIONS:
+        lines.append('*OpenUI *{0}/{1}: PickOne'.format(option, label))
+        lines.append('*Default{0}: {1}'.format(option, printer['ppd'][option]))
+        lines.extend('*{0} {1}/{1}: "<<>>setpagedevice"'.format(option, choice) for choice in choices)
+        lines.append('*CloseUI: *{0}'.format(option))
+    for option in SUPPLY_OPTIONS:
+        if option in printer['options']:
+            lines.append('*{0}: {1}'.format(option, printer['options'][option].capitalize()))
+    return '\n'.join(lines) + '\n'
+
+
+@contextlib.contextmanager
+def replace_file(path):
+    """
+    Opens a new file that replaces path once it's written, like cupsd does, so readers never see it half-written.
+    """
+    with open(path + '.N', 'w') as f:
+        yield f
+    os.rename(path + '.N', path)
+
+
+def write_config(etc, state):
+    """
+    Writes printers.conf, classes.conf and the PPDs the way cupsd does.
+    """
+    def yes_no(value):
+        return 'Yes' if value in (True, 'true') else 'No'
+
+    # Every printer and class is stamped with the time of the write, so nothing can rely on these being stable
+    now = int(time.time())
+
+    ppd_dir = os.path.join(etc, 'ppd')
+    if not os.path.isdir(ppd_dir):
+        os.makedirs(ppd_dir)
+
+    with replace_file(os.path.join(etc, 'printers.conf')) as f:
+        f.write('# Printer configuration file for CUPS v2.2.1\n# Written by cupsd\n')
+        for (name, printer) in sorted(state['printers'].items()):
+            section = 'DefaultPrinter' if state['default'] == name else 'Printer'
+            f.write('<{0} {1}>\n'.format(section, name))
+            f.write('Info {0}\nLocation {1}\nMakeModel {2}\nDeviceURI {3}\nState {4}\nStateTime {5}\nConfigTime {5}\n'
+                    .format(printer['info'] or name, printer['location'], printer['make'], printer['uri'],
+                            'Idle' if printer['enabled'] else 'Stopped', now))
+            f.write('Type 8425668\nAccepting {0}\nShared {1}\nJobSheets none none\n'
+                    .format(yes_no(printer['accepting']), yes_no(printer['shared'])))
+            for (option, value) in sorted(printer['options'].items()):
+                if not printer['ppd'] or option not in SUPPLY_OPTIONS:
+                    f.write('Option {0} {1}\n'.format(option, value))
+            f.write('</{0}>\n'.format(section))
+
+            ppd = os.path.join(ppd_dir, '{0}.ppd'.format(name))
+            if printer['ppd']:
+                with replace_file(ppd) as ppd_file:
+                    ppd_file.write(ppd_text(printer))
+            elif os.path.exists(ppd):
+                os.unlink(ppd)
+
+    with replace_file(os.path.join(etc, 'classes.conf')) as f:
+        f.write('# Class configuration file for CUPS v2.2.1\n# Written by cupsd\n')
+        for (name, cups_class) in sorted(state['classes'].items()):
+            section = 'DefaultClass' if state['default'] == name else 'Class'
+            f.write('<{0} {1}>\n'.format(section, name))
+            f.write('Info {0}\nLocation {1}\nState {2}\nStateTime {5}\nConfigTime {5}\nAccepting {3}\nShared {4}\n'
+                    .format(cups_class['info'] or name, cups_class['location'],
+                            'Idle' if cups_class['enabled'] else 'Stopped', yes_no(cups_class['accepting']),
+                            yes_no(cups_class['shared']), now))
+            for (option, value) in sorted(cups_class['options'].items()):
+                f.write('Option {0} {1}\n'.format(option, value))
+            f.write(''.join('Printer {0}\n'.format(member) for member in cups_class['members']))
+            f.write('</{0}>\n'.format(section))
+
+
+def get_destination(state, name):
+    return state['printers'].get(name) or state['classes'].get(name)
+
+
+def remove_destination(state, name):
+    if name in state['printers']:
+        del state['printers'][name]
+        for class_name in list(state['classes']):
+            members = state['classes'][class_name]['members']
+            if name in members:
+                members.remove(name)
+            if not members:
+                del state['classes'][class_name]
+    else:
+        del state['classes'][name]
+
+    if state['default'] == name:
+        state['default'] = None
+
+
+def lpadmin(state, args):
+    name = None
+    args = list(args)
+
+    while args:
+        arg = args.pop(0)
+
+        if arg == '-E' and name is not None:
+            dest = get_destination(state, name)
+            dest['enabled'] = dest['accepting'] = True
+            continue
+
+        if not args:
+            return 1, '', "lpadmin: Expected an argument after '{0}'.\n".format(arg)
+        value = args.pop(0)
+
+        if arg == '-h':
+            continue
+
+        if arg == '-x':
+            if get_destination(state, value) is None:
+                return 1, '', 'lpadmin: The printer or class does not exist.\n'
+            remove_destination(state, value)
+            continue
+
+        if arg == '-d':
+            if get_destination(state, value) is None:
+                return 1, '', 'lpadmin: The printer or class does not exist.\n'
+            state['default'] = value
+            continue
+
+        if arg == '-p':
+            name = value
+            if get_destination(state, name) is None:
+                state['printers'][name] = new_printer()
+            continue
+
+        dest = get_destination(state, name) if name is not None else None
+        if dest is None:
+            return 1, '', 'lpadmin: No printer specified.\n'
+
+        if arg == '-v':
+            dest['uri'] = value
+        elif arg == '-D':
+            dest['info'] = value
+        elif arg == '-L':
+            dest['location'] = value
+        elif arg in ('-m', '-P'):
+            if value == 'raw':
+                dest['make'] = 'Remote Printer'
+                dest['pc_file_name'] = None
+                dest['ppd'] = {}
+                continue
+
+            if arg == '-m':
+                driver = find_driver(value)
+                if driver is None:
+                    return 1, '', 'lpadmin: Unable to copy PPD file.\n'
+                dest['make'] = driver['make-and-model']
+                dest['pc_file_name'] = value.rsplit('/', 1)[1].upper() if value.startswith('drv:///') else None
+            else:
+                dest['pc_file_name'] = None
+                dest['make'] = 'PPD {0}'.format(os.path.basename(value))
+            dest['ppd'] = dict((option, default) for (option, label, choices, default) in PPD_OPTIONS)
+        elif arg == '-o':
+            (option, sep, option_value) = value.partition('=')
+            if option == 'printer-is-shared':
+                dest['shared'] = option_value
+            elif option in dest.get('ppd', {}):
+                dest['ppd'][option] = option_value
+            else:
+                dest['options'][option] = option_value
+        elif arg == '-c':
+            cups_class = state['classes'].setdefault(value, new_class())
+            if name not in cups_class['members']:
+                cups_class['members'].append(name)
+        elif arg == '-r':
+            cups_class = state['classes'].get(value)
+            if cups_class is None or name not in cups_class['members']:
+                return 1, '', 'lpadmin: Printer not member of class.\n'
+            cups_class['members'].remove(name)
+            if not cups_class['members']:
+                del state['classes'][value]
+        else:
+            return 1, '', "lpadmin: Unknown option '{0}'.\n".format(arg)
+
+    return 0, '', ''
+
+
+def lpstat(state, args):
+    out = []
+    destinations = sorted(list(state['printers']) + list(state['classes']))
+
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+
+        if arg == '-h':
+            args.pop(0)
+            continue
+
+        names = destinations
+        if args and not args[0].startswith('-'):
+            names = [args.pop(0)]
+            if get_destination(state, names[0]) is None:
+                return 1, ''.join(out), 'lpstat: Invalid destination name in list "{0}".\n'.format(names[0])
+
+        if arg == '-d':
+            if state['default']:
+                out.append('system default destination: {0}\n'.format(state['default']))
+            else:
+                out.append('no system default destination\n')
+            continue
+
+        for name in names:
+            dest = get_destination(state, name)
+
+            if arg == '-p':
+                if dest['enabled']:
+                    out.append('printer {0} is idle.  enabled since Fri 01 Jan 2016 12:00:00 AM UTC\n'.format(name))
+                else:
+                    out.append('printer {0} disabled since Fri 01 Jan 2016 12:00:00 AM UTC -\n'
+                               '\treason unknown\n'.format(name))
+            elif arg == '-a':
+                if dest['accepting']:
+                    out.append('{0} accepting requests since Fri 01 Jan 2016 12:00:00 AM UTC\n'.format(name))
+                else:
+                    out.append('{0} not accepting requests since Fri 01 Jan 2016 12:00:00 AM UTC -\n'
+                               '\tRejecting Jobs\n'.format(name))
+            elif arg == '-v' and name in state['printers']:
+                out.append('device for {0}: {1}\n'.format(name, dest['uri']))
+            elif arg == '-c' and name in state['classes']:
+                out.append('members of class {0}:\n'.format(name))
+                out.extend('\t{0}\n'.format(member) for member in dest['members'])
+
+    if not destinations and not out:
+        return 1, '', 'lpstat: No destinations added.\n'
+
+    return 0, ''.join(out), ''
+
+
+def lpoptions(state, args):
+    name = args[args.index('-p') + 1]
+    dest = get_destination(state, name)
+
+    if dest is None:
+        return 1, '', 'lpoptions: The printer or class does not exist.\n'
+
+    if '-l' in args:
+        out = []
+        for (option, label, choices, default) in PPD_OPTIONS:
+            if option in dest.get('ppd', {}):
+                values = [('*' + choice) if choice == dest['ppd'][option] else choice for choice in choices]
+                out.append('{0}/{1}: {2}\n'.format(option, label, ' '.join(values)))
+        return 0, ''.join(out), ''
+
+    options = {
+        'copies': '1',
+        'finishings': '3',
+        'job-sheets': 'none,none',
+        'printer-info': dest['info'] or name,
+        'printer-is-accepting-jobs': 'true' if dest['accepting'] else 'false',
+        'printer-is-shared': dest['shared'],
+        'printer-location': dest['location'],
+        'printer-make-and-model': dest.get('make', 'Local Printer Class'),
+        'printer-state': '3' if dest['enabled'] else '5',
+    }
+    if name in state['classes']:
+        options['member-names'] = ','.join(dest['members'])
+    else:
+        options['device-uri'] = dest['uri']
+
+    def quote(value):
+        return "'{0}'".format(value) if ' ' in value or not value else value
+
+    return 0, ' '.join('{0}={1}'.format(k, quote(v)) for (k, v) in sorted(options.items())) + '\n', ''
+
+
+def lpinfo(state, args):
+    schemes = None
+    if '--include-schemes' in args:
+        schemes = args[args.index('--include-schemes') + 1].split(',')
+
+    # Written as it goes, like cups-driverd sends its reply, so readers can stop early
+    found = False
+    for driver in drivers():
+        if schemes is not None and driver['name'].split('://', 1)[0] not in schemes:
+            continue
+        found = True
+        sys.stdout.write('Model:  name = {0}\n'
+                         '        natural_language = {1}\n'
+                         '        make-and-model = {2}\n'
+                         '        device-id = {3}\n'
+                         .format(driver['name'], driver['natural_language'], driver['make-and-model'],
+                                 driver['device-id']))
+
+    if not found:
+        return 1, '', 'lpinfo: No drivers found.\n'
+    return 0, '', ''
+
+
+COMMANDS = {
+    'lpadmin': lpadmin,
+    'lpstat': lpstat,
+    'lpoptions': lpoptions,
+    'lpinfo': lpinfo,
+}
+
+
+def main():
+    command = sys.argv[1]
+    args = sys.argv[2:]
+
+    # The options selecting the server come first, see CUPSServer.command
+    while args and args[0] in ('-h', '-E'):
+        args = args[2:] if args[0] == '-h' else args[1:]
+
+    if os.environ.get('FAKE_CUPS_LOG'):
+        with open(os.environ['FAKE_CUPS_LOG'], 'a') as log:
+            log.write(json.dumps([command] + args) + '\n')
+
+    time.sleep(float(os.environ.get('FAKE_CUPS_LATENCY', '0')))
+
+    with open(os.environ['FAKE_CUPS_STATE'], 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        state = load_state(f)
+        (rc, out, err) = COMMANDS[command](state, args)
+        if command == 'lpadmin' and rc == 0:
+            save_state(f, state)
+
+    sys.stdout.write(out)
+    sys.stderr.write(err)
+    sys.exit(rc)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""
+Tests how cups_config makes the CUPS services pick up a changed configuration, without a service manager.
+
+The module is loaded from library/cups_config.py, so Ansible has to be installed, eg:
+    python -m unittest discover -s tests/unit
+"""
+
+import grp
+import os
+import pwd
+import shutil
+import sys
+import tempfile
+import unittest
+
+MODULE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'library', 'cups_config.py')
+
+
+def load_module():
+    """
+    :returns: cups_config loaded as a python module.
+    """
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source('cups_config', MODULE)
+
+    spec = importlib.util.spec_from_file_location('cups_config', MODULE)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['cups_config'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+cups_config = load_module()
+CUPSConfig = cups_config.CUPSConfig
+
+
+class FakeModule(object):
+    """
+    Stands in for the AnsibleModule, recording the commands run instead of running them.
+
+    'running' holds the services the service manager reports as running.
+    """
+
+    def __init__(self, systemctl=None, running=(), check_mode=False, **params):
+        self.params = {
+            'cupsd_conf': None,
+            'cups_browsed_conf': None,
+            'snmp_conf': None,
+            'etc_dir': '/etc/cups',
+            'owner': pwd.getpwuid(os.getuid()).pw_name,
+            'group': grp.getgrgid(os.getgid()).gr_name,
+            'mode': '0644',
+            'validate': False,
+            'reload': False,
+            'cups_service': 'cups',
+            'cups_browsed_service': 'cups-browsed',
+        }
+        self.params.update(params)
+        self.check_mode = check_mode
+        self.systemctl = systemctl
+        self.running = running
+        self.commands = []
+
+    def get_bin_path(self, name):
+        return self.systemctl if name == 'systemctl' else None
+
+    def run_command(self, args, **kwargs):
+        self.commands.append(args)
+
+        if args[0] == 'service' and args[2] == 'status':
+            return (0 if args[1] in self.running else 3), '', ''
+        if 'is-active' in args:
+            return (0 if args[-1] in self.running else 3), '', ''
+        return 0, '', ''
+
+    def fail_json(self, **kwargs):
+        raise AssertionError(kwargs['msg'])
+
+
+class TestCUPSConfigReload(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.etc_dir = os.path.join(self.tmp_dir, 'etc')
+        os.mkdir(self.etc_dir)
+
+        self.rendered = {}
+        for (param, filename, service) in CUPSConfig.FILES:
+            self.rendered[param] = os.path.join(self.tmp_dir, filename)
+            with open(self.rendered[param], 'w') as f:
+                f.write('# new {0}\n'.format(filename))
+
+        self.systemd_dir = CUPSConfig.SYSTEMD_DIR
+
+    def tearDown(self):
+        CUPSConfig.SYSTEMD_DIR = self.systemd_dir
+        shutil.rmtree(self.tmp_dir)
+
+    def install(self, systemd, **kwargs):
+        """
+        Runs cups_config on a host with or without systemd.
+
+        :returns: The result and the commands run.
+        """
+        # systemctl may be installed on a host that wasn't booted with systemd
+        CUPSConfig.SYSTEMD_DIR = self.tmp_dir if systemd else os.path.join(self.tmp_dir, 'missing')
+        module = FakeModule(systemctl='/bin/systemctl', etc_dir=self.etc_dir, **kwargs)
+
+        return CUPSConfig(module).install(), module.commands
+
+    def test_systemd_sends_hup_to_main_process(self):
+        (result, commands) = self.install(True, running=['cups', 'cups-browsed'],
+                                          cupsd_conf=self.rendered['cupsd_conf'],
+                                          cups_browsed_conf=self.rendered['cups_browsed_conf'])
+
+        self.assertEqual(result['reloaded'], ['cups', 'cups-browsed'])
+        self.assertEqual(commands, [
+            ['/bin/systemctl', 'is-active', '--quiet', 'cups'],
+            ['/bin/systemctl', 'kill', '--signal=HUP', '--kill-who=main', 'cups'],
+            ['/bin/systemctl', 'is-active', '--quiet', 'cups-browsed'],
+            ['/bin/systemctl', 'restart', 'cups-browsed'],
+        ])
+
+    def test_without_systemd_uses_service(self):
+        (result, commands) = self.install(False, running=['cups'], cupsd_conf=self.rendered['cupsd_conf'])
+
+        self.assertEqual(result['reloaded'], ['cups'])
+        self.assertEqual(commands, [['service', 'cups', 'status'], ['service', 'cups', 'reload']])
+
+    def test_stopped_service_is_left_alone(self):
+        (result, commands) = self.install(True, cupsd_conf=self.rendered['cupsd_conf'])
+
+        self.assertTrue(result['changed'])
+        self.assertEqual(result['reloaded'], [])
+        self.assertEqual(commands, [['/bin/systemctl', 'is-active', '--quiet', 'cups']])
+
+    def test_unchanged_configuration_reloads_nothing(self):
+        self.install(True, running=['cups'], snmp_conf=self.rendered['snmp_conf'])
+        (result, commands) = self.install(True, running=['cups'], snmp_conf=self.rendered['snmp_conf'])
+
+        self.assertFalse(result['changed'])
+        self.assertEqual(commands, [])
+
+    def test_reload_without_changes(self):
+        (result, commands) = self.install(True, running=['cups'], reload=True)
+
+        self.assertEqual(result['reloaded'], ['cups'])
+        self.assertEqual(commands[-1], ['/bin/systemctl', 'kill', '--signal=HUP', '--kill-who=main', 'cups'])
+
+    def test_check_mode_reports_without_reloading(self):
+        (result, commands) = self.install(True, running=['cups'], check_mode=True,
+                                          cupsd_conf=self.rendered['cupsd_conf'])
+
+        self.assertEqual(result['reloaded'], ['cups'])
+        self.assertEqual(commands, [['/bin/systemctl', 'is-active', '--quiet', 'cups']])
+        self.assertFalse(os.path.exists(os.path.join(self.etc_dir, 'cupsd.conf')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+"""
+Tests that a failing printer or class item of CUPSBulkCommand only fails itself, without a cupsd.
+
+The module is loaded from library/cups_lpadmin.py, so Ansible has to be installed, eg:
+    python -m unittest discover -s tests/unit
+"""
+
+import copy
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from test_cups_lpadmin_ipp import cups_lpadmin
+
+CUPSBulkCommand = cups_lpadmin.CUPSBulkCommand
+CUPSIPPBackend = cups_lpadmin.CUPSIPPBackend
+CUPSTimer = cups_lpadmin.CUPSTimer
+
+# The module parameters CUPSBulkCommand reads besides the ones of CUPS_ITEM_ARGUMENT_SPEC, with their defaults
+BULK_PARAMS = {
+    'purge': False,
+    'printers': None,
+    'classes': None,
+    'driver_cache': None,
+    'backend': 'lpadmin',
+    'server': None,
+    'port': 631,
+    'encryption': 'ifrequested',
+    'username': None,
+    'password': None,
+    'validate_certs': True,
+    'server_concurrency': 8,
+    'config_dir': None,
+    'state_file': None,
+    'remove': None,
+    'exclude': [],
+    'workers': 4,
+    'query_concurrency': 8,
+    'query_timeout': 60,
+    'journal_limit': 200,
+    'journal_output_limit': 1024,
+    'legacy_output': False,
+    'profile': None,
+}
+
+# How long a bulk run may take before it's considered hanging
+TIMEOUT = 30
+
+
+class ExitingModule(object):
+    """
+    Stands in for the AnsibleModule. Like the real one it exits with SystemExit when failing, keeping the result.
+    """
+
+    check_mode = False
+
+    def __init__(self, **params):
+        self.params = dict((k, copy.deepcopy(spec.get('default')))
+                           for (k, spec) in cups_lpadmin.CUPS_ITEM_ARGUMENT_SPEC.items())
+        self.params.update(BULK_PARAMS)
+        self.params.update(params)
+        self.failures = []
+
+    def boolean(self, value):
+        return value in (True, 'true', 'True', 'yes', 'on', '1', 1)
+
+    def run_command(self, args, **kwargs):
+        raise AssertionError("No command should be run, got {0}".format(args))
+
+    def fail_json(self, **kwargs):
+        self.failures.append(kwargs)
+        raise SystemExit(1)
+
+
+def run_in_thread(function, *args):
+    """
+    Runs a function in a thread of its own, failing the test if it doesn't return in time.
+
+    :returns: The result of the function or the SystemExit raised by it.
+    """
+    outcome = []
+
+    def target():
+        try:
+            outcome.append(function(*args))
+        except SystemExit as e:
+            outcome.append(e)
+
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    thread.join(TIMEOUT)
+
+    if thread.is_alive():
+        raise AssertionError("The bulk run didn't finish within {0} seconds.".format(TIMEOUT))
+
+    return outcome[0]
+
+
+class TestBulkItemIsolation(unittest.TestCase):
+
+    def setUp(self):
+        cups_lpadmin.CUPSServer.servers.clear()
+
+    def test_failing_shared_ipp_backend_fails_only_the_items(self):
+        module = ExitingModule(backend='ipp', workers=2,
+                               printers=[{'name': 'Office', 'uri': 'socket://10.0.0.1', 'model': 'raw'},
+                                         {'name': 'Lab', 'uri': 'socket://10.0.0.2', 'model': 'raw'}])
+        bulk = CUPSBulkCommand(module)
+
+        def unreachable(method, path, body=None, content_type=None):
+            bulk.ipp.module.fail_json(msg="Unable to talk IPP to CUPS at 'localhost': Connection refused")
+        bulk.ipp._http = unreachable
+
+        self.assertIsInstance(run_in_thread(bulk.start_process), SystemExit)
+
+        # The module only fails once, at the end, reporting every item
+        self.assertEqual(len(module.failures), 1)
+        result = module.failures[0]
+        self.assertEqual([r['name'] for r in result['printers']], ['Office', 'Lab'])
+        for r in result['printers']:
+            self.assertTrue(r['failed'])
+            self.assertIn('Unable to talk IPP', r['msg'])
+
+    def test_aborted_item_does_not_block_the_others(self):
+        bulk = CUPSBulkCommand(ExitingModule(workers=2))
+
+        def process_item(printer_or_class, params, skip_forced_options=False):
+            if params['name'] == 'Office':
+                raise SystemExit(1)
+            return None, {'name': params['name'], 'printer_or_class': printer_or_class, 'changed': False}
+        bulk._process_item = process_item
+
+        items = [('printer', {'name': 'Office', 'state': 'present'}), ('printer', {'name': 'Lab', 'state': 'present'}),
+                 ('class', {'name': 'Floor1', 'state': 'present'})]
+        results = run_in_thread(bulk._run_scheduled, items, [set(), set(), set([0])])
+
+        self.assertEqual([r['name'] for (c, r) in results], ['Office', 'Lab', 'Floor1'])
+        self.assertTrue(results[0][1]['failed'])
+        self.assertFalse(results[1][1].get('failed'))
+        self.assertEqual(results[2][1]['msg'], "Skipped as 'Office' failed.")
+
+
+class FakeClock(object):
+    """
+    Stands in for the time module of cups_lpadmin, returning the time set.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+
+class TestBulkTimings(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.time = cups_lpadmin.time
+        cups_lpadmin.time = self.clock
+
+    def tearDown(self):
+        cups_lpadmin.time = self.time
+
+    def test_phases_of_items_processed_at_once_count_wall_time(self):
+        bulk = CUPSTimer()
+        (office, lab) = (CUPSTimer(parent=bulk), CUPSTimer(parent=bulk))
+
+        with office.phase('comparison'):
+            self.clock.now = 1.0
+            with lab.phase('comparison'):
+                self.clock.now = 3.0
+                with lab.phase('driver_lookup'):
+                    self.clock.now = 4.0
+            self.clock.now = 5.0
+
+        self.assertEqual(office.timings['comparison'], 5.0)
+        self.assertEqual(lab.timings['comparison'], 2.0)
+        self.assertEqual(lab.timings['driver_lookup'], 1.0)
+
+        # Both items compared from 0 to 5, not for 7 seconds
+        summary = bulk.summary()
+        self.assertEqual(summary['comparison'], 5.0)
+        self.assertEqual(summary['driver_lookup'], 1.0)
+        self.assertEqual(summary['total'], 5.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Tests that CUPSComparison of cups_lpadmin stops at the first check deciding a setting, without a cupsd.
+
+The module is loaded from library/cups_lpadmin.py, so Ansible has to be installed, eg:
+    python -m unittest discover -s tests/unit
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from test_cups_lpadmin_ipp import cups_lpadmin
+
+CUPSComparison = cups_lpadmin.CUPSComparison
+CUPSPPD = cups_lpadmin.CUPSPPD
+
+
+def lookup_driver():
+    raise AssertionError("The driver shouldn't be looked up")
+
+
+class TestComparison(unittest.TestCase):
+
+    def test_cheaper_check_skips_driver_lookup(self):
+        comparison = CUPSComparison()
+        comparison.add('printer-make-and-model', 'driver', lambda: 'Fake Model 1', lookup_driver)
+        comparison.add('printer-make-and-model', 'file', lambda: 'Fake Model 1', lambda: 'Fake Model 1')
+        comparison.add('printer-location', 'query', lambda: 'Room 1', lambda: 'Room 2')
+
+        self.assertEqual(comparison.run(), {'printer-location': 'Room 2'})
+        self.assertEqual(comparison.report, [
+            {'name': 'printer-location', 'cost': 'query', 'outcome': 'mismatch'},
+            {'name': 'printer-make-and-model', 'cost': 'file', 'outcome': 'match'},
+            {'name': 'printer-make-and-model', 'cost': 'driver', 'outcome': 'skipped'},
+        ])
+
+    def test_undetermined_check_falls_back(self):
+        comparison = CUPSComparison()
+        comparison.add('printer-make-and-model', 'file', lambda: 'Fake Model 1', lambda: None)
+        comparison.add('printer-make-and-model', 'driver', lambda: 'Fake Model 1', lambda: 'Fake Model 2')
+
+        self.assertEqual(comparison.run(), {'printer-make-and-model': 'Fake Model 2'})
+        self.assertEqual([c['outcome'] for c in comparison.report], ['undetermined', 'mismatch'])
+
+
+class TestPPDKeyword(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_keyword(self):
+        path = os.path.join(self.tmp_dir, 'Office.ppd')
+        with open(path, 'w') as f:
+            f.write('*PPD-Adobe: "4.3"\n*NickName: "HP LaserJet Series PCL 4/5"\n*PCFileName: "LASERJET.PPD"\n')
+
+        self.assertEqual(CUPSPPD.get_keyword(path, 'PCFileName'), 'LASERJET.PPD')
+        self.assertEqual(CUPSPPD.get_nickname(path), 'HP LaserJet Series PCL 4/5')
+        self.assertIsNone(CUPSPPD.get_keyword(path, 'ModelName'))
+        self.assertIsNone(CUPSPPD.get_keyword(os.path.join(self.tmp_dir, 'Lab.ppd'), 'PCFileName'))
+
+
+if __name__ == '__main__':
+    unittest.main()
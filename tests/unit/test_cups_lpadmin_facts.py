@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""
+Tests how cups_lpadmin gathers the printers and classes of CUPS as facts (gather_facts), without a cupsd.
+
+The module is loaded from library/cups_lpadmin.py, so Ansible has to be installed, eg:
+    python -m unittest discover -s tests/unit
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from test_cups_lpadmin_ipp import cups_lpadmin
+from test_cups_lpadmin_bulk import ExitingModule
+
+CUPSFactsCommand = cups_lpadmin.CUPSFactsCommand
+
+PRINTERS_CONF = '''# Printer configuration file for CUPS v2.2.1
+<DefaultPrinter Office>
+Info Front desk
+Location Room 1
+MakeModel Fake Model 1
+DeviceURI socket://10.0.0.1
+State Idle
+Accepting Yes
+Shared No
+</DefaultPrinter>
+<Printer Lab>
+Info Lab
+DeviceURI socket://10.0.0.2
+State Stopped
+Accepting No
+Shared Yes
+</Printer>
+'''
+
+CLASSES_CONF = '''# Class configuration file for CUPS v2.2.1
+<Class Floor1>
+Info First floor
+State Idle
+Accepting Yes
+Printer Office
+Printer Lab
+</Class>
+'''
+
+OFFICE_PPD = '''*PPD-Adobe: "4.3"
+*NickName: "Fake Model 1"
+*OpenUI *PageSize/Page Size: PickOne
+*DefaultPageSize: A4
+*PageSize Letter/US Letter: "<</PageSize[612 792]>>setpagedevice"
+*PageSize A4/A4: "<</PageSize[595 842]>>setpagedevice"
+*CloseUI: *PageSize
+*OpenUI *Duplex/2-Sided Printing: PickOne
+*DefaultDuplex: None
+*Duplex None/Off: ""
+*Duplex DuplexNoTumble/Long Edge: ""
+*CloseUI: *Duplex
+'''
+
+
+class TestGatherFacts(unittest.TestCase):
+
+    def setUp(self):
+        cups_lpadmin.CUPSServer.servers.clear()
+
+        self.cups_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.cups_dir, 'ppd'))
+
+        for (filename, text) in (('printers.conf', PRINTERS_CONF), ('classes.conf', CLASSES_CONF),
+                                 (os.path.join('ppd', 'Office.ppd'), OFFICE_PPD)):
+            with open(os.path.join(self.cups_dir, filename), 'w') as f:
+                f.write(text)
+
+    def tearDown(self):
+        shutil.rmtree(self.cups_dir)
+
+    def gather(self, sections, names=None):
+        module = ExitingModule(config_dir=self.cups_dir, gather_facts=sections, gather_names=names or ['*'])
+        result = CUPSFactsCommand(module).start_process()
+
+        self.assertFalse(result['changed'])
+        return result['ansible_facts']['cups']
+
+    def test_all_sections(self):
+        facts = self.gather(['all'])
+
+        self.assertEqual(facts['default'], 'Office')
+        self.assertEqual(sorted(facts['printers']), ['Lab', 'Office'])
+
+        office = facts['printers']['Office']
+        self.assertEqual(office['device-uri'], 'socket://10.0.0.1')
+        self.assertTrue(office['enabled'])
+        self.assertTrue(office['accepting'])
+        self.assertEqual(office['attributes']['printer-location'], 'Room 1')
+        self.assertEqual(office['attributes']['printer-make-and-model'], 'Fake Model 1')
+        self.assertEqual(office['driver_options'], {'PageSize': 'A4', 'Duplex': 'None'})
+
+        lab = facts['printers']['Lab']
+        self.assertFalse(lab['enabled'])
+        self.assertFalse(lab['accepting'])
+        self.assertEqual(lab['driver_options'], {})
+
+        self.assertEqual(facts['classes']['Floor1']['members'], ['Office', 'Lab'])
+        self.assertNotIn('driver_options', facts['classes']['Floor1'])
+
+    def test_sections_and_names_limit_the_facts(self):
+        facts = self.gather(['members'], names=['re:^L.*', 'Floor*'])
+
+        self.assertEqual(facts['default'], 'Office')
+        self.assertEqual(list(facts['printers']), ['Lab'])
+        self.assertEqual(facts['printers']['Lab'],
+                         {'device-uri': 'socket://10.0.0.2', 'enabled': False, 'accepting': False})
+        self.assertEqual(facts['classes']['Floor1'], {'enabled': True, 'accepting': True,
+                                                      'members': ['Office', 'Lab']})
+
+    def test_unknown_section(self):
+        module = ExitingModule(config_dir=self.cups_dir, gather_facts=['everything'], gather_names=['*'])
+
+        self.assertRaises(SystemExit, CUPSFactsCommand, module)
+        self.assertIn('Unsupported gather_facts', module.failures[0]['msg'])
+
+
+if __name__ == '__main__':
+    unittest.main()
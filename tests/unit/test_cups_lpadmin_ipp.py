@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests the IPP backend of cups_lpadmin (CUPSIPPBackend) without a cupsd.
+
+The IPP encoding is checked byte for byte and against a CUPS-Get-Printers response the way cupsd sends it. The
+translation of lpadmin arguments into IPP operations is checked by recording the requests instead of sending them.
+
+The module is loaded from library/cups_lpadmin.py, so Ansible has to be installed, eg:
+    python -m unittest discover -s tests/unit
+"""
+
+import os
+import struct
+import sys
+import unittest
+
+MODULE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'library', 'cups_lpadmin.py')
+
+
+def load_module():
+    """
+    :returns: cups_lpadmin loaded as a python module.
+    """
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source('cups_lpadmin', MODULE)
+
+    spec = importlib.util.spec_from_file_location('cups_lpadmin', MODULE)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['cups_lpadmin'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+cups_lpadmin = load_module()
+CUPSIPPBackend = cups_lpadmin.CUPSIPPBackend
+
+# A CUPS-Get-Printers response of cupsd listing a printer and a class with two members, for the requested-attributes
+# CUPSIPPBackend.get_printers asks for. cupsd sends printer-type as an enum.
+CUPS_GET_PRINTERS_RESPONSE = (
+    b'\x02\x00'                                                 # version 2.0
+    b'\x00\x00'                                                 # successful-ok
+    b'\x00\x00\x00\x01'                                         # request-id
+    b'\x01'                                                     # operation-attributes-tag
+    b'\x47\x00\x12attributes-charset\x00\x05utf-8'
+    b'\x48\x00\x1battributes-natural-language\x00\x05en-us'
+    b'\x41\x00\x0estatus-message\x00\x0dsuccessful-ok'
+    b'\x04'                                                     # printer-attributes-tag
+    b'\x45\x00\x0adevice-uri\x00\x11socket://10.0.0.1'
+    b'\x42\x00\x0cprinter-name\x00\x06Office'
+    b'\x23\x00\x0dprinter-state\x00\x04\x00\x00\x00\x03'
+    b'\x22\x00\x19printer-is-accepting-jobs\x00\x01\x01'
+    b'\x23\x00\x0cprinter-type\x00\x04\x00\x00\x90\x4c'
+    b'\x04'                                                     # printer-attributes-tag
+    b'\x45\x00\x0adevice-uri\x00\x10file:///dev/null'
+    b'\x4a\x00\x0cmember-names\x00\x06Office'
+    b'\x4a\x00\x00\x00\x03Lab'                                  # additional value of member-names
+    b'\x42\x00\x0cprinter-name\x00\x06Floor1'
+    b'\x23\x00\x0dprinter-state\x00\x04\x00\x00\x00\x05'
+    b'\x22\x00\x19printer-is-accepting-jobs\x00\x01\x00'
+    b'\x23\x00\x0cprinter-type\x00\x04\x00\x00\x90\x05'
+    b'\x03'                                                     # end-of-attributes-tag
+)
+
+PPD = '''*PPD-Adobe: "4.3"
+*ModelName: "Test Printer"
+*DefaultPageSize: Letter
+*DefaultDuplex: None
+'''
+
+
+class FakeModule(object):
+    """
+    Stands in for the AnsibleModule, failing the test instead of exiting.
+    """
+
+    def fail_json(self, **kwargs):
+        raise AssertionError(kwargs['msg'])
+
+
+class RecordingBackend(CUPSIPPBackend):
+    """
+    A CUPSIPPBackend that records its requests instead of sending them to cupsd.
+
+    'destinations' holds the printers and classes of the fake cupsd by printer-uri, with their attribute hash, and
+    'ppds' the PPDs of printers by name.
+    """
+
+    def __init__(self, destinations=None, ppds=None):
+        CUPSIPPBackend.__init__(self, FakeModule())
+        self.destinations = destinations or {}
+        self.ppds = ppds or {}
+        self.requests = []
+
+    def request(self, operation, attributes, printer_attributes=None, path='/', document=None):
+        uri = dict((name, values) for (tag, name, values) in attributes).get('printer-uri')
+
+        if operation == self.GET_PRINTER_ATTRIBUTES:
+            # Get-Printer-Attributes with a printers URI finds classes too, like cupsd does
+            for (k, v) in self.destinations.items():
+                if k.rsplit('/', 1)[1] == uri.rsplit('/', 1)[1]:
+                    return 0, '', [v]
+            return self.STATUS_NOT_FOUND, 'Not found', []
+
+        self.requests.append({
+            'operation': operation,
+            'uri': uri,
+            'printer_attributes': printer_attributes,
+            'path': path,
+            'document': document,
+        })
+        return 0, '', []
+
+    def get_ppd(self, name):
+        return self.ppds.get(name)
+
+
+class TestIPPEncoding(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = CUPSIPPBackend(FakeModule())
+        self.backend.user = 'root'
+
+    def test_encode_attribute(self):
+        self.assertEqual(CUPSIPPBackend._encode_attribute(CUPSIPPBackend.TAG_NAME, 'printer-name', 'Office'),
+                         b'\x42\x00\x0cprinter-name\x00\x06Office')
+        self.assertEqual(CUPSIPPBackend._encode_attribute(CUPSIPPBackend.TAG_ENUM, 'printer-state', 3),
+                         b'\x23\x00\x0dprinter-state\x00\x04\x00\x00\x00\x03')
+        self.assertEqual(CUPSIPPBackend._encode_attribute(CUPSIPPBackend.TAG_BOOLEAN, 'printer-is-shared', False),
+                         b'\x22\x00\x11printer-is-shared\x00\x01\x00')
+        self.assertEqual(CUPSIPPBackend._encode_attribute(CUPSIPPBackend.TAG_KEYWORD, 'requested-attributes',
+                                                          ['printer-name', 'device-uri']),
+                         b'\x44\x00\x14requested-attributes\x00\x0cprinter-name'
+                         b'\x44\x00\x00\x00\x0adevice-uri')
+
+    def test_request_round_trip(self):
+        requested = ['printer-name', 'printer-type']
+        data = self.backend._encode_request(CUPSIPPBackend.CUPS_ADD_MODIFY_PRINTER,
+                                            [(CUPSIPPBackend.TAG_URI, 'printer-uri',
+                                              CUPSIPPBackend.destination_uri('Office')),
+                                             (CUPSIPPBackend.TAG_KEYWORD, 'requested-attributes', requested)],
+                                            [(CUPSIPPBackend.TAG_BOOLEAN, 'printer-is-shared', True),
+                                             (CUPSIPPBackend.TAG_ENUM, 'printer-state', 3)])
+
+        self.assertEqual(struct.unpack('>BBHI', data[:8]), (2, 0, CUPSIPPBackend.CUPS_ADD_MODIFY_PRINTER, 1))
+        self.assertEqual(data[-1:], b'\x03')
+
+        # A request has the same layout as a response, with the operation-id where the status-code is
+        (operation, groups) = CUPSIPPBackend._decode_response(data)
+
+        self.assertEqual(operation, CUPSIPPBackend.CUPS_ADD_MODIFY_PRINTER)
+        self.assertEqual(groups, [
+            (CUPSIPPBackend.TAG_OPERATION, {
+                'attributes-charset': ['utf-8'],
+                'attributes-natural-language': ['en'],
+                'printer-uri': ['ipp://localhost/printers/Office'],
+                'requested-attributes': requested,
+                'requesting-user-name': ['root'],
+            }),
+            (CUPSIPPBackend.TAG_PRINTER, {
+                'printer-is-shared': [True],
+                'printer-state': [3],
+            }),
+        ])
+
+        # Every request gets a request-id of its own
+        data = self.backend._encode_request(CUPSIPPBackend.CUPS_GET_PRINTERS, [])
+        self.assertEqual(struct.unpack('>I', data[4:8]), (2,))
+
+    def test_decode_cups_get_printers_response(self):
+        (status, groups) = CUPSIPPBackend._decode_response(CUPS_GET_PRINTERS_RESPONSE)
+
+        self.assertEqual(status, 0)
+        self.assertEqual([tag for (tag, attributes) in groups],
+                         [CUPSIPPBackend.TAG_OPERATION, CUPSIPPBackend.TAG_PRINTER, CUPSIPPBackend.TAG_PRINTER])
+        self.assertEqual(groups[0][1]['status-message'], ['successful-ok'])
+        self.assertEqual(groups[1][1], {
+            'device-uri': ['socket://10.0.0.1'],
+            'printer-name': ['Office'],
+            'printer-state': [3],
+            'printer-is-accepting-jobs': [True],
+            'printer-type': [0x904c],
+        })
+        self.assertEqual(groups[2][1], {
+            'device-uri': ['file:///dev/null'],
+            'member-names': ['Office', 'Lab'],
+            'printer-name': ['Floor1'],
+            'printer-state': [5],
+            'printer-is-accepting-jobs': [False],
+            'printer-type': [0x9005],
+        })
+        self.assertTrue(groups[2][1]['printer-type'][0] & CUPSIPPBackend.PRINTER_TYPE_CLASS)
+
+    def test_decode_skips_collections_and_out_of_band_values(self):
+        data = (
+            b'\x02\x00\x00\x00\x00\x00\x00\x01'
+            b'\x04'
+            b'\x34\x00\x09media-col\x00\x00'                       # begin-collection
+            b'\x4a\x00\x00\x00\x0amedia-size'                       # member-attr-name
+            b'\x34\x00\x00\x00\x00'
+            b'\x37\x00\x00\x00\x00'                                 # end-collection
+            b'\x37\x00\x00\x00\x00'
+            b'\x13\x00\x10printer-location\x00\x00'                 # no-value
+            b'\x35\x00\x0cprinter-info\x00\x0b\x00\x02en\x00\x05Front'    # textWithLanguage
+            b'\x03'
+        )
+
+        (status, groups) = CUPSIPPBackend._decode_response(data)
+
+        self.assertEqual(groups, [(CUPSIPPBackend.TAG_PRINTER, {
+            'printer-location': [None],
+            'printer-info': ['Front'],
+        })])
+
+    def test_destination_uri(self):
+        self.assertEqual(CUPSIPPBackend.destination_uri('Office'), 'ipp://localhost/printers/Office')
+        self.assertEqual(CUPSIPPBackend.destination_uri('Floor1', is_class=True), 'ipp://localhost/classes/Floor1')
+        self.assertEqual(CUPSIPPBackend.destination_uri(u'Réception 2'),
+                         'ipp://localhost/printers/R%C3%A9ception%202')
+
+
+class TestIPPLpadmin(unittest.TestCase):
+
+    OFFICE = 'ipp://localhost/printers/Office'
+    LAB = 'ipp://localhost/printers/Lab'
+    FLOOR1 = 'ipp://localhost/classes/Floor1'
+
+    # cupsd builds the member-uris of a class from the host and port it was reached at
+    OFFICE_MEMBER = 'ipp://localhost:631/printers/Office'
+    LAB_MEMBER = 'ipp://localhost:631/printers/Lab'
+
+    def setUp(self):
+        self.backend = RecordingBackend(
+            destinations={
+                self.OFFICE: {'printer-type': [0x904c]},
+                self.LAB: {'printer-type': [0x904c]},
+                self.FLOOR1: {'printer-type': [0x9005], 'member-uris': [self.OFFICE_MEMBER, self.LAB_MEMBER]},
+            },
+            ppds={'Office': PPD},
+        )
+
+    def assertRequests(self, args, expected):
+        """
+        Asserts that lpadmin succeeds for args and sends the expected operations with the expected printer-uri.
+        """
+        self.assertEqual(self.backend.lpadmin(args), (0, '', ''))
+        self.assertEqual([(r['operation'], r['uri']) for r in self.backend.requests], expected)
+        for r in self.backend.requests:
+            self.assertEqual(r['path'], '/admin/')
+
+    def test_add_printer(self):
+        self.assertRequests(['-p', 'New', '-E', '-v', 'socket://10.0.0.2', '-m', 'drv:///sample.drv/generic.ppd',
+                             '-D', 'Front desk', '-L', 'Room 1', '-o', 'printer-is-shared=false',
+                             '-o', 'printer-error-policy=retry-job', '-o', 'job-k-limit=1024'],
+                            [(CUPSIPPBackend.CUPS_ADD_MODIFY_PRINTER, 'ipp://localhost/printers/New')])
+
+        self.assertEqual(self.backend.requests[0]['printer_attributes'], [
+            (CUPSIPPBackend.TAG_ENUM, 'printer-state', 3),
+            (CUPSIPPBackend.TAG_BOOLEAN, 'printer-is-accepting-jobs', True),
+            (CUPSIPPBackend.TAG_URI, 'device-uri', 'socket://10.0.0.2'),
+            (CUPSIPPBackend.TAG_NAME, 'ppd-name', 'drv:///sample.drv/generic.ppd'),
+            (CUPSIPPBackend.TAG_TEXT, 'printer-info', 'Front desk'),
+            (CUPSIPPBackend.TAG_TEXT, 'printer-location', 'Room 1'),
+            (CUPSIPPBackend.TAG_BOOLEAN, 'printer-is-shared', False),
+            (CUPSIPPBackend.TAG_NAME, 'printer-error-policy', 'retry-job'),
+            (CUPSIPPBackend.TAG_INTEGER, 'job-k-limit', '1024'),
+        ])
+
+    def test_ppd_options_are_written_into_the_ppd(self):
+        self.assertRequests(['-p', 'Office', '-o', 'PageSize=A4', '-o', 'cupsIPPSupplies=false'],
+                            [(CUPSIPPBackend.CUPS_ADD_MODIFY_PRINTER, self.OFFICE)])
+
+        request = self.backend.requests[0]
+        self.assertEqual(request['printer_attributes'], [])
+        self.assertEqual(request['document'], PPD.replace('Letter', 'A4').encode('utf-8') +
+                         b'*cupsIPPSupplies: False\n')
+
+    def test_options_without_ppd_are_printer_defaults(self):
+        self.assertRequests(['-p', 'Lab', '-o', 'PageSize=A4'],
+                            [(CUPSIPPBackend.CUPS_ADD_MODIFY_PRINTER, self.LAB)])
+
+        self.assertEqual(self.backend.requests[0]['printer_attributes'],
+                         [(CUPSIPPBackend.TAG_TEXT, 'PageSize-default', 'A4')])
+
+    def test_delete_printer(self):
+        self.assertRequests(['-x', 'Office'], [(CUPSIPPBackend.CUPS_DELETE_PRINTER, self.OFFICE)])
+
+    def test_delete_class(self):
+        self.assertRequests(['-x', 'Floor1'], [(CUPSIPPBackend.CUPS_DELETE_CLASS, self.FLOOR1)])
+
+    def test_set_default(self):
+        self.assertRequests(['-d', 'Floor1'], [(CUPSIPPBackend.CUPS_SET_DEFAULT, self.FLOOR1)])
+
+    def test_add_to_class(self):
+        self.backend.destinations[self.FLOOR1]['member-uris'] = [self.OFFICE_MEMBER]
+
+        self.assertRequests(['-p', 'Lab', '-c', 'Floor1'], [(CUPSIPPBackend.CUPS_ADD_MODIFY_CLASS, self.FLOOR1)])
+
+        self.assertEqual(self.backend.requests[0]['printer_attributes'],
+                         [(CUPSIPPBackend.TAG_URI, 'member-uris', [self.OFFICE_MEMBER, self.LAB])])
+
+    def test_add_existing_member(self):
+        self.assertRequests(['-p', 'Lab', '-c', 'Floor1'], [])
+
+    def test_add_to_new_class(self):
+        self.assertRequests(['-p', 'Lab', '-c', 'Floor2'],
+                            [(CUPSIPPBackend.CUPS_ADD_MODIFY_CLASS, 'ipp://localhost/classes/Floor2')])
+
+        self.assertEqual(self.backend.requests[0]['printer_attributes'],
+                         [(CUPSIPPBackend.TAG_URI, 'member-uris', [self.LAB])])
+
+    def test_remove_from_class(self):
+        self.assertRequests(['-p', 'Office', '-r', 'Floor1'], [(CUPSIPPBackend.CUPS_ADD_MODIFY_CLASS, self.FLOOR1)])
+
+        self.assertEqual(self.backend.requests[0]['printer_attributes'],
+                         [(CUPSIPPBackend.TAG_URI, 'member-uris', [self.LAB_MEMBER])])
+
+    def test_remove_last_member_deletes_class(self):
+        self.backend.destinations[self.FLOOR1]['member-uris'] = [self.LAB_MEMBER]
+
+        self.assertRequests(['-p', 'Lab', '-r', 'Floor1'], [(CUPSIPPBackend.CUPS_DELETE_CLASS, self.FLOOR1)])
+
+    def test_errors(self):
+        (rc, out, err) = self.backend.lpadmin(['-p', 'Lab', '-r', 'Floor2'])
+        self.assertEqual(rc, 1)
+        self.assertIn("not a member of class 'Floor2'", err)
+
+        (rc, out, err) = self.backend.lpadmin(['-p', 'Lab', '-u', 'allow:all'])
+        self.assertEqual(rc, 1)
+        self.assertIn("Unsupported option '-u'", err)
+
+        (rc, out, err) = self.backend.lpadmin(['-p'])
+        self.assertEqual(rc, 1)
+
+        self.assertEqual(self.backend.requests, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
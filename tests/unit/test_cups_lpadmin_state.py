@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+Tests how CUPSStateStore of cups_lpadmin fingerprints the CUPS state of printers and classes, without a cupsd.
+
+The module is loaded from library/cups_lpadmin.py, so Ansible has to be installed, eg:
+    python -m unittest discover -s tests/unit
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from test_cups_lpadmin_ipp import cups_lpadmin
+
+CUPSStateStore = cups_lpadmin.CUPSStateStore
+
+PRINTERS_CONF = '''# Printer configuration file for CUPS v2.2.1
+<DefaultPrinter Office>
+Info Front desk
+Location Room 1
+DeviceURI socket://10.0.0.1
+State Idle
+StateTime {time}
+ConfigTime {time}
+Reason toner-low
+Attribute marker-levels {level}
+Accepting Yes
+Shared No
+</DefaultPrinter>
+<Printer Lab>
+Info Lab
+Location {location}
+DeviceURI socket://10.0.0.2
+State Idle
+StateTime {time}
+ConfigTime {time}
+Accepting Yes
+Shared No
+</Printer>
+'''
+
+
+class FakeDriverCache(object):
+
+    def fingerprint(self):
+        return 'drivers'
+
+
+class TestStateStore(unittest.TestCase):
+
+    def setUp(self):
+        self.cups_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.cups_dir, 'ppd'))
+        self.store = CUPSStateStore(None, os.path.join(self.cups_dir, 'state.json'), self.cups_dir,
+                                    FakeDriverCache())
+
+    def tearDown(self):
+        shutil.rmtree(self.cups_dir)
+
+    def write(self, time=1, level=80, location='Room 2', ppd=None):
+        """
+        Writes printers.conf and the PPD of Office and makes the store read them again.
+        """
+        with open(os.path.join(self.cups_dir, 'printers.conf'), 'w') as f:
+            f.write(PRINTERS_CONF.format(time=time, level=level, location=location))
+
+        if ppd is not None:
+            with open(os.path.join(self.cups_dir, 'ppd', 'Office.ppd'), 'w') as f:
+                f.write(ppd)
+
+        self.store.refresh()
+
+    def fingerprints(self):
+        return [self.store.fingerprint({'name': name, 'driver': 'model', 'model': None})
+                for name in ('Office', 'Lab')]
+
+    def test_no_printers_conf(self):
+        self.assertEqual(self.fingerprints(), [None, None])
+
+    def test_volatile_lines_are_ignored(self):
+        self.write(time=1, level=80, ppd='*DefaultPageSize: A4\n')
+        before = self.fingerprints()
+
+        # cupsd rewrote everything, eg. as options were re-sent, without anything changing
+        self.write(time=2, level=20, ppd='*DefaultPageSize: A4\n')
+        self.assertEqual(self.fingerprints(), before)
+
+    def test_only_the_changed_destination_changes(self):
+        self.write(ppd='*DefaultPageSize: A4\n')
+        (office, lab) = self.fingerprints()
+
+        self.write(location='Room 3', ppd='*DefaultPageSize: A4\n')
+        self.assertEqual(self.fingerprints()[0], office)
+        self.assertNotEqual(self.fingerprints()[1], lab)
+
+        self.write(location='Room 3', ppd='*DefaultPageSize: Letter\n')
+        self.assertNotEqual(self.fingerprints()[0], office)
+
+    def test_fingerprint_is_taken_once_per_run(self):
+        self.write()
+        before = self.fingerprints()
+
+        with open(os.path.join(self.cups_dir, 'printers.conf'), 'w') as f:
+            f.write(PRINTERS_CONF.format(time=1, level=80, location='Room 3'))
+        self.assertEqual(self.fingerprints(), before)
+
+    def test_pending_requires_unchanged_state(self):
+        self.write()
+        (office, lab) = self.fingerprints()
+
+        self.store.update('Lab', 'params', lab, commands_run=True)
+        self.assertTrue(self.store.pending('Lab', 'params', lab))
+        self.assertFalse(self.store.matches('Lab', 'params', lab))
+
+        # Changed in between the runs, so it has to be checked in full
+        self.write(location='Room 3')
+        self.assertFalse(self.store.pending('Lab', 'params', self.fingerprints()[1]))
+        self.assertFalse(self.store.pending('Lab', 'other params', lab))
+
+        self.store.update('Lab', 'params', self.fingerprints()[1])
+        self.assertTrue(self.store.matches('Lab', 'params', self.fingerprints()[1]))
+        self.assertFalse(self.store.pending('Lab', 'params', self.fingerprints()[1]))
+
+        self.store.update('Lab', 'params', self.fingerprints()[1], failed=True)
+        self.assertFalse(self.store.matches('Lab', 'params', self.fingerprints()[1]))
+
+
+if __name__ == '__main__':
+    unittest.main()